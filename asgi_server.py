@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+"""
+Servidor ASGI para el Analizador de Facturas.
+
+Expone el mismo contrato que backend_server.py (/analyze, /invoices,
+/query-debt, /health y /ready) sobre AsyncInvoiceAnalyzer, de modo que un solo proceso puede atender
+cientos de análisis concurrentes. Se ejecuta con uvicorn:
+
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5001
+"""
+
+import os
+import time
+import asyncio
+import functools
+import tempfile
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+from async_analyzer import AsyncInvoiceAnalyzer
+from single_flight import AsyncSingleFlight, content_hash
+from rate_limiter import AdmissionRejected, anthropic_limiter
+from outbound import outbound_policy
+from warmup import warm_up, readiness
+from invoice_store import get_invoice_store, search_from_params
+from usage_tracker import usage_tracker, usage_scope
+from profiling import request_profiler, folded
+from catalog_sync import start_catalog_sync, catalog_sync_stats
+from preprocessing import preprocessor
+from phash import near_duplicates
+from job_queue import get_job_queue, job_response
+from upload_validation import UploadRejected, allowed_file, validate_upload
+from debt_refresh import stored_debts, debt_refresh_stats
+from deadline import DEFAULT_DEADLINE, DeadlineExceeded, deadline_scope, request_deadline
+from shadow import shadow_evaluator
+from response_encoding import (
+    encode_body, request_id_for, request_logs, save_request_logs, wants_verbose
+)
+
+# Tiempo máximo de punta a punta de /analyze?withDebt=1, incluidas las consultas de deuda
+WITH_DEBT_DEADLINE = float(os.environ.get('WITH_DEBT_DEADLINE', 30))
+
+# Coalescencia de análisis concurrentes del mismo archivo dentro del proceso
+analysis_flights = AsyncSingleFlight()
+
+
+def _write_temp_file(file_bytes, ext):
+    fd, temp_file_path = tempfile.mkstemp(suffix=ext.lower())
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(file_bytes)
+    return temp_file_path
+
+
+# Logs de la respuesta: completos con ?verbose=1; si no, se guardan aparte para /debug/logs
+def response_logs(request, request_id, logs):
+    save_request_logs(request_id, request.url.path, logs)
+    return logs if wants_verbose(request.query_params) else []
+
+
+class EncodingMiddleware:
+    """ETag (GET) y compresión br/gzip de las respuestas, según lo que acepte el cliente."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        start = None
+        chunks = []
+
+        async def encoded_send(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+            chunks.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+            headers = MutableHeaders(raw=list(start['headers']))
+            status, body, extra_headers = encode_body(
+                scope['method'], start['status'], b''.join(chunks), headers.get('content-type'), request_headers
+            )
+            for name, value in extra_headers.items():
+                headers[name] = value
+            headers['Content-Length'] = str(len(body))
+            await send(dict(start, status=status, headers=headers.raw))
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, encoded_send)
+
+
+# Perfila la solicitud si un administrador lo pide (cabecera X-Profile o ?profile=).
+# Se perfila el hilo del event loop: incluye las demás solicitudes que atienda a la vez.
+def profiled(endpoint):
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        mode = request_profiler.requested_mode(request.headers, request.query_params)
+        if mode is None:
+            return await endpoint(request)
+        with request_profiler.profile(mode, request.url.path, request.headers.get('X-Request-Id')) as record:
+            response = await endpoint(request)
+        response.headers['X-Profile-Id'] = record['id']
+        return response
+    return wrapper
+
+
+# Ejecuta el análisis completo de un archivo subido y devuelve resultado y logs
+async def run_analysis(file_bytes, ext, file_hash=None, with_debt=False, deadline=None):
+    temp_file_path = await asyncio.to_thread(_write_temp_file, file_bytes, ext)
+    logs = []
+    try:
+        # Cada etapa recibe solo lo que queda del plazo de la solicitud (sin plazo si es None)
+        with deadline_scope(deadline):
+            # Analizar la factura, contabilizando los tokens de cada llamada a Claude
+            with usage_scope() as usage:
+                analyzer = AsyncInvoiceAnalyzer()
+                result = await analyzer.analyze_invoice(temp_file_path)
+            # Con withDebt, consultar en paralelo las deudas de las modalidades completas
+            debts = None
+            if with_debt and result and isinstance(result, dict):
+                debt_deadline = deadline.expires_at if deadline is not None else time.monotonic() + WITH_DEBT_DEADLINE
+                debts = await analyzer.consult_debts(result, debt_deadline)
+    finally:
+        try:
+            os.remove(temp_file_path)
+        except Exception as e:
+            logs.append(f"Error al eliminar archivo temporal: {str(e)}")
+
+    # Guardar el resultado en el historial; un fallo aquí no debe afectar la respuesta
+    # Un resultado reutilizado ya está en el historial: guardarlo de nuevo extendería la ventana de reutilización
+    invoice_id = analyzer.reused_invoice_id()
+    # Un resultado parcial (sin identificadores) no se guarda
+    if invoice_id is None and result and isinstance(result, dict) and not result.get('partial'):
+        try:
+            invoice_id = await asyncio.to_thread(get_invoice_store().save, result, file_hash, analyzer.perceptual_hash)
+        except Exception as e:
+            logs.append(f"Error al guardar la factura en el historial: {str(e)}")
+
+    # Una fracción de los análisis se repite en segundo plano con la configuración candidata
+    request_usage = usage.summary()
+    shadow_evaluator.mirror(analyzer, temp_file_path, result, request_usage)
+
+    near_duplicate = analyzer.near_duplicate.summary() if analyzer.near_duplicate is not None else None
+    return {
+        'result': result,
+        'logs': logs,
+        'invoiceId': invoice_id,
+        'usage': request_usage,
+        'debts': debts,
+        'nearDuplicate': near_duplicate
+    }
+
+
+# Ruta para verificar el estado del servidor
+async def health_check(request):
+    return JSONResponse({
+        'status': 'ok',
+        'message': 'Servidor funcionando correctamente',
+        'anthropicLimiter': anthropic_limiter.stats(),
+        'upstreams': outbound_policy.stats(),
+        'catalogSync': catalog_sync_stats(),
+        'preprocessing': preprocessor.stats()
+    })
+
+
+# Ruta para verificar si el precalentamiento terminó y el proceso puede recibir tráfico
+async def ready_check(request):
+    state = readiness()
+    return JSONResponse(state, status_code=200 if state['ready'] else 503)
+
+
+# Ruta con el consumo de tokens y costo por etapa, modelo y compañía
+async def usage_metrics(request):
+    return JSONResponse(usage_tracker.stats())
+
+
+# Ruta con los contadores de facturas casi duplicadas (atajos aplicados y grupo de control)
+async def near_duplicate_metrics(request):
+    return JSONResponse(near_duplicates.stats())
+
+
+# Ruta con la comparación entre el análisis principal y la configuración candidata en sombra
+async def shadow_metrics(request):
+    return JSONResponse(shadow_evaluator.stats())
+
+
+# Ruta para analizar facturas
+@profiled
+async def analyze_invoice(request):
+    form = await request.form()
+    file = form.get('file')
+
+    # Verificar si se envió un archivo
+    if file is None or isinstance(file, str):
+        return JSONResponse({
+            'success': False,
+            'error': 'No se ha enviado ningún archivo',
+            'logs': []
+        }, status_code=400)
+
+    # Verificar si el archivo tiene nombre
+    if not file.filename:
+        return JSONResponse({
+            'success': False,
+            'error': 'No se ha seleccionado ningún archivo',
+            'logs': []
+        }, status_code=400)
+
+    # Verificar si el archivo es de un formato permitido
+    if not allowed_file(file.filename):
+        return JSONResponse({
+            'success': False,
+            'error': 'Formato de archivo no permitido. Use: PNG, JPG, JPEG, GIF o PDF',
+            'errorCode': 'UNSUPPORTED_EXTENSION',
+            'logs': []
+        }, status_code=400)
+
+    # Con withDebt=1 la respuesta incluye las deudas, dentro de un único plazo total
+    with_debt = request.query_params.get('withDebt', '').lower() in ('1', 'true')
+    # Plazo de punta a punta: X-Request-Timeout o el del servidor
+    deadline = request_deadline(request.headers, WITH_DEBT_DEADLINE if with_debt else DEFAULT_DEADLINE)
+    request_id = request_id_for(request.headers)
+
+    try:
+        # Con async=1 solo se encola el análisis: lo procesa un worker (pdf_analyzer.py worker)
+        if request.query_params.get('async', '').lower() in ('1', 'true'):
+            file_bytes = await file.read()
+            ext = await asyncio.to_thread(validate_upload, file_bytes, file.filename)
+            job_queue = get_job_queue()
+            job_id = await asyncio.to_thread(job_queue.enqueue, file_bytes, ext, content_hash(file_bytes), with_debt)
+            job = await asyncio.to_thread(job_queue.get, job_id)
+            return JSONResponse({
+                'success': True,
+                'jobId': job_id,
+                'status': job['status'],
+                'statusUrl': f'/jobs/{job_id}'
+            }, status_code=202, headers={'Location': f'/jobs/{job_id}'})
+
+        # Rechazar antes de leer el archivo si la cola hacia Anthropic está llena
+        anthropic_limiter.check_admission()
+
+        # Rechazar en milisegundos los archivos vacíos, dañados o en blanco, sin llamar a Claude
+        file_bytes = await file.read()
+        ext = await asyncio.to_thread(validate_upload, file_bytes, file.filename)
+
+        # Las subidas duplicadas concurrentes comparten un único análisis
+        file_hash = content_hash(file_bytes)
+        outcome, shared = await analysis_flights.do(
+            file_hash + (':debt' if with_debt else ''),
+            lambda: run_analysis(file_bytes, ext, file_hash, with_debt, deadline)
+        )
+        result = outcome['result']
+        logs = list(outcome['logs'])
+        if shared:
+            logs.append("Resultado compartido con una solicitud idéntica en curso")
+
+        # Si no se pudo extraer datos, devolver un error
+        if not result or not isinstance(result, dict):
+            return JSONResponse({
+                'success': False,
+                'error': 'No se pudieron extraer datos de la factura',
+                'requestId': request_id,
+                'logs': response_logs(request, request_id, logs)
+            }, status_code=400)
+
+        response = {
+            'success': True,
+            'data': result,
+            'invoiceId': outcome.get('invoiceId'),
+            'usage': outcome.get('usage'),
+            'nearDuplicate': outcome.get('nearDuplicate'),
+            'requestId': request_id,
+            'logs': response_logs(request, request_id, logs)
+        }
+        if result.get('partial'):
+            response['partial'] = True
+        if with_debt:
+            response['debts'] = outcome.get('debts') or []
+        return JSONResponse(response)
+
+    except UploadRejected as e:
+        return JSONResponse({
+            'success': False,
+            'error': e.message,
+            'errorCode': e.code,
+            'requestId': request_id,
+            'logs': []
+        }, status_code=e.status)
+
+    except AdmissionRejected as e:
+        return JSONResponse({
+            'success': False,
+            'error': 'Servidor saturado, reintente más tarde',
+            'logs': [str(e)]
+        }, status_code=503, headers={'Retry-After': str(e.retry_after)})
+
+    except DeadlineExceeded as e:
+        return JSONResponse({
+            'success': False,
+            'error': str(e),
+            'errorCode': 'DEADLINE_EXCEEDED',
+            'requestId': request_id,
+            'logs': []
+        }, status_code=504)
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        return JSONResponse({
+            'success': False,
+            'error': str(e),
+            'requestId': request_id,
+            'logs': response_logs(request, request_id, [f"Error en el servidor: {str(e)}", error_details])
+        }, status_code=500)
+
+
+# Ruta para consultar el estado de un análisis encolado con /analyze?async=1
+async def get_job(request):
+    job = await asyncio.to_thread(get_job_queue().get, request.path_params['job_id'])
+    if job is None:
+        return JSONResponse({
+            'success': False,
+            'error': 'Trabajo no encontrado',
+            'logs': []
+        }, status_code=404)
+
+    return JSONResponse(job_response(job, verbose=wants_verbose(request.query_params)))
+
+
+# Ruta con la cantidad de trabajos por estado en la cola durable
+async def job_metrics(request):
+    return JSONResponse(await asyncio.to_thread(get_job_queue().stats))
+
+
+# Ruta para buscar facturas ya analizadas (sin volver a consultar a Claude)
+async def search_invoices(request):
+    try:
+        invoices = await asyncio.to_thread(search_from_params, get_invoice_store(), request.query_params)
+    except ValueError as e:
+        return JSONResponse({
+            'success': False,
+            'error': str(e),
+            'logs': []
+        }, status_code=400)
+
+    return JSONResponse({
+        'success': True,
+        'count': len(invoices),
+        'data': invoices
+    })
+
+
+# Ruta para obtener el resultado completo de una factura del historial
+async def get_invoice(request):
+    invoice = await asyncio.to_thread(get_invoice_store().get, request.path_params['invoice_id'])
+    if invoice is None:
+        return JSONResponse({
+            'success': False,
+            'error': 'Factura no encontrada',
+            'logs': []
+        }, status_code=404)
+
+    return JSONResponse({
+        'success': True,
+        'data': invoice
+    })
+
+
+# Ruta con las últimas deudas guardadas de una factura (actualizadas por pdf_analyzer.py refresh-debts)
+async def get_invoice_debts(request):
+    invoice_id = request.path_params['invoice_id']
+    debts = await asyncio.to_thread(stored_debts, get_invoice_store(), invoice_id)
+    if debts is None:
+        return JSONResponse({
+            'success': False,
+            'error': 'Factura no encontrada',
+            'logs': []
+        }, status_code=404)
+
+    return JSONResponse({
+        'success': True,
+        'invoiceId': invoice_id,
+        'debts': debts
+    })
+
+
+# Ruta con el estado de la actualización programada de deudas
+async def debt_refresh_metrics(request):
+    return JSONResponse(await asyncio.to_thread(debt_refresh_stats, get_invoice_store()))
+
+
+# Ruta para listar los perfiles guardados (solo administradores)
+async def list_profiles(request):
+    if not request_profiler.is_admin(request.headers):
+        return JSONResponse({'success': False, 'error': 'No autorizado', 'logs': []}, status_code=403)
+    profiles = await asyncio.to_thread(request_profiler.store.list)
+    return JSONResponse({'success': True, 'data': profiles})
+
+
+# Ruta para descargar un perfil como pilas plegadas (flamegraph) o JSON con ?format=json
+async def get_profile(request):
+    if not request_profiler.is_admin(request.headers):
+        return JSONResponse({'success': False, 'error': 'No autorizado', 'logs': []}, status_code=403)
+    profile = await asyncio.to_thread(request_profiler.store.get, request.path_params['profile_id'])
+    if profile is None:
+        return JSONResponse({'success': False, 'error': 'Perfil no encontrado', 'logs': []}, status_code=404)
+    if request.query_params.get('format') == 'json':
+        return JSONResponse({'success': True, 'data': profile})
+    return PlainTextResponse(folded(profile))
+
+
+# Ruta para consultar los logs de un análisis por su requestId (solo administradores)
+async def get_request_logs(request):
+    if not request_profiler.is_admin(request.headers):
+        return JSONResponse({'success': False, 'error': 'No autorizado', 'logs': []}, status_code=403)
+    record = await asyncio.to_thread(request_logs.get, request.path_params['request_id'])
+    if record is None:
+        return JSONResponse({'success': False, 'error': 'Logs no encontrados', 'logs': []}, status_code=404)
+    return JSONResponse({'success': True, 'data': record})
+
+
+# Ruta para consultar deudas
+async def query_debt(request):
+    try:
+        # Obtener datos de la solicitud
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+
+        if not data:
+            return JSONResponse({
+                'success': False,
+                'error': 'No se recibieron datos para la consulta',
+                'logs': ['Error: No se recibieron datos para la consulta']
+            }, status_code=400)
+
+        # Obtener los parámetros necesarios
+        company_code = data.get('companyCode')
+        modality_id = data.get('modalityId')
+        query_data = data.get('queryData')
+
+        # Validar parámetros
+        validation_errors = []
+        if not company_code:
+            validation_errors.append("Falta el parámetro 'companyCode'")
+        if not modality_id:
+            validation_errors.append("Falta el parámetro 'modalityId'")
+        if not query_data:
+            validation_errors.append("Falta el parámetro 'queryData'")
+
+        if validation_errors:
+            return JSONResponse({
+                'success': False,
+                'error': 'Parámetros inválidos',
+                'logs': validation_errors
+            }, status_code=400)
+
+        return JSONResponse({
+            'success': True,
+            'message': 'Consulta de deuda recibida correctamente',
+            'data': {
+                'companyCode': company_code,
+                'modalityId': modality_id,
+                'queryData': query_data
+            }
+        })
+
+    except Exception as e:
+        return JSONResponse({
+            'success': False,
+            'error': str(e),
+            'logs': [f"Error en el servidor: {str(e)}"]
+        }, status_code=500)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Cargar catálogo, clientes y plantillas antes de aceptar solicitudes
+    await asyncio.to_thread(warm_up)
+    sync = await asyncio.to_thread(start_catalog_sync)
+    yield
+    if sync is not None:
+        sync.stop()
+    # Cerrar los clientes HTTP compartidos al apagar el servidor
+    await AsyncInvoiceAnalyzer.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/ready', ready_check, methods=['GET']),
+        Route('/metrics/usage', usage_metrics, methods=['GET']),
+        Route('/metrics/near-duplicates', near_duplicate_metrics, methods=['GET']),
+        Route('/metrics/shadow', shadow_metrics, methods=['GET']),
+        Route('/analyze', analyze_invoice, methods=['POST']),
+        Route('/jobs/{job_id}', get_job, methods=['GET']),
+        Route('/metrics/jobs', job_metrics, methods=['GET']),
+        Route('/invoices', search_invoices, methods=['GET']),
+        Route('/invoices/{invoice_id:int}', get_invoice, methods=['GET']),
+        Route('/invoices/{invoice_id:int}/debts', get_invoice_debts, methods=['GET']),
+        Route('/metrics/debt-refresh', debt_refresh_metrics, methods=['GET']),
+        Route('/query-debt', query_debt, methods=['POST']),
+        Route('/debug/profiles', list_profiles, methods=['GET']),
+        Route('/debug/profiles/{profile_id}', get_profile, methods=['GET']),
+        Route('/debug/logs/{request_id}', get_request_logs, methods=['GET'])
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(EncodingMiddleware)
+    ],
+    lifespan=lifespan
+)
+
+# Solo ejecutar el servidor si se ejecuta este archivo directamente
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.environ.get('PORT', 5001))
+    host = '0.0.0.0' if os.environ.get('ENVIRONMENT') == 'production' else '127.0.0.1'
+
+    print("\n=====================================")
+    print("  ANALIZADOR DE FACTURAS (ASGI)")
+    print("=====================================")
+    print(f"\nServidor iniciado en: http://{host}:{port}")
+    print("\nPresiona Ctrl+C para detener el servidor")
+
+    uvicorn.run(app, host=host, port=port)
@@ -0,0 +1,263 @@
+"""
+Analizador de facturas asíncrono.
+
+Reutiliza de InvoiceAnalyzer la construcción de prompts, la búsqueda en el
+catálogo y la interpretación de respuestas, pero hace las llamadas a Anthropic
+y Tapila con clientes asíncronos, de modo que un solo proceso puede mantener
+cientos de análisis en vuelo mientras espera la red.
+"""
+
+import os
+import json
+import time
+import asyncio
+import anthropic
+import httpx
+
+from pdf_analyzer import InvoiceAnalyzer, COMPANY_PROMPT
+from rate_limiter import AdmissionRejected, anthropic_limiter, estimate_input_tokens
+from outbound import outbound_policy
+from usage_tracker import usage_tracker
+from preprocessing import preprocessor
+from phash import near_duplicates
+from deadline import DeadlineExceeded, MIN_CALL_BUDGET, require_budget
+import cassette
+
+
+def _timeout(timeout):
+    """Convierte el timeout (conexión, lectura) de la política al formato de httpx."""
+    return httpx.Timeout(timeout[1], connect=timeout[0])
+
+
+def _anthropic_timeout(timeout):
+    return anthropic.Timeout(timeout[1], connect=timeout[0])
+
+
+class AsyncInvoiceAnalyzer(InvoiceAnalyzer):
+    # Clientes compartidos por todas las instancias para reutilizar conexiones
+    _async_client = None
+    _http_client = None
+
+    def create_client(self):
+        if AsyncInvoiceAnalyzer._async_client is None:
+            client = None
+            recording = cassette.active_cassette()
+            if recording is None or not recording.offline:
+                anthropic_policy = outbound_policy.policies['anthropic']
+                client = anthropic.AsyncAnthropic(
+                    api_key=os.getenv("ANTHROPIC_API_KEY"),
+                    timeout=_anthropic_timeout(anthropic_policy.timeout),
+                    max_retries=0
+                )
+            AsyncInvoiceAnalyzer._async_client = cassette.wrap_anthropic_client(client, asynchronous=True)
+        return AsyncInvoiceAnalyzer._async_client
+
+    @classmethod
+    def http_client(cls):
+        """Cliente HTTP asíncrono compartido para Tapila."""
+        if cls._http_client is None:
+            cls._http_client = httpx.AsyncClient(transport=cassette.async_transport())
+        return cls._http_client
+
+    @classmethod
+    async def aclose(cls):
+        if cls._http_client is not None:
+            await cls._http_client.aclose()
+            cls._http_client = None
+        if cls._async_client is not None:
+            await cls._async_client.close()
+            cls._async_client = None
+
+    async def get_auth_token(self):
+        """Obtiene el token de Tapila sin bloquear el event loop."""
+        try:
+            url, headers, data = self.login_request()
+
+            print("\nIntentando obtener token de autenticación...")
+
+            async def post_login(timeout):
+                response = await self.http_client().post(url, headers=headers, json=data, timeout=_timeout(timeout))
+                if response.status_code >= 500:
+                    response.raise_for_status()
+                return response
+
+            response = await outbound_policy.call_async('tapila_login', post_login)
+
+            print(f"Status code: {response.status_code}")
+            print(f"Response body: {response.text}")
+
+            response.raise_for_status()
+            return self.store_auth_token(response.json())
+
+        except httpx.HTTPError as e:
+            print(f"Error al obtener el token de autenticación: {str(e)}")
+            return None
+        except cassette.CassetteMiss:
+            raise
+        except Exception as e:
+            print(f"Error inesperado al obtener el token: {str(e)}")
+            return None
+
+    async def prepared_image(self, image_path):
+        """Prepara la factura una sola vez por análisis, en el pool de procesos."""
+        prepared = self._prepared_images.get(image_path)
+        if prepared is None:
+            prepared = await preprocessor.prepare_async(image_path)
+            self._prepared_images[image_path] = prepared
+        return prepared
+
+    async def find_near_duplicate(self, image_path):
+        """Busca en el historial otra foto de la misma factura sin bloquear el event loop."""
+        self.perceptual_hash = (await self.prepared_image(image_path)).perceptual_hash
+        self.near_duplicate = await asyncio.to_thread(near_duplicates.lookup, self.perceptual_hash)
+        self.report_near_duplicate(self.near_duplicate)
+        return self.near_duplicate
+
+    async def analyze_image(self, image_path, prompt, stage=None):
+        """Analiza una imagen con Claude usando el cliente asíncrono."""
+        try:
+            prepared = await self.prepared_image(image_path)
+            require_budget(MIN_CALL_BUDGET, stage)
+            model, max_tokens = self.message_options()
+            request = self.image_message_request(prompt, prepared.data, prepared.media_type, model, max_tokens)
+
+            async def create_message(timeout):
+                async with anthropic_limiter.async_slot(estimate_input_tokens(prompt), request["max_tokens"] // 4) as slot:
+                    try:
+                        message = await self.client.messages.create(timeout=_anthropic_timeout(timeout), **request)
+                    except Exception as e:
+                        self.handle_overload(e, slot)
+                        raise
+                    slot.record_usage(message.usage)
+                return message
+
+            started = time.monotonic()
+            message = await outbound_policy.call_async('anthropic', create_message)
+            usage_tracker.record(stage, request["model"], getattr(message, 'usage', None), time.monotonic() - started)
+
+            return message.content[0].text
+
+        except (AdmissionRejected, DeadlineExceeded, cassette.CassetteMiss):
+            raise
+        except Exception as e:
+            return f"Error analyzing image: {str(e)}"
+
+    async def consult_debt(self, company_code, modality_id, query_data):
+        """Consulta la deuda en Tapila sin bloquear el event loop."""
+        try:
+            if not self.auth_token:
+                await self.get_auth_token()
+                if not self.auth_token:
+                    return None
+
+            url, headers, data = self.debt_request(company_code, modality_id, query_data)
+            cache_key = json.dumps([company_code, modality_id, query_data], sort_keys=True)
+
+            async def post_debts(timeout):
+                response = await self.http_client().post(url, headers=headers, json=data, timeout=_timeout(timeout))
+                if response.status_code == 401:
+                    print("Token rechazado, renovando...")
+                    if await self.get_auth_token():
+                        headers['x-authorization-token'] = self.auth_token
+                        response = await self.http_client().post(url, headers=headers, json=data, timeout=_timeout(timeout))
+
+                print(f"\nResponse status code: {response.status_code}")
+                print(f"Response body: {response.text}")
+
+                response.raise_for_status()
+
+                debt = response.json()
+                self.remember_debt(cache_key, debt)
+                return debt
+
+            return await outbound_policy.call_async('tapila_debts', post_debts, fallback=lambda: self.cached_debt(cache_key))
+
+        except (httpx.HTTPError, AdmissionRejected) as e:
+            print(f"Error al consultar la deuda: {str(e)}")
+            return None
+
+    async def consult_debts(self, result, deadline):
+        """Consulta en paralelo la deuda de cada modalidad completa, sin pasar del deadline (time.monotonic())."""
+        lookups = self.debt_lookups(result)
+        if not lookups:
+            return []
+        if time.monotonic() >= deadline:
+            return [self.debt_entry(modality_id, "timeout") for modality_id, _ in lookups]
+
+        # Un solo login para todas las consultas paralelas
+        if not self.auth_token:
+            await self.get_auth_token()
+
+        company_code = result.get("companyCode", "")
+        tasks = [
+            (modality_id, asyncio.ensure_future(self.consult_debt(company_code, modality_id, query_data)))
+            for modality_id, query_data in lookups
+        ]
+        done, pending = await asyncio.wait([task for _, task in tasks], timeout=max(0.0, deadline - time.monotonic()))
+        for task in pending:
+            task.cancel()
+
+        debts = []
+        for modality_id, task in tasks:
+            if task not in done or isinstance(task.exception(), DeadlineExceeded):
+                debts.append(self.debt_entry(modality_id, "timeout"))
+            elif task.exception() is not None:
+                debts.append(self.debt_entry(modality_id, "error", error=str(task.exception())))
+            elif task.result() is None:
+                debts.append(self.debt_entry(modality_id, "error", error="No se pudo consultar la deuda"))
+            else:
+                debts.append(self.debt_entry(modality_id, "ok", task.result()))
+        return debts
+
+    async def analyze_invoice(self, image_path):
+        """Analiza una factura y extrae la información necesaria."""
+        try:
+            near_duplicate = await self.find_near_duplicate(image_path)
+
+            # La primera búsqueda carga el catálogo desde disco: se hace fuera del event loop
+            company_info = await asyncio.to_thread(self.known_company, near_duplicate)
+            if company_info:
+                category = near_duplicate.category
+            else:
+                invoice_info = await self.analyze_image(image_path, COMPANY_PROMPT, stage='company')
+                company = self.parse_company_response(invoice_info)
+                if company is None:
+                    return None
+                company_names, category, invoice_type = company
+
+                company_info = await asyncio.to_thread(self.select_company, company_names, category)
+                if not company_info:
+                    return None
+            usage_tracker.tag_company(company_info.get("companyCode", ""))
+
+            active_modalities = self.get_active_modalities(company_info)
+            if not active_modalities:
+                return None
+
+            identifiers_to_find, identifiers_prompt = self.identifiers_plan(company_info, active_modalities)
+
+            print("\nConsultando a Claude para extraer los identificadores...")
+            try:
+                identifiers_info = await self.analyze_image(image_path, identifiers_prompt, stage='identifiers')
+            except DeadlineExceeded as e:
+                return self.partial_result(company_info, category, active_modalities, identifiers_to_find, e)
+            invoice_data = self.parse_identifiers_response(identifiers_info, identifiers_to_find)
+            if invoice_data is None:
+                return None
+
+            result = self.build_result(company_info, category, active_modalities, identifiers_to_find, invoice_data)
+            result = self.confirm_reuse(near_duplicate, result)
+            near_duplicates.observe(near_duplicate, result)
+
+            print("\nResultado del análisis:")
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+
+            return result
+
+        except (AdmissionRejected, DeadlineExceeded, cassette.CassetteMiss):
+            raise
+        except Exception as e:
+            print(f"Error al analizar la factura: {str(e)}")
+            import traceback
+            print(traceback.format_exc())
+            return None
@@ -5,13 +5,33 @@ Este script proporciona solo las APIs necesarias sin la interfaz web.
 """
 
 import os
-import json
-from flask import Flask, request, jsonify
+import time
+import functools
+import contextvars
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import tempfile
 from io import StringIO
 import logging
 from pdf_analyzer import InvoiceAnalyzer
+from single_flight import SingleFlight, content_hash
+from rate_limiter import AdmissionRejected, anthropic_limiter
+from outbound import outbound_policy
+from warmup import warm_up, readiness
+from invoice_store import get_invoice_store, search_from_params
+from usage_tracker import usage_tracker, usage_scope
+from profiling import request_profiler, folded
+from catalog_sync import start_catalog_sync, catalog_sync_stats
+from preprocessing import preprocessor
+from phash import near_duplicates
+from job_queue import get_job_queue, job_response
+from upload_validation import UploadRejected, allowed_file, validate_upload
+from debt_refresh import stored_debts, debt_refresh_stats
+from deadline import DEFAULT_DEADLINE, DeadlineExceeded, deadline_scope, request_deadline
+from shadow import shadow_evaluator
+from response_encoding import (
+    encode_body, request_id_for, request_logs, save_request_logs, wants_verbose
+)
 import sys
 
 # Configurar la aplicación Flask
@@ -21,45 +41,180 @@ CORS(app)  # Habilitar CORS para todas las rutas
 # Asegurar que Python pueda encontrar los módulos en el directorio actual
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-# Clase para capturar logs
+# Tiempo máximo de punta a punta de /analyze?withDebt=1, incluidas las consultas de deuda
+WITH_DEBT_DEADLINE = float(os.environ.get('WITH_DEBT_DEADLINE', 30))
+
+# Coalescencia de análisis concurrentes del mismo archivo (por hash de contenido).
+# SINGLE_FLIGHT_DIR habilita la coordinación entre workers mediante archivos de bloqueo.
+analysis_flights = SingleFlight(
+    shared_dir=os.environ.get('SINGLE_FLIGHT_DIR'),
+    shared_ttl=float(os.environ.get('SINGLE_FLIGHT_TTL', 30)),
+    max_wait=float(os.environ.get('SINGLE_FLIGHT_MAX_WAIT', 60))
+)
+
+# Captura de logs de la solicitud en curso; con varios hilos por worker cada análisis tiene la suya
+_current_capture = contextvars.ContextVar('log_capture', default=None)
+
+class RequestLogHandler(logging.Handler):
+    """Único handler del logger raíz: envía cada registro a la captura de la solicitud que lo generó."""
+
+    def emit(self, record):
+        capture = _current_capture.get()
+        if capture is not None:
+            capture.write(self.format(record))
+        elif record.levelno >= logging.lastResort.level:
+            # Fuera de una solicitud, los avisos siguen saliendo por stderr
+            logging.lastResort.handle(record)
+
 class LogCapture:
     def __init__(self):
         self.log_capture_string = StringIO()
-        self.log_handler = logging.StreamHandler(self.log_capture_string)
-        self.log_handler.setLevel(logging.INFO)
-        self.formatter = logging.Formatter('%(message)s')
-        self.log_handler.setFormatter(self.formatter)
-        self.logger = logging.getLogger()
-        self.original_handlers = self.logger.handlers.copy()
-        self.original_level = self.logger.level
+        self._token = None
 
     def start_capture(self):
-        self.logger.handlers = [self.log_handler]
-        self.logger.setLevel(logging.INFO)
+        self._token = _current_capture.set(self)
 
     def stop_capture(self):
-        self.logger.handlers = self.original_handlers
-        self.logger.setLevel(self.original_level)
+        _current_capture.reset(self._token)
+
+    def write(self, message):
+        self.log_capture_string.write(message + '\n')
 
     def get_logs(self):
         log_contents = self.log_capture_string.getvalue()
         return log_contents.strip().split('\n') if log_contents else []
 
-# Función para verificar si el tipo de archivo es permitido
-def allowed_file(filename):
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Se instala una sola vez: las solicitudes nunca reasignan los handlers del logger raíz
+_request_log_handler = RequestLogHandler(logging.INFO)
+_request_log_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.getLogger().addHandler(_request_log_handler)
+if logging.getLogger().getEffectiveLevel() > logging.INFO:
+    logging.getLogger().setLevel(logging.INFO)
+
+# Logs de la respuesta: completos con ?verbose=1; si no, se guardan aparte para /debug/logs
+def response_logs(request_id, logs):
+    save_request_logs(request_id, request.path, logs)
+    return logs if wants_verbose(request.args) else []
+
+# ETag (GET) y compresión br/gzip según lo que acepte el cliente
+@app.after_request
+def encode_response(response):
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    status, body, headers = encode_body(
+        request.method, response.status_code, response.get_data(), response.mimetype, request.headers
+    )
+    response.set_data(body)
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+# Perfila la solicitud si un administrador lo pide (cabecera X-Profile o ?profile=)
+def profiled(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        mode = request_profiler.requested_mode(request.headers, request.args)
+        if mode is None:
+            return view(*args, **kwargs)
+        with request_profiler.profile(mode, request.path, request.headers.get('X-Request-Id')) as record:
+            response = app.make_response(view(*args, **kwargs))
+        response.headers['X-Profile-Id'] = record['id']
+        return response
+    return wrapper
+
+# Ejecuta el análisis completo de un archivo subido y devuelve resultado y logs
+def run_analysis(file_bytes, ext, file_hash=None, with_debt=False, deadline=None):
+    # Guardar el archivo temporalmente con un nombre único
+    fd, temp_file_path = tempfile.mkstemp(suffix=ext.lower())
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(file_bytes)
+
+    # Capturar logs durante el análisis
+    log_capture = LogCapture()
+    log_capture.start_capture()
+
+    try:
+        # Cada etapa recibe solo lo que queda del plazo de la solicitud (sin plazo si es None)
+        with deadline_scope(deadline):
+            # Analizar la factura, contabilizando los tokens de cada llamada a Claude
+            with usage_scope() as usage:
+                analyzer = InvoiceAnalyzer()
+                result = analyzer.analyze_invoice(temp_file_path)
+            # Con withDebt, consultar en paralelo las deudas de las modalidades completas
+            debts = None
+            if with_debt and result and isinstance(result, dict):
+                debt_deadline = deadline.expires_at if deadline is not None else time.monotonic() + WITH_DEBT_DEADLINE
+                debts = analyzer.consult_debts(result, debt_deadline)
+    finally:
+        # Eliminar el archivo temporal también si el análisis se rechaza o se agota el plazo
+        try:
+            os.remove(temp_file_path)
+        except Exception as e:
+            log_capture.write(f"Error al eliminar archivo temporal: {str(e)}")
+        # Detener la captura de logs
+        log_capture.stop_capture()
+    logs = log_capture.get_logs()
+
+    # Guardar el resultado en el historial; un fallo aquí no debe afectar la respuesta
+    # Un resultado reutilizado ya está en el historial: guardarlo de nuevo extendería la ventana de reutilización
+    invoice_id = analyzer.reused_invoice_id()
+    # Un resultado parcial (sin identificadores) no se guarda
+    if invoice_id is None and result and isinstance(result, dict) and not result.get('partial'):
+        try:
+            invoice_id = get_invoice_store().save(result, file_hash, analyzer.perceptual_hash)
+        except Exception as e:
+            logs.append(f"Error al guardar la factura en el historial: {str(e)}")
+
+    # Una fracción de los análisis se repite en segundo plano con la configuración candidata
+    request_usage = usage.summary()
+    shadow_evaluator.mirror(analyzer, temp_file_path, result, request_usage)
+
+    near_duplicate = analyzer.near_duplicate.summary() if analyzer.near_duplicate is not None else None
+    return {
+        'result': result,
+        'logs': logs,
+        'invoiceId': invoice_id,
+        'usage': request_usage,
+        'debts': debts,
+        'nearDuplicate': near_duplicate
+    }
 
 # Ruta para verificar el estado del servidor
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'ok',
-        'message': 'Servidor funcionando correctamente'
+        'message': 'Servidor funcionando correctamente',
+        'anthropicLimiter': anthropic_limiter.stats(),
+        'upstreams': outbound_policy.stats(),
+        'catalogSync': catalog_sync_stats(),
+        'preprocessing': preprocessor.stats()
     })
 
+# Ruta para verificar si el precalentamiento terminó y el worker puede recibir tráfico
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    state = readiness()
+    return jsonify(state), (200 if state['ready'] else 503)
+
+# Ruta con el consumo de tokens y costo por etapa, modelo y compañía
+@app.route('/metrics/usage', methods=['GET'])
+def usage_metrics():
+    return jsonify(usage_tracker.stats())
+
+# Ruta con los contadores de facturas casi duplicadas (atajos aplicados y grupo de control)
+@app.route('/metrics/near-duplicates', methods=['GET'])
+def near_duplicate_metrics():
+    return jsonify(near_duplicates.stats())
+
+# Ruta con la comparación entre el análisis principal y la configuración candidata en sombra
+@app.route('/metrics/shadow', methods=['GET'])
+def shadow_metrics():
+    return jsonify(shadow_evaluator.stats())
+
 # Ruta para analizar facturas
 @app.route('/analyze', methods=['POST'])
+@profiled
 def analyze_invoice():
     # Verificar si se envió un archivo
     if 'file' not in request.files:
@@ -84,46 +239,104 @@ def analyze_invoice():
         return jsonify({
             'success': False,
             'error': 'Formato de archivo no permitido. Use: PNG, JPG, JPEG, GIF o PDF',
+            'errorCode': 'UNSUPPORTED_EXTENSION',
             'logs': []
         }), 400
 
-    try:
-        # Guardar el archivo temporalmente
-        temp_dir = tempfile.gettempdir()
-        temp_file_path = os.path.join(temp_dir, file.filename)
-        file.save(temp_file_path)
+    # Con withDebt=1 la respuesta incluye las deudas, dentro de un único plazo total
+    with_debt = request.args.get('withDebt', '').lower() in ('1', 'true')
+    # Plazo de punta a punta: X-Request-Timeout o el del servidor
+    deadline = request_deadline(request.headers, WITH_DEBT_DEADLINE if with_debt else DEFAULT_DEADLINE)
+    request_id = request_id_for(request.headers)
 
-        # Capturar logs durante el análisis
-        log_capture = LogCapture()
-        log_capture.start_capture()
+    try:
+        # Con async=1 solo se encola el análisis: lo procesa un worker (pdf_analyzer.py worker)
+        if request.args.get('async', '').lower() in ('1', 'true'):
+            file_bytes = file.read()
+            ext = validate_upload(file_bytes, file.filename)
+            job_queue = get_job_queue()
+            job_id = job_queue.enqueue(file_bytes, ext, content_hash(file_bytes), with_debt)
+            response = jsonify({
+                'success': True,
+                'jobId': job_id,
+                'status': job_queue.get(job_id)['status'],
+                'statusUrl': f'/jobs/{job_id}'
+            })
+            response.headers['Location'] = f'/jobs/{job_id}'
+            return response, 202
 
-        # Analizar la factura
-        analyzer = InvoiceAnalyzer()
-        result = analyzer.analyze_invoice(temp_file_path)
+        # Rechazar antes de leer el archivo si la cola hacia Anthropic está llena
+        anthropic_limiter.check_admission()
 
-        # Detener la captura de logs
-        log_capture.stop_capture()
-        logs = log_capture.get_logs()
+        # Rechazar en milisegundos los archivos vacíos, dañados o en blanco, sin llamar a Claude
+        file_bytes = file.read()
+        ext = validate_upload(file_bytes, file.filename)
 
-        # Eliminar el archivo temporal
-        try:
-            os.remove(temp_file_path)
-        except Exception as e:
-            logs.append(f"Error al eliminar archivo temporal: {str(e)}")
+        # Las subidas duplicadas concurrentes comparten un único análisis
+        file_hash = content_hash(file_bytes)
+        # Con el plazo publicado, la espera por una solicitud idéntica no lo supera
+        with deadline_scope(deadline):
+            outcome, shared = analysis_flights.do(
+                file_hash + (':debt' if with_debt else ''),
+                lambda: run_analysis(file_bytes, ext, file_hash, with_debt, deadline),
+                # Los resultados parciales dependen del plazo de cada solicitud: no se publican
+                shareable=lambda outcome: outcome['result'] is not None and not outcome['result'].get('partial')
+            )
+        result = outcome['result']
+        logs = list(outcome['logs'])
+        if shared:
+            logs.append("Resultado compartido con una solicitud idéntica en curso")
 
         # Si no se pudo extraer datos, devolver un error
         if not result or not isinstance(result, dict):
             return jsonify({
                 'success': False,
                 'error': 'No se pudieron extraer datos de la factura',
-                'logs': logs
+                'requestId': request_id,
+                'logs': response_logs(request_id, logs)
             }), 400
 
-        return jsonify({
+        response = {
             'success': True,
             'data': result,
-            'logs': logs
+            'invoiceId': outcome.get('invoiceId'),
+            'usage': outcome.get('usage'),
+            'nearDuplicate': outcome.get('nearDuplicate'),
+            'requestId': request_id,
+            'logs': response_logs(request_id, logs)
+        }
+        if result.get('partial'):
+            response['partial'] = True
+        if with_debt:
+            response['debts'] = outcome.get('debts') or []
+        return jsonify(response)
+
+    except UploadRejected as e:
+        return jsonify({
+            'success': False,
+            'error': e.message,
+            'errorCode': e.code,
+            'requestId': request_id,
+            'logs': []
+        }), e.status
+
+    except AdmissionRejected as e:
+        response = jsonify({
+            'success': False,
+            'error': 'Servidor saturado, reintente más tarde',
+            'logs': [str(e)]
         })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+
+    except DeadlineExceeded as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'errorCode': 'DEADLINE_EXCEEDED',
+            'requestId': request_id,
+            'logs': []
+        }), 504
 
     except Exception as e:
         import traceback
@@ -131,9 +344,113 @@ def analyze_invoice():
         return jsonify({
             'success': False,
             'error': str(e),
-            'logs': [f"Error en el servidor: {str(e)}", error_details]
+            'requestId': request_id,
+            'logs': response_logs(request_id, [f"Error en el servidor: {str(e)}", error_details])
         }), 500
 
+# Ruta para consultar el estado de un análisis encolado con /analyze?async=1
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Trabajo no encontrado',
+            'logs': []
+        }), 404
+
+    return jsonify(job_response(job, verbose=wants_verbose(request.args)))
+
+# Ruta con la cantidad de trabajos por estado en la cola durable
+@app.route('/metrics/jobs', methods=['GET'])
+def job_metrics():
+    return jsonify(get_job_queue().stats())
+
+# Ruta para buscar facturas ya analizadas (sin volver a consultar a Claude)
+@app.route('/invoices', methods=['GET'])
+def search_invoices():
+    try:
+        invoices = search_from_params(get_invoice_store(), request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'logs': []
+        }), 400
+
+    return jsonify({
+        'success': True,
+        'count': len(invoices),
+        'data': invoices
+    })
+
+# Ruta para obtener el resultado completo de una factura del historial
+@app.route('/invoices/<int:invoice_id>', methods=['GET'])
+def get_invoice(invoice_id):
+    invoice = get_invoice_store().get(invoice_id)
+    if invoice is None:
+        return jsonify({
+            'success': False,
+            'error': 'Factura no encontrada',
+            'logs': []
+        }), 404
+
+    return jsonify({
+        'success': True,
+        'data': invoice
+    })
+
+# Ruta con las últimas deudas guardadas de una factura (actualizadas por pdf_analyzer.py refresh-debts)
+@app.route('/invoices/<int:invoice_id>/debts', methods=['GET'])
+def get_invoice_debts(invoice_id):
+    debts = stored_debts(get_invoice_store(), invoice_id)
+    if debts is None:
+        return jsonify({
+            'success': False,
+            'error': 'Factura no encontrada',
+            'logs': []
+        }), 404
+
+    return jsonify({
+        'success': True,
+        'invoiceId': invoice_id,
+        'debts': debts
+    })
+
+# Ruta con el estado de la actualización programada de deudas
+@app.route('/metrics/debt-refresh', methods=['GET'])
+def debt_refresh_metrics():
+    return jsonify(debt_refresh_stats(get_invoice_store()))
+
+# Ruta para listar los perfiles guardados (solo administradores)
+@app.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+    if not request_profiler.is_admin(request.headers):
+        return jsonify({'success': False, 'error': 'No autorizado', 'logs': []}), 403
+    return jsonify({'success': True, 'data': request_profiler.store.list()})
+
+# Ruta para descargar un perfil como pilas plegadas (flamegraph) o JSON con ?format=json
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    if not request_profiler.is_admin(request.headers):
+        return jsonify({'success': False, 'error': 'No autorizado', 'logs': []}), 403
+    profile = request_profiler.store.get(profile_id)
+    if profile is None:
+        return jsonify({'success': False, 'error': 'Perfil no encontrado', 'logs': []}), 404
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'data': profile})
+    return Response(folded(profile), mimetype='text/plain')
+
+# Ruta para consultar los logs de un análisis por su requestId (solo administradores)
+@app.route('/debug/logs/<request_id>', methods=['GET'])
+def get_request_logs(request_id):
+    if not request_profiler.is_admin(request.headers):
+        return jsonify({'success': False, 'error': 'No autorizado', 'logs': []}), 403
+    record = request_logs.get(request_id)
+    if record is None:
+        return jsonify({'success': False, 'error': 'Logs no encontrados', 'logs': []}), 404
+    return jsonify({'success': True, 'data': record})
+
 # Ruta para consultar deudas
 @app.route('/query-debt', methods=['POST'])
 def query_debt():
@@ -202,6 +519,10 @@ if __name__ == '__main__':
     print(f"\nServidor iniciado en: http://{host}:{port}")
     print(f"Para acceder desde otros dispositivos: http://<tu-ip>:{port}")
     print("\nPresiona Ctrl+C para detener el servidor")
+
+    # Cargar catálogo, clientes y plantillas antes de aceptar solicitudes
+    warm_up()
+    start_catalog_sync()
     
     # Iniciar el servidor
     app.run(host=host, port=port, debug=False) 
\ No newline at end of file
@@ -0,0 +1,332 @@
+"""
+Análisis por lotes de un archivo de facturas, sin interacción.
+
+    python3 pdf_analyzer.py batch escaneos/2024-05 'escaneos/**/*.pdf' --jobs 8 --out resultados.jsonl
+
+Recorre directorios (recursivamente) y patrones glob, analiza las facturas en
+paralelo y escribe un registro JSON por línea y por archivo. Cada factura
+terminada se anota en un checkpoint (por defecto `<salida>.checkpoint`, con el
+SHA-256 del contenido): si la ejecución se interrumpe, el mismo comando la
+retoma sin volver a analizar las facturas ya resueltas, y un archivo con el
+mismo contenido que otro ya analizado se registra como duplicado sin llamar a
+Claude. Las que fallaron se reintentan en la siguiente ejecución; en la salida
+vale el último registro de cada archivo.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import preprocessing
+from rate_limiter import AdmissionRejected
+from usage_tracker import usage_scope
+from upload_validation import UploadRejected, validate_upload
+
+SUPPORTED_EXTENSIONS = set(preprocessing.MEDIA_TYPES)
+
+# Segundos entre actualizaciones de la línea de progreso
+PROGRESS_INTERVAL = 1.0
+
+
+def expand_inputs(inputs):
+    """Archivos de factura de los directorios, patrones glob y archivos indicados, sin repetir."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, names in os.walk(item):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(names))
+        elif glob.has_magic(item):
+            paths.extend(sorted(glob.glob(item, recursive=True)))
+        else:
+            paths.append(item)
+
+    seen = set()
+    files = []
+    for path in paths:
+        key = os.path.abspath(path)
+        if key in seen or not os.path.isfile(path):
+            continue
+        if os.path.splitext(path)[1].lower() not in SUPPORTED_EXTENSIONS:
+            continue
+        seen.add(key)
+        files.append(path)
+    return files
+
+
+class Checkpoint:
+    """Archivos ya resueltos, una línea `sha256 ruta` por archivo."""
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = set()
+        # Primer archivo resuelto con cada contenido
+        self.hashes = {}
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    sha256, _, done_path = line.rstrip('\n').partition(' ')
+                    if sha256 and done_path:
+                        self._mark(sha256, done_path)
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a')
+
+    def _mark(self, sha256, path):
+        self.paths.add(path)
+        self.hashes.setdefault(sha256, path)
+
+    def add(self, sha256, path):
+        self._mark(sha256, path)
+        self._file.write(f"{sha256} {path}\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.started = time.monotonic()
+        self.analyzed = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.failed = 0
+        self.cost = 0.0
+        self.interrupted = False
+        self._printed = 0.0
+        self._printed_finished = None
+
+    @property
+    def finished(self):
+        return self.analyzed + self.duplicates + self.skipped + self.failed
+
+    def line(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.analyzed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.finished
+        eta = f"{int(remaining / rate // 60)}m{int(remaining / rate % 60):02d}s" if rate > 0 else "-"
+        return (f"[{self.finished}/{self.total}] {rate:.2f} facturas/s, ETA {eta}, "
+                f"omitidas {self.skipped}, duplicadas {self.duplicates}, errores {self.failed}, "
+                f"costo ${self.cost:.2f}")
+
+    def update(self, force=False):
+        now = time.monotonic()
+        if force and self._printed_finished == self.finished:
+            return
+        if force or now - self._printed >= PROGRESS_INTERVAL:
+            self._printed = now
+            self._printed_finished = self.finished
+            # En una terminal la línea se reescribe en el lugar
+            end = '\r' if self.stream.isatty() and not force else '\n'
+            print(self.line(), end=end, file=self.stream, flush=True)
+
+    def message(self, text):
+        prefix = '\n' if self.stream.isatty() else ''
+        print(prefix + text, file=self.stream, flush=True)
+
+
+class Claim:
+    """Archivo que está analizando un contenido; los duplicados esperan su resultado."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = threading.Event()
+        self.failed = False
+
+
+class BatchRunner:
+    def __init__(self, jobs=4, with_debts=False, debt_timeout=30.0, save=False, retries=5):
+        self.jobs = jobs
+        self.with_debts = with_debts
+        self.debt_timeout = debt_timeout
+        # Guardar también los resultados en el historial (invoice_store)
+        self.save = save
+        # Reintentos ante rechazos del control de admisión hacia Anthropic
+        self.retries = retries
+        self._claimed = {}
+        self._lock = threading.Lock()
+
+    def claim(self, sha256, path, checkpoint):
+        """
+        Reserva el hash para este archivo; devuelve el archivo que ya resolvió ese contenido, o None.
+
+        Un duplicado de un archivo en curso espera su resultado: solo es
+        duplicado si ese análisis terminó bien; si falló, este archivo toma la
+        reserva y se analiza.
+        """
+        while True:
+            with self._lock:
+                owner = checkpoint.hashes.get(sha256)
+                if owner is not None:
+                    return owner
+                claim = self._claimed.get(sha256)
+                if claim is None or claim.failed:
+                    self._claimed[sha256] = Claim(path)
+                    return None
+            claim.done.wait()
+            if not claim.failed:
+                return claim.path
+
+    def release(self, sha256, failed):
+        with self._lock:
+            claim = self._claimed[sha256]
+            claim.failed = failed
+        claim.done.set()
+
+    def analyze_file(self, path, checkpoint):
+        """Analiza un archivo y devuelve su registro de salida."""
+        from pdf_analyzer import InvoiceAnalyzer
+
+        started = time.monotonic()
+        record = {'path': path, 'sha256': None, 'status': 'ok'}
+        claimed = False
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            record['sha256'] = hashlib.sha256(data).hexdigest()
+            owner = self.claim(record['sha256'], path, checkpoint)
+            if owner is not None:
+                record['status'] = 'duplicate'
+                record['duplicateOf'] = owner
+                return record
+            claimed = True
+            # Los archivos vacíos, dañados o en blanco se descartan sin llamar a Claude
+            validate_upload(data, path)
+            del data
+
+            for attempt in range(self.retries + 1):
+                try:
+                    with usage_scope() as usage:
+                        analyzer = InvoiceAnalyzer()
+                        result = analyzer.analyze_invoice(path)
+                    break
+                except AdmissionRejected as e:
+                    if attempt >= self.retries:
+                        raise
+                    time.sleep(e.retry_after)
+
+            record['usage'] = usage.summary()
+            if not result:
+                record['status'] = 'error'
+                record['error'] = 'No se pudieron extraer datos de la factura'
+                return record
+            record['result'] = result
+            if self.with_debts:
+                record['debts'] = analyzer.consult_debts(result, time.monotonic() + self.debt_timeout)
+            if self.save:
+                from invoice_store import get_invoice_store
+                record['invoiceId'] = analyzer.reused_invoice_id() or get_invoice_store().save(
+                    result, record['sha256'], analyzer.perceptual_hash
+                )
+        except UploadRejected as e:
+            record['status'] = 'error'
+            record['error'] = e.message
+            record['errorCode'] = e.code
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = f"{type(e).__name__}: {str(e)}"
+        finally:
+            if claimed:
+                self.release(record['sha256'], record['status'] == 'error')
+            record['seconds'] = round(time.monotonic() - started, 3)
+        return record
+
+    def run(self, files, out, checkpoint_path, verbose=False):
+        """Procesa los archivos escribiendo un registro por línea en out; devuelve el progreso final."""
+        checkpoint = Checkpoint(checkpoint_path)
+        progress = Progress(len(files))
+        # Los detalles que imprime el analizador solo se muestran con --verbose
+        quiet = None if verbose else open(os.devnull, 'w')
+        executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='batch')
+        pending = set()
+        try:
+            with open(out, 'a') as output, redirect_stdout(quiet or sys.stdout):
+                try:
+                    for path in files:
+                        if path in checkpoint.paths:
+                            # Resuelto en una ejecución anterior
+                            progress.skipped += 1
+                            continue
+                        # Ventana acotada de trabajos en vuelo: el listado puede tener decenas de miles
+                        while len(pending) >= self.jobs * 2:
+                            pending = self._collect(pending, output, checkpoint, progress)
+                        pending.add(executor.submit(self.analyze_file, path, checkpoint))
+                    while pending:
+                        pending = self._collect(pending, output, checkpoint, progress)
+                except KeyboardInterrupt:
+                    progress.interrupted = True
+                    progress.message("Interrumpido: esperando los análisis en curso. "
+                                     "El mismo comando retoma el lote.")
+                    for future in pending:
+                        future.cancel()
+                    for future in pending:
+                        if not future.cancelled():
+                            self._record(future.result(), output, checkpoint, progress)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            checkpoint.close()
+            if quiet is not None:
+                quiet.close()
+        progress.update(force=True)
+        return progress
+
+    def _collect(self, pending, output, checkpoint, progress):
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            self._record(future.result(), output, checkpoint, progress)
+        progress.update()
+        return pending
+
+    def _record(self, record, output, checkpoint, progress):
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        output.flush()
+        if record['status'] == 'error':
+            progress.failed += 1
+            progress.message(f"Error en {record['path']}: {record['error']}")
+            return
+        checkpoint.add(record['sha256'], record['path'])
+        if record['status'] == 'duplicate':
+            progress.duplicates += 1
+        else:
+            progress.cost += record['usage'].get('cost_usd', 0.0)
+            progress.analyzed += 1
+
+
+def run_batch(args):
+    from phash import near_duplicates
+
+    # Cada archivo del lote se analiza completo: en un archivo de facturas del mismo
+    # diseño, el atajo por similitud copiaría el resultado de una factura a la siguiente
+    near_duplicates.mode = 'off'
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        print("No se encontraron facturas en las rutas indicadas", file=sys.stderr)
+        return 1
+
+    checkpoint_path = args.checkpoint or f"{args.out}.checkpoint"
+    print(f"Facturas encontradas: {len(files)}; resultados en {args.out} (checkpoint {checkpoint_path})",
+          file=sys.stderr)
+    runner = BatchRunner(
+        jobs=args.jobs,
+        with_debts=args.debts,
+        debt_timeout=args.debt_timeout,
+        save=args.save,
+        retries=args.retries
+    )
+    progress = runner.run(files, args.out, checkpoint_path, verbose=args.verbose)
+    elapsed = time.monotonic() - progress.started
+    print(f"Analizadas {progress.analyzed}, omitidas {progress.skipped}, duplicadas {progress.duplicates}, "
+          f"errores {progress.failed} en {elapsed:.1f}s ({progress.analyzed / elapsed if elapsed else 0:.2f} facturas/s)", file=sys.stderr)
+    if progress.interrupted:
+        return 130
+    return 0 if progress.failed == 0 else 1
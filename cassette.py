@@ -0,0 +1,346 @@
+"""
+Grabación y reproducción de las llamadas salientes (Anthropic y Tapila).
+
+Con CASSETTE_MODE=record cada solicitud se guarda con su respuesta y latencia
+en CASSETTE_DIR, en un archivo por huella de la solicitud. Con
+CASSETTE_MODE=replay las respuestas se sirven desde esos archivos sin acceso a
+la red (CASSETTE_SIMULATE_LATENCY=1 reproduce además la latencia grabada), y
+con CASSETTE_MODE=auto se reproduce lo grabado y se graba lo que falte.
+
+La huella ignora lo que cambia entre ejecuciones sin alterar la respuesta:
+timeouts, cabeceras (token y API keys), credenciales y externalRequestId.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+MODES = ('record', 'replay', 'auto')
+
+# Campos del cuerpo de Tapila que no forman parte de la huella
+VOLATILE_FIELDS = {'externalRequestId', 'clientUsername', 'password'}
+
+# Cabeceras que no se guardan: el cuerpo se graba ya descomprimido
+DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+
+class CassetteMiss(Exception):
+    """No hay grabación para la solicitud y el modo no permite salir a la red."""
+
+    def __init__(self, kind, key):
+        super().__init__(f"No hay grabación para la solicitud {kind}/{key}")
+        self.kind = kind
+        self.key = key
+
+
+def fingerprint(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def http_fingerprint(method, url, body):
+    """Huella de una solicitud HTTP a Tapila sin los campos volátiles del cuerpo."""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = body
+    if isinstance(data, dict):
+        data = {key: value for key, value in data.items() if key not in VOLATILE_FIELDS}
+    return fingerprint({'method': method.upper(), 'url': str(url), 'body': data})
+
+
+class Cassette:
+    def __init__(self, directory, mode, simulate_latency=False):
+        if mode not in MODES:
+            raise ValueError(f"CASSETTE_MODE inválido: {mode} (use {', '.join(MODES)})")
+        self.directory = directory
+        self.mode = mode
+        self.simulate_latency = simulate_latency
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    @property
+    def offline(self):
+        return self.mode == 'replay'
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, f"{key}.json")
+
+    def load(self, kind, key):
+        """Devuelve la grabación o None; en modo replay la falta es un error."""
+        if self.mode != 'record':
+            try:
+                with open(self._path(kind, key), 'r') as f:
+                    entry = json.load(f)
+                with self._lock:
+                    self.hits += 1
+                return entry
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.misses += 1
+        if self.offline:
+            raise CassetteMiss(kind, key)
+        return None
+
+    def save(self, kind, key, request, response, latency):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            'kind': kind,
+            'request': request,
+            'response': response,
+            'latency': round(latency, 4),
+            'recordedAt': time.time()
+        }
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(entry, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+        with self._lock:
+            self.recorded += 1
+
+    def delay(self, entry):
+        return entry.get('latency', 0) if self.simulate_latency else 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'directory': self.directory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'recorded': self.recorded
+            }
+
+
+# --- Anthropic -------------------------------------------------------------
+
+def _anthropic_request_summary(request):
+    """Resumen legible de la solicitud sin los datos de la imagen."""
+    messages = []
+    for message in request.get('messages', []):
+        content = []
+        for block in message.get('content', []):
+            if block.get('type') == 'text':
+                content.append({'type': 'text', 'text': block.get('text', '')})
+            else:
+                source = block.get('source', {})
+                content.append({
+                    'type': block.get('type'),
+                    'media_type': source.get('media_type'),
+                    'sha256': hashlib.sha256(str(source.get('data', '')).encode('utf-8')).hexdigest()
+                })
+        messages.append({'role': message.get('role'), 'content': content})
+    return {'model': request.get('model'), 'max_tokens': request.get('max_tokens'), 'messages': messages}
+
+
+def _message_to_dict(message):
+    usage = getattr(message, 'usage', None)
+    return {
+        'content': [
+            {'type': getattr(block, 'type', 'text'), 'text': getattr(block, 'text', '')}
+            for block in message.content
+        ],
+        'usage': {
+            name: getattr(usage, name, 0) or 0
+            for name in ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+        }
+    }
+
+
+def _message_from_dict(data):
+    return SimpleNamespace(
+        content=[SimpleNamespace(**block) for block in data['content']],
+        usage=SimpleNamespace(**data['usage'])
+    )
+
+
+class CassetteMessages:
+    def __init__(self, cassette, messages):
+        self.cassette = cassette
+        self._messages = messages
+
+    def create(self, timeout=None, **request):
+        key = fingerprint(request)
+        entry = self.cassette.load('anthropic', key)
+        if entry is not None:
+            time.sleep(self.cassette.delay(entry))
+            return _message_from_dict(entry['response'])
+
+        started = time.monotonic()
+        message = self._messages.create(timeout=timeout, **request)
+        self.cassette.save('anthropic', key, _anthropic_request_summary(request),
+                           _message_to_dict(message), time.monotonic() - started)
+        return message
+
+
+class AsyncCassetteMessages(CassetteMessages):
+    async def create(self, timeout=None, **request):
+        key = fingerprint(request)
+        entry = self.cassette.load('anthropic', key)
+        if entry is not None:
+            await asyncio.sleep(self.cassette.delay(entry))
+            return _message_from_dict(entry['response'])
+
+        started = time.monotonic()
+        message = await self._messages.create(timeout=timeout, **request)
+        self.cassette.save('anthropic', key, _anthropic_request_summary(request),
+                           _message_to_dict(message), time.monotonic() - started)
+        return message
+
+
+class CassetteClient:
+    """Cliente de Anthropic que graba o reproduce messages.create."""
+
+    def __init__(self, cassette, client, asynchronous=False):
+        self._client = client
+        messages = getattr(client, 'messages', None)
+        self.messages = (AsyncCassetteMessages if asynchronous else CassetteMessages)(cassette, messages)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+
+def wrap_anthropic_client(client, asynchronous=False):
+    """Envuelve el cliente si hay una grabación activa (en modo replay client puede ser None)."""
+    cassette = active_cassette()
+    if cassette is None:
+        return client
+    return CassetteClient(cassette, client, asynchronous)
+
+
+# --- Tapila ----------------------------------------------------------------
+
+def _http_request_summary(method, url, body):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = body
+    if isinstance(data, dict) and 'password' in data:
+        data = dict(data, password='***')
+    return {'method': method.upper(), 'url': str(url), 'body': data}
+
+
+def _kept_headers(headers):
+    return {name: value for name, value in headers.items() if name.lower() not in DROPPED_HEADERS}
+
+
+def mount_session(session):
+    """Instala en la sesión de requests un adaptador que graba o reproduce las llamadas."""
+    cassette = active_cassette()
+    if cassette is None:
+        return session
+
+    import requests
+    from requests.structures import CaseInsensitiveDict
+
+    class CassetteAdapter(requests.adapters.HTTPAdapter):
+        def send(self, request, **kwargs):
+            key = http_fingerprint(request.method, request.url, request.body)
+            entry = cassette.load('tapila', key)
+            if entry is not None:
+                time.sleep(cassette.delay(entry))
+                response = requests.models.Response()
+                response.status_code = entry['response']['status_code']
+                response.headers = CaseInsensitiveDict(entry['response']['headers'])
+                response._content = entry['response']['body'].encode('utf-8')
+                response.encoding = 'utf-8'
+                response.url = request.url
+                response.request = request
+                return response
+
+            started = time.monotonic()
+            response = super().send(request, **kwargs)
+            cassette.save('tapila', key, _http_request_summary(request.method, request.url, request.body), {
+                'status_code': response.status_code,
+                'headers': _kept_headers(response.headers),
+                'body': response.text
+            }, time.monotonic() - started)
+            return response
+
+    adapter = CassetteAdapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def async_transport():
+    """Transporte de httpx que graba o reproduce las llamadas (None sin grabación activa)."""
+    cassette = active_cassette()
+    if cassette is None:
+        return None
+
+    import httpx
+
+    class CassetteTransport(httpx.AsyncBaseTransport):
+        def __init__(self):
+            self._transport = httpx.AsyncHTTPTransport()
+
+        async def handle_async_request(self, request):
+            body = await request.aread()
+            key = http_fingerprint(request.method, request.url, body)
+            entry = cassette.load('tapila', key)
+            if entry is not None:
+                await asyncio.sleep(cassette.delay(entry))
+                return httpx.Response(
+                    entry['response']['status_code'],
+                    headers=entry['response']['headers'],
+                    content=entry['response']['body'].encode('utf-8'),
+                    request=request
+                )
+
+            started = time.monotonic()
+            response = await self._transport.handle_async_request(request)
+            await response.aread()
+            cassette.save('tapila', key, _http_request_summary(request.method, request.url, body), {
+                'status_code': response.status_code,
+                'headers': _kept_headers(response.headers),
+                'body': response.text
+            }, time.monotonic() - started)
+            return response
+
+        async def aclose(self):
+            await self._transport.aclose()
+
+    return CassetteTransport()
+
+
+# --- Configuración ---------------------------------------------------------
+
+_active = None
+_configured = False
+_config_lock = threading.Lock()
+
+
+def configure(mode=None, directory=None, simulate_latency=None):
+    """Activa (o desactiva, con mode vacío) la grabación; por defecto lee el entorno."""
+    global _active, _configured
+    mode = os.environ.get('CASSETTE_MODE', '') if mode is None else mode
+    directory = directory or os.environ.get('CASSETTE_DIR', 'cassettes')
+    if simulate_latency is None:
+        simulate_latency = os.environ.get('CASSETTE_SIMULATE_LATENCY', '0') == '1'
+    with _config_lock:
+        _active = Cassette(directory, mode, simulate_latency) if mode else None
+        _configured = True
+    return _active
+
+
+def active_cassette():
+    if not _configured:
+        configure()
+    return _active
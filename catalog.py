@@ -0,0 +1,148 @@
+"""
+Catálogo de compañías (companies.json) cargado una sola vez por proceso.
+
+Para cada servicio guarda las palabras normalizadas de su nombre y, una vez
+calculada, la plantilla de identificadores y prompt de extracción, de modo que
+las solicitudes no vuelven a leer ni a normalizar el archivo completo.
+
+Las actualizaciones (ver catalog_sync.py) construyen un catálogo nuevo que
+reutiliza las entradas sin cambios y lo reemplazan de una sola vez.
+"""
+
+import re
+import json
+import hashlib
+import threading
+
+# Formas jurídicas que se eliminan del nombre antes de comparar
+LEGAL_FORMS_PATTERN = re.compile(r'\b(s\.a\.|s\.a|sa|sociedad anonima|sociedad anónima)\b')
+SPECIAL_CHARS_PATTERN = re.compile(r'[^\w\s]')
+SPACES_PATTERN = re.compile(r'\s+')
+
+# List of common words to ignore
+COMMON_WORDS = {'y', 'de', 'la', 'el', 'los', 'las', 'del', 'para', 'por', 'con', 'en', 'a', 'o', 'u'}
+
+
+def normalize_company_name(name):
+    """Normalize company name for comparison."""
+    if not isinstance(name, str):
+        return []
+
+    # Convert to lowercase
+    name = name.lower()
+
+    # Split by slash and take each part
+    name_parts = [part.strip() for part in name.split('/')]
+
+    # Process each part
+    normalized_parts = []
+    for part in name_parts:
+        # Remove common suffixes and legal forms
+        part = LEGAL_FORMS_PATTERN.sub('', part)
+        # Remove special characters and extra spaces
+        part = SPECIAL_CHARS_PATTERN.sub('', part)
+        part = SPACES_PATTERN.sub(' ', part)
+        if part.strip():
+            # Split into words and filter out common words
+            words = part.strip().split()
+            # Add only non-common words
+            normalized_parts.extend([word for word in words if word not in COMMON_WORDS])
+
+    return normalized_parts
+
+
+def service_digest(service):
+    """Huella del contenido de un servicio, para detectar cambios."""
+    return hashlib.sha1(json.dumps(service, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class CatalogEntry:
+    def __init__(self, service):
+        self.service = service
+        self.company_code = service.get('companyCode', '')
+        self.company_name = service.get('companyName', '')
+        self.digest = service_digest(service)
+        self.words = normalize_company_name(self.company_name)
+        # (identificadores a buscar, prompt de extracción), calculado a demanda o en el warm-up
+        self.plan = None
+
+
+class Catalog:
+    def __init__(self, services):
+        self.entries = [
+            CatalogEntry(service) for service in services
+            if isinstance(service, dict) and service.get('companyName')
+        ]
+        self.by_code = {entry.company_code: entry for entry in self.entries}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            companies_data = json.load(f)
+        return cls(companies_data.get('services', []))
+
+    @classmethod
+    def from_entries(cls, entries):
+        catalog = cls([])
+        catalog.entries = entries
+        catalog.by_code = {entry.company_code: entry for entry in entries}
+        return catalog
+
+    def entry_for(self, company_code):
+        return self.by_code.get(company_code)
+
+    def updated(self, services, removed_codes=(), delta=False):
+        """
+        Catálogo nuevo con los servicios recibidos y el detalle de cambios.
+
+        Con delta=True, services solo trae los servicios modificados o nuevos y
+        removed_codes los eliminados; si no, services es el catálogo completo.
+        Las entradas sin cambios se reutilizan con sus palabras y plantillas.
+        """
+        services = [service for service in services if isinstance(service, dict) and service.get('companyName')]
+        if delta:
+            incoming = {service.get('companyCode', ''): service for service in services}
+            removed = set(removed_codes or ())
+            merged = [
+                incoming.pop(entry.company_code, entry.service)
+                for entry in self.entries if entry.company_code not in removed
+            ]
+            services = merged + list(incoming.values())
+
+        changes = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+        entries = []
+        for service in services:
+            company_code = service.get('companyCode', '')
+            current = self.by_code.get(company_code)
+            if current is not None and (current.service is service or current.digest == service_digest(service)):
+                entries.append(current)
+                changes['unchanged'] += 1
+                continue
+            entries.append(CatalogEntry(service))
+            changes['changed' if current is not None else 'added'].append(company_code)
+
+        codes = {entry.company_code for entry in entries}
+        changes['removed'] = [code for code in self.by_code if code not in codes]
+        return Catalog.from_entries(entries), changes
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(path):
+    """Devuelve el catálogo del archivo indicado, cargándolo la primera vez."""
+    catalog = _catalogs.get(path)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(path)
+            if catalog is None:
+                catalog = Catalog.load(path)
+                _catalogs[path] = catalog
+    return catalog
+
+
+def set_catalog(path, catalog):
+    """Reemplaza el catálogo de una sola vez; las solicitudes en curso conservan el anterior."""
+    with _catalogs_lock:
+        _catalogs[path] = catalog
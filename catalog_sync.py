@@ -0,0 +1,222 @@
+"""
+Sincronización incremental del catálogo de compañías.
+
+Consulta periódicamente el catálogo del proveedor (CATALOG_SYNC_URL) con
+solicitudes condicionales (ETag / Last-Modified) o, para pruebas, un archivo
+local (CATALOG_SYNC_FILE). Si hubo cambios, arma un catálogo nuevo que
+reutiliza las entradas sin cambios, precalcula las plantillas de las
+compañías nuevas o modificadas y recién entonces lo reemplaza de una sola
+vez: las solicitudes en curso nunca ven un catálogo a medio actualizar.
+
+El proveedor puede responder el catálogo completo ({"services": [...]}) o solo
+las diferencias ({"delta": true, "services": [...], "removed": [...]}).
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+from catalog import get_catalog, set_catalog
+from outbound import outbound_policy
+
+# Load environment variables
+load_dotenv()
+
+
+class HttpCatalogSource:
+    """Catálogo del proveedor, pedido con If-None-Match / If-Modified-Since."""
+
+    def __init__(self, url, api_key=None):
+        self.url = url
+        self.api_key = api_key
+        self.last_modified = None
+
+    def fetch(self, etag=None):
+        """Devuelve (documento, etag) o None si el catálogo no cambió."""
+        from pdf_analyzer import InvoiceAnalyzer
+
+        headers = {'Accept': 'application/json'}
+        if self.api_key:
+            headers['x-api-key'] = self.api_key
+        if etag:
+            headers['If-None-Match'] = etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        def get_catalog_document(timeout):
+            response = InvoiceAnalyzer.http_session().get(self.url, headers=headers, timeout=timeout)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            return response
+
+        response = outbound_policy.call('tapila_catalog', get_catalog_document)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        self.last_modified = response.headers.get('Last-Modified')
+        return response.json(), response.headers.get('ETag')
+
+
+class FileCatalogSource:
+    """Fuente local para pruebas: el ETag es el hash del contenido del archivo."""
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+
+    def fetch(self, etag=None):
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if etag and signature == self._stat:
+            return None
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self._stat = signature
+        new_etag = hashlib.sha256(data).hexdigest()[:32]
+        if new_etag == etag:
+            return None
+        return json.loads(data), new_etag
+
+
+class CatalogSync:
+    def __init__(self, source, path, interval=300, persist=False):
+        self.source = source
+        self.path = path
+        self.interval = interval
+        # Guardar el catálogo sincronizado en companies.json para los próximos arranques
+        self.persist = persist
+        self.etag = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            'source': type(source).__name__,
+            'syncs': 0,
+            'notModified': 0,
+            'errors': 0,
+            'lastSyncAt': None,
+            'lastChangeAt': None,
+            'lastChanges': None,
+            'lastError': None,
+            'companies': None
+        }
+
+    def sync_once(self):
+        """Consulta la fuente y aplica los cambios; devuelve el detalle o None si no hubo."""
+        with self._lock:
+            started = time.monotonic()
+            fetched = self.source.fetch(self.etag)
+            self._stats['syncs'] += 1
+            self._stats['lastSyncAt'] = time.time()
+            if fetched is None:
+                self._stats['notModified'] += 1
+                return None
+
+            document, etag = fetched
+            current = get_catalog(self.path)
+            catalog, changes = current.updated(
+                document.get('services', []),
+                removed_codes=document.get('removed', []),
+                delta=bool(document.get('delta'))
+            )
+            self._prepare(catalog, changes['added'] + changes['changed'])
+
+            if changes['added'] or changes['changed'] or changes['removed']:
+                set_catalog(self.path, catalog)
+                if self.persist:
+                    self._write(catalog)
+                self._stats['lastChangeAt'] = time.time()
+                print(f"Catálogo actualizado: {len(changes['added'])} nuevas, "
+                      f"{len(changes['changed'])} modificadas, {len(changes['removed'])} eliminadas")
+
+            self.etag = etag
+            changes['durationSeconds'] = round(time.monotonic() - started, 3)
+            self._stats['lastChanges'] = changes
+            self._stats['companies'] = len(catalog.entries)
+            return changes
+
+    def _prepare(self, catalog, company_codes):
+        """Precalcula las plantillas de las entradas nuevas antes de publicarlas."""
+        if not company_codes:
+            return
+        from pdf_analyzer import InvoiceAnalyzer
+
+        analyzer = InvoiceAnalyzer()
+        # quiet en lugar de redirigir stdout: corre en un hilo junto a las solicitudes
+        for company_code in company_codes:
+            entry = catalog.entry_for(company_code)
+            active_modalities = analyzer.get_active_modalities(entry.service, quiet=True)
+            if active_modalities:
+                entry.plan = analyzer.build_plan(active_modalities, quiet=True)
+
+    def _write(self, catalog):
+        try:
+            with open(self.path, 'r') as f:
+                companies_data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            companies_data = {}
+        companies_data['services'] = [entry.service for entry in catalog.entries]
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(companies_data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+    def _run(self):
+        while True:
+            try:
+                self.sync_once()
+                self._stats['lastError'] = None
+            except Exception as e:
+                self._stats['errors'] += 1
+                self._stats['lastError'] = str(e)
+                print(f"Error al sincronizar el catálogo: {str(e)}")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='catalog-sync', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return dict(self._stats, etag=self.etag, interval=self.interval)
+
+
+_sync = None
+_sync_lock = threading.Lock()
+
+
+def start_catalog_sync():
+    """Inicia la sincronización en segundo plano si está configurada (una vez por proceso)."""
+    global _sync
+    with _sync_lock:
+        if _sync is not None:
+            return _sync
+        url = os.environ.get('CATALOG_SYNC_URL')
+        local_file = os.environ.get('CATALOG_SYNC_FILE')
+        if url:
+            source = HttpCatalogSource(url, os.environ.get('TAPILA_API_KEY'))
+        elif local_file:
+            source = FileCatalogSource(local_file)
+        else:
+            return None
+
+        from pdf_analyzer import InvoiceAnalyzer
+        _sync = CatalogSync(
+            source,
+            InvoiceAnalyzer().companies_file,
+            interval=float(os.environ.get('CATALOG_SYNC_INTERVAL', 300)),
+            persist=os.environ.get('CATALOG_SYNC_PERSIST', '0') == '1'
+        )
+        _sync.start()
+        return _sync
+
+
+def catalog_sync_stats():
+    return _sync.stats() if _sync is not None else None
@@ -0,0 +1,108 @@
+"""
+Plazo de punta a punta de un análisis.
+
+Cada solicitud a /analyze lleva un plazo: el de la cabecera X-Request-Timeout
+(segundos, hasta ANALYZE_MAX_DEADLINE) o el del servidor (ANALYZE_DEADLINE, o
+WITH_DEBT_DEADLINE con withDebt=1). deadline_scope lo publica en una
+ContextVar y cada etapa recibe solo el tiempo que queda: la espera por el
+limitador de Anthropic y por el pool de preparación, los timeouts de cada
+intento hacia Anthropic y Tapila (ver outbound.py) y las consultas de deuda.
+
+Cuando el plazo se agota después de identificar la compañía, el análisis
+devuelve un resultado parcial (compañía y modalidades, sin identificadores)
+marcado con "partial"; si se agota antes, se lanza DeadlineExceeded.
+"""
+
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+DEFAULT_DEADLINE = float(os.environ.get('ANALYZE_DEADLINE', 60))
+MAX_DEADLINE = float(os.environ.get('ANALYZE_MAX_DEADLINE', 120))
+# Tiempo mínimo para que valga la pena iniciar una llamada a Claude
+MIN_CALL_BUDGET = float(os.environ.get('ANALYZE_MIN_CALL_BUDGET', 3))
+
+_current = contextvars.ContextVar('analysis_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Se agotó el plazo de la solicitud; stage indica la etapa que no pudo completarse."""
+
+    def __init__(self, stage=None):
+        super().__init__(f"Se agotó el plazo del análisis ({stage})" if stage else "Se agotó el plazo del análisis")
+        self.stage = stage
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def require(self, seconds, stage=None):
+        """Lanza DeadlineExceeded si quedan menos de `seconds` segundos."""
+        if self.remaining() < max(seconds, 1e-3):
+            raise DeadlineExceeded(stage)
+
+    def bound(self, timeout):
+        """Recorta un timeout (conexión, lectura) al tiempo que queda."""
+        remaining = self.remaining()
+        return (min(timeout[0], remaining), min(timeout[1], remaining))
+
+
+def current_deadline():
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """Publica el plazo para las etapas del análisis (None: sin plazo)."""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def bounded_wait(seconds):
+    """Espera máxima recortada al plazo de la solicitud en curso, si lo hay."""
+    deadline = _current.get()
+    return seconds if deadline is None else min(seconds, deadline.remaining())
+
+
+def require_budget(seconds, stage=None):
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.require(seconds, stage)
+
+
+def deadline_expired():
+    deadline = _current.get()
+    return deadline is not None and deadline.expired
+
+
+def request_deadline(headers, default=DEFAULT_DEADLINE):
+    """Plazo de una solicitud: X-Request-Timeout si es válido (acotado a ANALYZE_MAX_DEADLINE) o default."""
+    seconds = default
+    value = headers.get(DEADLINE_HEADER)
+    if value:
+        try:
+            requested = float(value)
+        except ValueError:
+            requested = None
+        if requested is not None and requested > 0:
+            seconds = requested
+    return Deadline(min(seconds, MAX_DEADLINE))
@@ -0,0 +1,280 @@
+"""
+Actualización programada de las deudas de las cuentas ya analizadas.
+
+El saldo de una factura cambia cuando el cliente paga, y hasta ahora solo se
+veía consultando /query-debt a mano. Este proceso (`pdf_analyzer.py
+refresh-debts`, el `clock` de Procfile.local) registra cada cuenta del historial
+(compañía, modalidad e identificadores) y vuelve a consultar su deuda cada
+DEBT_REFRESH_INTERVAL segundos mientras la última factura de la cuenta vence
+dentro de los próximos DEBT_REFRESH_HORIZON_DAYS días (o venció hace menos de
+DEBT_REFRESH_GRACE_DAYS).
+
+Las consultas pendientes se agrupan por companyCode y se intercalan entre
+compañías, repartidas en el tiempo con un límite global y otro por compañía
+para respetar los límites de Tapila; usan el token y la sesión HTTP
+compartidos de InvoiceAnalyzer. Los resultados se guardan en invoice_store
+(debt_checks) y los clientes leen el saldo en /invoices/<id>/debts sin
+generar consultas a Tapila.
+
+Como la cola de análisis, es de un solo host: lee y escribe el mismo historial
+SQLite (INVOICE_DB_PATH) que el servidor web, en un disco local. Un dyno de
+Heroku aparte tendría su propio invoices.db vacío y /invoices/<id>/debts nunca
+mostraría sus resultados; por eso no está en el Procfile.
+"""
+
+import os
+import json
+import time
+import random
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, timedelta
+from dotenv import load_dotenv
+
+from rate_limiter import TokenBucket
+
+# Load environment variables
+load_dotenv()
+
+# Solapamiento al buscar facturas nuevas: una factura guardada durante la búsqueda no se pierde
+TRACK_OVERLAP = 60.0
+
+# Espera máxima tras un fallo, antes de volver al intervalo normal
+MAX_FAILURE_BACKOFF = 3600.0
+
+
+def account_key(company_code, modality_id, query_data):
+    """Misma clave que la caché de deudas de InvoiceAnalyzer.consult_debt."""
+    return json.dumps([company_code, modality_id, query_data], sort_keys=True)
+
+
+def invoice_accounts(result):
+    """Cuentas de un resultado de análisis: [(account_key, modalityId, queryData)]."""
+    from pdf_analyzer import InvoiceAnalyzer
+
+    company_code = result.get('companyCode', '')
+    return [
+        (account_key(company_code, modality_id, query_data), modality_id, query_data)
+        for modality_id, query_data in InvoiceAnalyzer.debt_lookups(result)
+    ]
+
+
+def stored_debts(store, invoice_id):
+    """Última deuda guardada de cada modalidad de la factura, o None si la factura no existe."""
+    invoice = store.get(invoice_id)
+    if invoice is None:
+        return None
+    accounts = invoice_accounts(invoice['data'])
+    checks = store.debt_checks([key for key, _, _ in accounts])
+    debts = []
+    for key, modality_id, _ in accounts:
+        check = checks.get(key)
+        if check is None or check['checked_at'] is None:
+            debts.append({'modalityId': modality_id, 'status': 'pending', 'debt': None})
+            continue
+        debts.append({
+            'modalityId': modality_id,
+            # Con status "error" debt es la última deuda obtenida, si la hubo
+            'status': check['status'],
+            'debt': json.loads(check['debt_json']) if check['debt_json'] else None,
+            'checkedAt': check['checked_at'],
+            'changedAt': check['changed_at'],
+            'nextCheckAt': check['next_check_at']
+        })
+    return debts
+
+
+def debt_refresh_stats(store):
+    now = time.time()
+    due_from, due_to = DebtRefresher.from_env(store).window()
+    stats = store.debt_check_stats(now, now - 86400, due_from, due_to)
+    return {
+        'accounts': stats['accounts'],
+        # Cuentas dentro de la ventana de vencimiento con la consulta atrasada
+        'overdue': stats['overdue'],
+        'checkedLastDay': stats['checked'],
+        'changedLastDay': stats['changed'],
+        'failing': stats['failing'],
+        'lastCheckedAt': stats['last_checked_at'] or None
+    }
+
+
+def paced_bucket(rate_per_minute):
+    bucket = TokenBucket(rate_per_minute)
+    # Sin ráfaga inicial: las consultas se reparten desde el primer ciclo
+    bucket.tokens = min(1.0, bucket.capacity)
+    return bucket
+
+
+def interleave_by_company(checks):
+    """Ordena las consultas alternando compañías, respetando el orden dentro de cada una."""
+    groups = OrderedDict()
+    for check in checks:
+        groups.setdefault(check['company_code'], []).append(check)
+    ordered = []
+    queues = [list(reversed(group)) for group in groups.values()]
+    while queues:
+        for group in queues:
+            ordered.append(group.pop())
+        queues = [group for group in queues if group]
+    return ordered
+
+
+class DebtRefresher:
+    def __init__(self, store, interval=21600.0, horizon_days=10, grace_days=3, requests_per_minute=60,
+                 company_requests_per_minute=20, batch_size=200, concurrency=4, poll_interval=60.0):
+        self.store = store
+        self.interval = interval
+        self.horizon_days = horizon_days
+        self.grace_days = grace_days
+        self.requests_per_minute = requests_per_minute
+        self.company_requests_per_minute = company_requests_per_minute
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        # Mostrar el detalle de cada consulta a Tapila (--verbose)
+        self.verbose = False
+        self._bucket = paced_bucket(requests_per_minute)
+        self._company_buckets = {}
+        self._tracked_until = 0.0
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls, store):
+        return cls(
+            store,
+            interval=float(os.environ.get('DEBT_REFRESH_INTERVAL', 21600)),
+            horizon_days=int(os.environ.get('DEBT_REFRESH_HORIZON_DAYS', 10)),
+            grace_days=int(os.environ.get('DEBT_REFRESH_GRACE_DAYS', 3)),
+            requests_per_minute=float(os.environ.get('DEBT_REFRESH_RPM', 60)),
+            company_requests_per_minute=float(os.environ.get('DEBT_REFRESH_COMPANY_RPM', 20)),
+            batch_size=int(os.environ.get('DEBT_REFRESH_BATCH', 200)),
+            concurrency=int(os.environ.get('DEBT_REFRESH_CONCURRENCY', 4)),
+            poll_interval=float(os.environ.get('DEBT_REFRESH_POLL_INTERVAL', 60))
+        )
+
+    def window(self):
+        """Rango de fechas de vencimiento (ISO) de las facturas cuyas cuentas se consultan."""
+        today = date.today()
+        return (
+            (today - timedelta(days=self.grace_days)).isoformat(),
+            (today + timedelta(days=self.horizon_days)).isoformat()
+        )
+
+    def track_accounts(self):
+        """Registra las cuentas de las facturas guardadas desde la última vez; devuelve cuántas."""
+        due_from, _ = self.window()
+        rows = self.store.invoices_updated_since(max(0.0, self._tracked_until - TRACK_OVERLAP), due_from)
+        now = time.time()
+        accounts = []
+        for row in rows:
+            result = json.loads(row['result_json'])
+            for key, modality_id, query_data in invoice_accounts(result):
+                accounts.append((key, row['company_code'] or '', modality_id,
+                                 json.dumps(query_data, ensure_ascii=False), row['id'], now))
+            self._tracked_until = max(self._tracked_until, row['updated_at'])
+        self.store.track_debt_accounts(accounts)
+        return len(accounts)
+
+    def _next_check(self, failures):
+        if failures:
+            # Backoff exponencial tras fallos, sin superar el intervalo normal
+            return time.time() + min(self.interval, MAX_FAILURE_BACKOFF, 60.0 * 2 ** min(failures, 10))
+        # Variación del 10% para que las cuentas registradas juntas no venzan juntas
+        return time.time() + self.interval * random.uniform(0.9, 1.1)
+
+    def _company_bucket(self, company_code):
+        bucket = self._company_buckets.get(company_code)
+        if bucket is None:
+            bucket = self._company_buckets[company_code] = paced_bucket(self.company_requests_per_minute)
+        return bucket
+
+    def _pace(self, company_code):
+        """Espera a que el límite global y el de la compañía permitan una consulta; False si se detuvo."""
+        company_bucket = self._company_bucket(company_code)
+        while True:
+            now = time.monotonic()
+            delay = max(self._bucket.wait_time(1, now), company_bucket.wait_time(1, now))
+            if delay <= 0:
+                self._bucket.consume(1)
+                company_bucket.consume(1)
+                return True
+            if self._stop.wait(delay):
+                return False
+
+    def check(self, row):
+        """Consulta la deuda de una cuenta y guarda el resultado; devuelve True si el saldo cambió."""
+        from pdf_analyzer import InvoiceAnalyzer
+
+        query_data = json.loads(row['query_json'])
+        debt = None
+        error = None
+        try:
+            # El detalle de cada consulta (curl con las credenciales, cabeceras) solo se muestra con --verbose
+            debt = InvoiceAnalyzer().consult_debt(
+                row['company_code'], row['modality_id'], query_data, quiet=not self.verbose
+            )
+        except Exception as e:
+            error = str(e)
+        if debt is None or (isinstance(debt, dict) and debt.get('stale')):
+            # Sin respuesta nueva de Tapila: la deuda en caché no se guarda como actualizada
+            error = error or 'No se pudo consultar la deuda'
+            self.store.record_debt_check(row['account_key'], None, self._next_check(row['failures'] + 1), error)
+            raise RuntimeError(error)
+        return self.store.record_debt_check(row['account_key'], debt, self._next_check(0))
+
+    def run_once(self, executor):
+        """Un ciclo: registra cuentas nuevas y consulta las vencidas; devuelve el resumen del ciclo."""
+        summary = {'tracked': self.track_accounts(), 'checked': 0, 'changed': 0, 'failed': 0}
+        due_from, due_to = self.window()
+        checks = self.store.due_debt_checks(time.time(), due_from, due_to, self.batch_size)
+
+        failing = set()
+        futures = {}
+        for row in interleave_by_company(checks):
+            if row['company_code'] in failing:
+                continue
+            if not self._pace(row['company_code']):
+                break
+            futures[executor.submit(self.check, row)] = row['company_code']
+            # Una compañía con errores no consume el resto del ciclo: sus cuentas quedan para el próximo
+            for future in [future for future in futures if future.done()]:
+                if future.exception() is not None:
+                    failing.add(futures[future])
+        wait(futures)
+
+        for future in futures:
+            summary['checked'] += 1
+            if future.exception() is not None:
+                summary['failed'] += 1
+            elif future.result():
+                summary['changed'] += 1
+        return summary
+
+    def stop(self, *_):
+        if not self._stop.is_set():
+            print("Deteniendo la actualización de deudas: se terminan las consultas en curso")
+            self._stop.set()
+
+    def run(self, verbose=False):
+        self.verbose = verbose
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"Actualizando deudas cada {self.interval:.0f}s de las facturas que vencen en "
+              f"{self.horizon_days} días ({self.requests_per_minute:g} consultas/min)")
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='debt-refresh') as executor:
+            while not self._stop.is_set():
+                checked = 0
+                try:
+                    summary = self.run_once(executor)
+                    checked = summary['checked']
+                    if checked:
+                        print(f"Deudas actualizadas: {checked} consultas, {summary['changed']} con cambios, "
+                              f"{summary['failed']} con error")
+                except Exception as e:
+                    print(f"Error al actualizar las deudas: {str(e)}")
+                # Con un ciclo completo quedan más cuentas vencidas: se sigue sin esperar
+                if checked < self.batch_size and self._stop.wait(self.poll_interval):
+                    break
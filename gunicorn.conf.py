@@ -0,0 +1,30 @@
+"""
+Configuración de gunicorn.
+
+La aplicación se carga en el proceso maestro y se precalienta antes del fork,
+de modo que cada worker arranca con el catálogo, los clientes y las plantillas
+de prompts ya construidos.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+
+def when_ready(server):
+    # Con preload_app el módulo ya está importado en el maestro: precalentar antes del fork
+    from warmup import warm_up
+    warm_up()
+
+
+def post_worker_init(worker):
+    # Sin preload_app (o si falló en el maestro), cada worker se precalienta al iniciar
+    from warmup import warm_up
+    warm_up()
+
+    # Los hilos no sobreviven al fork: la sincronización del catálogo se inicia en cada worker
+    from catalog_sync import start_catalog_sync
+    start_catalog_sync()
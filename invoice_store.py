@@ -0,0 +1,415 @@
+"""
+Historial de facturas analizadas en SQLite.
+
+Cada resultado de /analyze se guarda junto con sus identificadores, con
+índices por compañía, cliente, identificador y fecha de vencimiento, para que
+soporte pueda buscar una cuenta o las facturas que vencen en un rango de
+fechas en milisegundos, sin volver a subir la factura ni llamar a Claude.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+
+# Límite de resultados por consulta
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# Formatos de fecha que Claude suele devolver para la fecha de vencimiento
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d/%m/%y', '%d.%m.%Y')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content_hash TEXT UNIQUE,
+    company_code TEXT,
+    company_name TEXT,
+    category TEXT,
+    nombre_cliente TEXT,
+    nombre_cliente_norm TEXT,
+    fecha_vencimiento TEXT,
+    valor_factura TEXT,
+    result_json TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_company_due ON invoices(company_code, fecha_vencimiento);
+CREATE INDEX IF NOT EXISTS idx_invoices_cliente ON invoices(nombre_cliente_norm);
+CREATE INDEX IF NOT EXISTS idx_invoices_due ON invoices(fecha_vencimiento);
+
+CREATE TABLE IF NOT EXISTS invoice_identifiers (
+    invoice_id INTEGER NOT NULL REFERENCES invoices(id) ON DELETE CASCADE,
+    modality_id TEXT,
+    identifier_name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_identifiers_value ON invoice_identifiers(value, identifier_name);
+CREATE INDEX IF NOT EXISTS idx_identifiers_invoice ON invoice_identifiers(invoice_id);
+
+CREATE TABLE IF NOT EXISTS invoice_perceptual_hashes (
+    invoice_id INTEGER PRIMARY KEY REFERENCES invoices(id) ON DELETE CASCADE,
+    perceptual_hash TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS debt_checks (
+    account_key TEXT PRIMARY KEY,
+    company_code TEXT NOT NULL,
+    modality_id TEXT NOT NULL,
+    query_json TEXT NOT NULL,
+    invoice_id INTEGER REFERENCES invoices(id) ON DELETE CASCADE,
+    status TEXT,
+    debt_json TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    checked_at REAL,
+    changed_at REAL,
+    next_check_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_debt_checks_next ON debt_checks(next_check_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_updated ON invoices(updated_at);
+"""
+
+# Campos de la respuesta de deuda que cambian en cada consulta y no indican un cambio de saldo
+VOLATILE_DEBT_FIELDS = {'externalRequestId', 'requestId', 'timestamp'}
+
+
+def normalize_date(value):
+    """Convierte la fecha de vencimiento a ISO (YYYY-MM-DD) o devuelve None."""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_identifier(value):
+    """Misma limpieza que InvoiceAnalyzer.clean_identifier (sin espacios, puntos ni guiones)."""
+    return value.replace(" ", "").replace(".", "").replace("-", "")
+
+
+def normalize_name(value):
+    if not isinstance(value, str):
+        return ''
+    return ' '.join(value.lower().split())
+
+
+def _stable_debt(value):
+    if isinstance(value, dict):
+        return {key: _stable_debt(item) for key, item in value.items() if key not in VOLATILE_DEBT_FIELDS}
+    if isinstance(value, list):
+        return [_stable_debt(item) for item in value]
+    return value
+
+
+class InvoiceStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    def save(self, result, content_hash=None, perceptual_hash=None):
+        """Guarda (o actualiza, si el contenido ya se analizó) un resultado de análisis."""
+        now = time.time()
+        nombre_cliente = result.get('nombre_cliente', '')
+        row = (
+            content_hash,
+            result.get('companyCode', ''),
+            result.get('companyName', ''),
+            result.get('category', ''),
+            nombre_cliente,
+            normalize_name(nombre_cliente),
+            normalize_date(result.get('fecha_vencimiento')),
+            str(result.get('valor_factura', '')),
+            json.dumps(result, ensure_ascii=False),
+            now,
+            now
+        )
+        conn = self._connection()
+        with conn:
+            invoice_id = None
+            if content_hash:
+                existing = conn.execute(
+                    'SELECT id FROM invoices WHERE content_hash = ?', (content_hash,)
+                ).fetchone()
+                if existing:
+                    invoice_id = existing['id']
+                    conn.execute(
+                        'UPDATE invoices SET company_code = ?, company_name = ?, category = ?, '
+                        'nombre_cliente = ?, nombre_cliente_norm = ?, fecha_vencimiento = ?, '
+                        'valor_factura = ?, result_json = ?, updated_at = ? WHERE id = ?',
+                        row[1:9] + (now, invoice_id)
+                    )
+                    conn.execute('DELETE FROM invoice_identifiers WHERE invoice_id = ?', (invoice_id,))
+            if invoice_id is None:
+                invoice_id = conn.execute(
+                    'INSERT INTO invoices (content_hash, company_code, company_name, category, '
+                    'nombre_cliente, nombre_cliente_norm, fecha_vencimiento, valor_factura, '
+                    'result_json, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    row
+                ).lastrowid
+
+            identifiers = [
+                (invoice_id, modality.get('modalityId', ''), name, value)
+                for modality in result.get('modalities', [])
+                for name, value in (modality.get('identifiersEncontrados') or {}).items()
+                if value
+            ]
+            conn.executemany(
+                'INSERT INTO invoice_identifiers (invoice_id, modality_id, identifier_name, value) '
+                'VALUES (?, ?, ?, ?)',
+                identifiers
+            )
+            if perceptual_hash is not None:
+                conn.execute(
+                    'INSERT OR REPLACE INTO invoice_perceptual_hashes (invoice_id, perceptual_hash) VALUES (?, ?)',
+                    (invoice_id, format(perceptual_hash, 'x'))
+                )
+        return invoice_id
+
+    def perceptual_hashes(self, after_id=0):
+        """Hashes perceptuales (hexadecimal) de las facturas con id mayor a after_id."""
+        return self._connection().execute(
+            'SELECT p.invoice_id, p.perceptual_hash, i.company_code, i.category, i.created_at '
+            'FROM invoice_perceptual_hashes p JOIN invoices i ON i.id = p.invoice_id '
+            'WHERE p.invoice_id > ? ORDER BY p.invoice_id',
+            (after_id,)
+        ).fetchall()
+
+    def invoices_updated_since(self, since, due_from):
+        """Facturas guardadas o actualizadas después de `since` que vencen desde due_from."""
+        return self._connection().execute(
+            'SELECT id, company_code, result_json, updated_at FROM invoices '
+            'WHERE updated_at > ? AND fecha_vencimiento >= ? ORDER BY updated_at',
+            (since, due_from)
+        ).fetchall()
+
+    def track_debt_accounts(self, accounts):
+        """
+        Registra las cuentas cuya deuda se actualiza periódicamente.
+
+        accounts: [(account_key, company_code, modality_id, query_json, invoice_id, next_check_at)].
+        Una cuenta ya registrada conserva su próxima consulta y pasa a la factura más reciente.
+        """
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT INTO debt_checks (account_key, company_code, modality_id, query_json, invoice_id, '
+                'next_check_at) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(account_key) DO UPDATE SET invoice_id = MAX(invoice_id, excluded.invoice_id)',
+                accounts
+            )
+
+    def due_debt_checks(self, now, due_from, due_to, limit):
+        """Cuentas con la consulta vencida cuya última factura vence entre due_from y due_to."""
+        return self._connection().execute(
+            'SELECT d.account_key, d.company_code, d.modality_id, d.query_json, d.invoice_id, d.failures, '
+            'i.fecha_vencimiento FROM debt_checks d JOIN invoices i ON i.id = d.invoice_id '
+            'WHERE d.next_check_at <= ? AND i.fecha_vencimiento BETWEEN ? AND ? '
+            'ORDER BY d.next_check_at LIMIT ?',
+            (now, due_from, due_to, limit)
+        ).fetchall()
+
+    def record_debt_check(self, account_key, debt, next_check_at, error=None):
+        """
+        Guarda el resultado de una consulta de deuda; devuelve True si el saldo cambió.
+
+        Con error se conserva la última deuda obtenida y se cuenta el fallo.
+        """
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            if error is not None:
+                conn.execute(
+                    'UPDATE debt_checks SET status = ?, failures = failures + 1, checked_at = ?, '
+                    'next_check_at = ? WHERE account_key = ?',
+                    ('error', now, next_check_at, account_key)
+                )
+                return False
+
+            row = conn.execute(
+                'SELECT debt_json FROM debt_checks WHERE account_key = ?', (account_key,)
+            ).fetchone()
+            previous = json.loads(row['debt_json']) if row and row['debt_json'] else None
+            changed = previous is None or _stable_debt(previous) != _stable_debt(debt)
+            conn.execute(
+                'UPDATE debt_checks SET status = ?, debt_json = ?, failures = 0, checked_at = ?, '
+                'changed_at = CASE WHEN ? THEN ? ELSE changed_at END, next_check_at = ? WHERE account_key = ?',
+                ('ok', json.dumps(debt, ensure_ascii=False), now, changed, now, next_check_at, account_key)
+            )
+            return changed
+
+    def debt_checks(self, account_keys):
+        """Última deuda guardada de cada cuenta, por account_key."""
+        if not account_keys:
+            return {}
+        placeholders = ','.join('?' * len(account_keys))
+        rows = self._connection().execute(
+            f'SELECT * FROM debt_checks WHERE account_key IN ({placeholders})', list(account_keys)
+        ).fetchall()
+        return {row['account_key']: row for row in rows}
+
+    def debt_check_stats(self, now, since, due_from, due_to):
+        row = self._connection().execute(
+            'SELECT COUNT(*) AS accounts, '
+            'SUM(d.next_check_at <= ? AND i.fecha_vencimiento BETWEEN ? AND ?) AS overdue, '
+            'SUM(d.checked_at > ?) AS checked, '
+            'SUM(d.changed_at > ?) AS changed, '
+            'SUM(d.failures > 0) AS failing, '
+            'MAX(d.checked_at) AS last_checked_at '
+            'FROM debt_checks d LEFT JOIN invoices i ON i.id = d.invoice_id',
+            (now, due_from, due_to, since, since)
+        ).fetchone()
+        return {key: row[key] or 0 for key in row.keys()}
+
+    def get(self, invoice_id):
+        """Devuelve el registro completo de una factura, con el resultado original."""
+        row = self._connection().execute(
+            'SELECT * FROM invoices WHERE id = ?', (invoice_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = self._summary(row)
+        record['data'] = json.loads(row['result_json'])
+        return record
+
+    def search(self, company_code=None, nombre_cliente=None, identifier=None,
+               identifier_name=None, due_from=None, due_to=None, limit=DEFAULT_LIMIT):
+        """Busca facturas por compañía, cliente (prefijo), identificador y rango de vencimiento."""
+        clauses = []
+        params = []
+        if company_code:
+            clauses.append('i.company_code = ?')
+            params.append(company_code)
+        if nombre_cliente:
+            # Búsqueda por prefijo expresada como rango para que use el índice
+            prefix = normalize_name(nombre_cliente)
+            clauses.append('i.nombre_cliente_norm >= ? AND i.nombre_cliente_norm < ?')
+            params.extend([prefix, prefix + '\uffff'])
+        if identifier:
+            # Se acepta el identificador tal como figura impreso en la factura
+            sub = 'SELECT invoice_id FROM invoice_identifiers WHERE value IN (?, ?)'
+            params.extend([identifier, normalize_identifier(identifier)])
+            if identifier_name:
+                sub += ' AND identifier_name = ?'
+                params.append(identifier_name)
+            clauses.append(f'i.id IN ({sub})')
+        if due_from:
+            clauses.append('i.fecha_vencimiento >= ?')
+            params.append(due_from)
+        if due_to:
+            clauses.append('i.fecha_vencimiento <= ?')
+            params.append(due_to)
+
+        query = 'SELECT i.* FROM invoices i'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        order = 'i.fecha_vencimiento' if (due_from or due_to) else 'i.updated_at DESC'
+        query += f' ORDER BY {order} LIMIT ?'
+        params.append(max(1, min(limit, MAX_LIMIT)))
+
+        conn = self._connection()
+        rows = conn.execute(query, params).fetchall()
+        records = [self._summary(row) for row in rows]
+        self._attach_identifiers(conn, records)
+        return records
+
+    def _summary(self, row):
+        return {
+            'id': row['id'],
+            'companyCode': row['company_code'],
+            'companyName': row['company_name'],
+            'category': row['category'],
+            'nombre_cliente': row['nombre_cliente'],
+            'fecha_vencimiento': row['fecha_vencimiento'],
+            'valor_factura': row['valor_factura'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at']
+        }
+
+    def _attach_identifiers(self, conn, records):
+        if not records:
+            return
+        by_id = {record['id']: record for record in records}
+        for record in records:
+            record['identifiers'] = {}
+        placeholders = ','.join('?' * len(by_id))
+        rows = conn.execute(
+            f'SELECT invoice_id, identifier_name, value FROM invoice_identifiers '
+            f'WHERE invoice_id IN ({placeholders})',
+            list(by_id)
+        ).fetchall()
+        for row in rows:
+            by_id[row['invoice_id']]['identifiers'][row['identifier_name']] = row['value']
+
+
+def search_from_params(store, params):
+    """
+    Traduce los parámetros de consulta HTTP a una búsqueda.
+
+    Parámetros: companyCode, nombreCliente, identifier, identifierName,
+    dueFrom, dueTo (YYYY-MM-DD), dueWithinDays y limit. Lanza ValueError si
+    alguno no es válido.
+    """
+    due_from = params.get('dueFrom')
+    due_to = params.get('dueTo')
+    for name, value in (('dueFrom', due_from), ('dueTo', due_to)):
+        if value and normalize_date(value) != value:
+            raise ValueError(f"El parámetro '{name}' debe tener formato YYYY-MM-DD")
+
+    due_within = params.get('dueWithinDays')
+    if due_within:
+        try:
+            days = int(due_within)
+        except ValueError:
+            raise ValueError("El parámetro 'dueWithinDays' debe ser un número entero")
+        today = date.today()
+        due_from = due_from or today.isoformat()
+        due_to = due_to or (today + timedelta(days=days)).isoformat()
+
+    try:
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("El parámetro 'limit' debe ser un número entero")
+
+    return store.search(
+        company_code=params.get('companyCode'),
+        nombre_cliente=params.get('nombreCliente'),
+        identifier=params.get('identifier'),
+        identifier_name=params.get('identifierName'),
+        due_from=due_from,
+        due_to=due_to,
+        limit=limit
+    )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_invoice_store():
+    """Store compartido del proceso; la ruta se configura con INVOICE_DB_PATH."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoices.db')
+                _store = InvoiceStore(os.environ.get('INVOICE_DB_PATH', default_path))
+    return _store
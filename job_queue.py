@@ -0,0 +1,425 @@
+"""
+Cola durable de análisis en SQLite (modo WAL).
+
+Con `/analyze?async=1` el servidor web solo guarda la factura en la cola y
+responde 202 con el id del trabajo; los workers (`python3 pdf_analyzer.py
+worker`, tantos procesos como se quiera) toman trabajos con un lease: mientras
+lo renuevan el trabajo es suyo, y si el worker muere el lease vence
+(JOB_VISIBILITY_TIMEOUT) y otro worker lo retoma. Los errores transitorios se
+reintentan con backoff hasta JOB_MAX_ATTEMPTS intentos; cuando Anthropic está
+saturado el trabajo vuelve a la cola sin consumir un intento.
+
+La cola sobrevive a los reinicios, pero es de un solo host: el servidor web y
+todos los workers deben abrir el mismo archivo (JOB_QUEUE_PATH) en un disco
+local. Los bloqueos de SQLite no son confiables sobre sistemas de archivos de
+red, así que para workers en varios hosts hace falta un broker de mensajes.
+Por eso el worker no está en el Procfile (cada dyno de Heroku tiene su propio
+disco): se inicia junto al servidor web con `honcho start -f Procfile.local`.
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import signal
+import socket
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+from rate_limiter import AdmissionRejected
+
+# Load environment variables
+load_dotenv()
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    file_ext TEXT NOT NULL,
+    content_hash TEXT,
+    with_debt INTEGER NOT NULL DEFAULT 0,
+    payload BLOB,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    outcome_json TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_available ON jobs(status, available_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs(status, lease_expires_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_hash ON jobs(content_hash, with_debt, status);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+"""
+
+
+class QueueFull(AdmissionRejected):
+    """Hay demasiados trabajos pendientes; el cliente debe reintentar más tarde."""
+
+    def __init__(self, pending, retry_after=5.0):
+        super().__init__(retry_after, reason="queue_full")
+        self.args = (f"Cola de análisis llena ({pending} trabajos pendientes)",)
+
+
+class JobQueue:
+    def __init__(self, path, visibility_timeout=120.0, max_attempts=3, max_pending=1000):
+        self.path = path
+        # Tiempo sin renovar el lease tras el cual otro worker puede tomar el trabajo
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self._local = threading.local()
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls):
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db')
+        return cls(
+            os.environ.get('JOB_QUEUE_PATH', default_path),
+            visibility_timeout=float(os.environ.get('JOB_VISIBILITY_TIMEOUT', 120)),
+            max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', 3)),
+            max_pending=int(os.environ.get('JOB_QUEUE_MAX_PENDING', 1000))
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Transacciones explícitas: el lease necesita BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def enqueue(self, file_bytes, file_ext, content_hash=None, with_debt=False):
+        """
+        Encola una factura y devuelve el id del trabajo.
+
+        Si la misma factura ya está en la cola o en proceso se devuelve ese
+        trabajo. Lanza QueueFull si hay max_pending trabajos pendientes.
+        """
+        def insert(conn):
+            if content_hash:
+                existing = conn.execute(
+                    "SELECT id FROM jobs WHERE content_hash = ? AND with_debt = ? "
+                    "AND status IN ('queued', 'running')",
+                    (content_hash, int(with_debt))
+                ).fetchone()
+                if existing:
+                    return existing['id']
+
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFull(pending)
+
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            conn.execute(
+                'INSERT INTO jobs (id, status, file_ext, content_hash, with_debt, payload, '
+                'max_attempts, available_at, created_at, updated_at) '
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, file_ext, content_hash, int(with_debt), sqlite3.Binary(file_bytes),
+                 self.max_attempts, now, now, now)
+            )
+            return job_id
+
+        return self._transaction(insert)
+
+    def lease(self, owner):
+        """Toma el próximo trabajo disponible (o con lease vencido); devuelve un dict o None."""
+        def take(conn):
+            now = time.time()
+            # Los trabajos abandonados que ya agotaron sus intentos no se retoman
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, updated_at = ?, "
+                "payload = NULL WHERE status = 'running' AND lease_expires_at <= ? AND attempts >= max_attempts",
+                ("El worker no terminó el trabajo tras el último intento", now, now, now)
+            )
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' AND available_at <= ? "
+                "ORDER BY available_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'running' AND lease_expires_at <= ? "
+                    "ORDER BY lease_expires_at LIMIT 1",
+                    (now,)
+                ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (owner, now + self.visibility_timeout, now, row['id'])
+            )
+            return dict(conn.execute(
+                'SELECT id, file_ext, content_hash, with_debt, payload, attempts, max_attempts '
+                'FROM jobs WHERE id = ?',
+                (row['id'],)
+            ).fetchone())
+
+        return self._transaction(take)
+
+    def heartbeat(self, job_id, owner):
+        """Renueva el lease; devuelve False si el trabajo ya no pertenece a este worker."""
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET lease_expires_at = ?, updated_at = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (now + self.visibility_timeout, now, job_id, owner)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, owner, outcome):
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = 'done', outcome_json = ?, error = NULL, payload = NULL, "
+            "lease_owner = NULL, lease_expires_at = NULL, finished_at = ?, updated_at = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (json.dumps(outcome, ensure_ascii=False), now, now, job_id, owner)
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, owner, error, retry_after=None):
+        """
+        Registra un intento fallido. Con retry_after (segundos) el trabajo
+        vuelve a la cola si le quedan intentos; si no, queda como fallido.
+        """
+        def update(conn):
+            now = time.time()
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (job_id, owner)
+            ).fetchone()
+            if row is None:
+                return False
+            if retry_after is not None and row['attempts'] < row['max_attempts']:
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, available_at = ?, "
+                    "lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                    (error, now + retry_after, now, job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, payload = NULL, "
+                    "lease_owner = NULL, lease_expires_at = NULL, finished_at = ?, updated_at = ? WHERE id = ?",
+                    (error, now, now, job_id)
+                )
+            return True
+
+        return self._transaction(update)
+
+    def requeue(self, job_id, owner, error, retry_after):
+        """Devuelve el trabajo a la cola sin contar el intento (el servicio no estaba disponible)."""
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = 'queued', error = ?, available_at = ?, attempts = MAX(attempts - 1, 0), "
+            "lease_owner = NULL, lease_expires_at = NULL, updated_at = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (error, now + retry_after, now, job_id, owner)
+        )
+        return cursor.rowcount == 1
+
+    def get(self, job_id):
+        """Estado público de un trabajo, con el resultado si ya terminó."""
+        row = self._connection().execute(
+            'SELECT id, status, attempts, max_attempts, outcome_json, error, created_at, '
+            'updated_at, finished_at FROM jobs WHERE id = ?',
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'maxAttempts': row['max_attempts'],
+            'error': row['error'],
+            'outcome': json.loads(row['outcome_json']) if row['outcome_json'] else None,
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+            'finishedAt': row['finished_at']
+        }
+
+    def purge(self, older_than):
+        """Borra los trabajos terminados hace más de older_than segundos."""
+        cursor = self._connection().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (time.time() - older_than,)
+        )
+        return cursor.rowcount
+
+    def stats(self):
+        rows = self._connection().execute(
+            'SELECT status, COUNT(*) AS count FROM jobs GROUP BY status'
+        ).fetchall()
+        counts = {status: 0 for status in STATUSES}
+        counts.update({row['status']: row['count'] for row in rows})
+        oldest = self._connection().execute(
+            "SELECT MIN(created_at) FROM jobs WHERE status = 'queued'"
+        ).fetchone()[0]
+        counts['oldestQueuedSeconds'] = round(time.time() - oldest, 3) if oldest else None
+        return counts
+
+
+def job_response(job, verbose=False):
+    """Respuesta de /jobs/<id>: mismo formato que /analyze cuando el trabajo terminó."""
+    response = {
+        'success': job['status'] != 'failed',
+        'jobId': job['id'],
+        'status': job['status'],
+        'attempts': job['attempts']
+    }
+    outcome = job['outcome']
+    if job['status'] == 'failed':
+        response['error'] = job['error']
+    elif outcome is not None:
+        if not outcome.get('result'):
+            response['success'] = False
+            response['error'] = 'No se pudieron extraer datos de la factura'
+        else:
+            response['data'] = outcome['result']
+            response['invoiceId'] = outcome.get('invoiceId')
+            response['usage'] = outcome.get('usage')
+            response['nearDuplicate'] = outcome.get('nearDuplicate')
+            if outcome.get('debts') is not None:
+                response['debts'] = outcome['debts']
+        response['logs'] = outcome.get('logs', []) if verbose else []
+    return response
+
+
+class Worker:
+    """Consume la cola con `concurrency` hilos; cada hilo procesa un trabajo a la vez."""
+
+    def __init__(self, queue, concurrency=4, poll_interval=2.0, retention=7 * 86400):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self.processed = 0
+        self.failed = 0
+
+    def stop(self, *_):
+        if not self._stop.is_set():
+            print("Deteniendo el worker: se terminan los trabajos en curso")
+            self._stop.set()
+
+    def process(self, job):
+        """Analiza la factura del trabajo con el mismo flujo que /analyze."""
+        from backend_server import run_analysis
+
+        # Sin cliente esperando no hay plazo de solicitud; las deudas usan WITH_DEBT_DEADLINE
+        return run_analysis(bytes(job['payload']), job['file_ext'], job['content_hash'], bool(job['with_debt']))
+
+    def _keep_leased(self, job_id, owner, done):
+        # Renovar el lease mientras dure el análisis
+        while not done.wait(self.queue.visibility_timeout / 3):
+            if not self.queue.heartbeat(job_id, owner):
+                print(f"Se perdió el lease del trabajo {job_id}")
+                return
+
+    def _run_job(self, job, owner):
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._keep_leased, args=(job['id'], owner, done), daemon=True)
+        heartbeat.start()
+        try:
+            outcome = self.process(job)
+        except AdmissionRejected as e:
+            # Anthropic saturado o circuito abierto: reintentar cuando indique el servicio, sin gastar
+            # un intento (la saturación no dice nada de la factura)
+            self.queue.requeue(job['id'], owner, str(e), e.retry_after)
+            return
+        except Exception as e:
+            # Backoff exponencial con jitter entre intentos
+            delay = random.uniform(0, min(60.0, 2.0 * (2 ** job['attempts'])))
+            self.queue.fail(job['id'], owner, f"{type(e).__name__}: {str(e)}", retry_after=delay)
+            self.failed += 1
+            print(f"Error en el trabajo {job['id']} (intento {job['attempts']}): {str(e)}")
+            return
+        finally:
+            done.set()
+            heartbeat.join()
+
+        if not outcome.get('result'):
+            # Igual que /analyze: una factura ilegible no se reintenta
+            self.queue.fail(job['id'], owner, 'No se pudieron extraer datos de la factura')
+            self.failed += 1
+        elif not self.queue.complete(job['id'], owner, outcome):
+            print(f"El trabajo {job['id']} fue tomado por otro worker; se descarta el resultado")
+        else:
+            self.processed += 1
+
+    def _loop(self, index):
+        owner = f"{self.owner_prefix}:{index}"
+        idle = 0.1
+        while not self._stop.is_set():
+            try:
+                job = self.queue.lease(owner)
+            except sqlite3.OperationalError as e:
+                print(f"Error al leer la cola: {str(e)}")
+                job = None
+            if job is None:
+                # Sin trabajos: esperar cada vez más, hasta poll_interval
+                self._stop.wait(idle)
+                idle = min(self.poll_interval, idle * 2)
+                continue
+            idle = 0.1
+            self._run_job(job, owner)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"Worker {self.owner_prefix} consumiendo {self.queue.path} con {self.concurrency} hilos")
+        threads = [
+            threading.Thread(target=self._loop, args=(index,), name=f'job-worker-{index}')
+            for index in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        while not self._stop.wait(3600):
+            removed = self.queue.purge(self.retention)
+            if removed:
+                print(f"Trabajos antiguos eliminados de la cola: {removed}")
+        for thread in threads:
+            thread.join()
+        print(f"Worker detenido: {self.processed} trabajos completados, {self.failed} intentos fallidos")
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Cola compartida del proceso; la ruta se configura con JOB_QUEUE_PATH."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue.from_env()
+    return _queue
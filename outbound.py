@@ -0,0 +1,377 @@
+"""
+Política común para las llamadas salientes (Anthropic y Tapila).
+
+Cada endpoint tiene sus propios timeouts de conexión y lectura, reintentos con
+backoff exponencial y jitter (solo para llamadas idempotentes), solicitudes
+cubiertas opcionales (hedging) tras el p95 de latencia observado y un circuit
+breaker que falla rápido, o sirve un valor de respaldo, cuando el servicio
+está degradado. Dentro de un deadline_scope cada intento recibe como timeout
+solo el tiempo que le queda a la solicitud (ver deadline.py).
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+from rate_limiter import AdmissionRejected
+from deadline import DeadlineExceeded, current_deadline
+
+# Load environment variables
+load_dotenv()
+
+# Tiempo mínimo para iniciar un intento: los clientes HTTP no aceptan un timeout nulo
+MIN_ATTEMPT_BUDGET = 0.05
+
+# Errores de red que se consideran transitorios (por nombre, para no importar los clientes)
+TRANSIENT_ERROR_NAMES = {
+    'ConnectionError', 'Timeout', 'ConnectTimeout', 'ReadTimeout',
+    'APIConnectionError', 'APITimeoutError', 'TimeoutError',
+    'TransportError', 'TimeoutException'
+}
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def attempt_timeout(policy, endpoint):
+    """Timeout del próximo intento: el de la política, recortado al plazo de la solicitud."""
+    deadline = current_deadline()
+    if deadline is None:
+        return policy.timeout
+    deadline.require(MIN_ATTEMPT_BUDGET, endpoint)
+    return deadline.bound(policy.timeout)
+
+
+def backoff_exceeds_deadline(delay):
+    deadline = current_deadline()
+    return deadline is not None and delay >= deadline.remaining()
+
+
+def is_transient(error):
+    """Indica si un error justifica reintentar y cuenta para el circuit breaker."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, AdmissionRejected):
+        return error.reason == 'upstream_overloaded'
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in (408, 425, 429) or status >= 500
+    return bool({cls.__name__ for cls in type(error).__mro__} & TRANSIENT_ERROR_NAMES)
+
+
+class CircuitOpenError(AdmissionRejected):
+    """El circuito del endpoint está abierto; se falla sin llamar al servicio."""
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(retry_after, reason="circuit_open")
+        self.endpoint = endpoint
+        self.args = (f"Servicio '{endpoint}' degradado, circuito abierto",)
+
+
+class EndpointPolicy:
+    def __init__(self, name, connect_timeout=3.05, read_timeout=30.0, max_attempts=3,
+                 backoff_base=0.5, backoff_cap=8.0, idempotent=True, hedge=False,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts if idempotent else 1
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.idempotent = idempotent
+        self.hedge = hedge and idempotent
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @classmethod
+    def from_env(cls, name, prefix, **defaults):
+        """Construye la política leyendo overrides como <PREFIX>_READ_TIMEOUT."""
+        return cls(
+            name,
+            connect_timeout=_env_float(f'{prefix}_CONNECT_TIMEOUT', defaults.get('connect_timeout', 3.05)),
+            read_timeout=_env_float(f'{prefix}_READ_TIMEOUT', defaults.get('read_timeout', 30.0)),
+            max_attempts=int(os.environ.get(f'{prefix}_MAX_ATTEMPTS', defaults.get('max_attempts', 3))),
+            idempotent=defaults.get('idempotent', True),
+            hedge=_env_flag(f'{prefix}_HEDGE', defaults.get('hedge', False)),
+            failure_threshold=int(os.environ.get(f'{prefix}_BREAKER_THRESHOLD', defaults.get('failure_threshold', 5))),
+            reset_timeout=_env_float(f'{prefix}_BREAKER_RESET', defaults.get('reset_timeout', 30.0))
+        )
+
+    @property
+    def timeout(self):
+        """Timeout en el formato (conexión, lectura) que acepta requests."""
+        return (self.connect_timeout, self.read_timeout)
+
+    def backoff(self, attempt):
+        """Backoff exponencial con jitter completo."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        # En half_open solo pasa una llamada de prueba; el resto falla rápido hasta que termine
+        self.probe_in_flight = False
+        self.probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                if now - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = 'half_open'
+            elif self.state != 'half_open':
+                return True
+            # Una prueba que no informó su resultado en reset_timeout se da por perdida
+            if self.probe_in_flight and now - self.probe_started_at < self.reset_timeout:
+                return False
+            self.probe_in_flight = True
+            self.probe_started_at = now
+            return True
+
+    def release_probe(self):
+        """La llamada terminó sin saber si el servicio se recuperó (p. ej. por el plazo): otra puede probar."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def retry_after(self):
+        with self._lock:
+            return max(1.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+
+class LatencyTracker:
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def p95(self):
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class OutboundPolicy:
+    def __init__(self, policies, hedge_workers=16):
+        self.policies = {policy.name: policy for policy in policies}
+        self.breakers = {
+            policy.name: CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+            for policy in policies
+        }
+        self.latencies = {policy.name: LatencyTracker() for policy in policies}
+        self._hedge_workers = hedge_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls([
+            EndpointPolicy.from_env('anthropic', 'ANTHROPIC', connect_timeout=5.0, read_timeout=60.0),
+            EndpointPolicy.from_env('tapila_login', 'TAPILA_LOGIN', read_timeout=10.0),
+            EndpointPolicy.from_env('tapila_debts', 'TAPILA_DEBTS', read_timeout=15.0),
+            EndpointPolicy.from_env('tapila_catalog', 'TAPILA_CATALOG', read_timeout=30.0)
+        ])
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._hedge_workers, thread_name_prefix='hedge'
+                )
+            return self._executor
+
+    def call(self, endpoint, fn, fallback=None):
+        """
+        Ejecuta fn(timeout) aplicando la política del endpoint.
+
+        fallback, si se indica, se usa cuando el circuito está abierto o se
+        agotan los reintentos por errores transitorios.
+        """
+        policy = self.policies[endpoint]
+        breaker = self.breakers[endpoint]
+
+        if not breaker.allow():
+            print(f"Circuito abierto para '{endpoint}', fallando rápido")
+            if fallback is not None:
+                return fallback()
+            raise CircuitOpenError(endpoint, breaker.retry_after())
+
+        for attempt in range(policy.max_attempts):
+            started = time.monotonic()
+            try:
+                result = self._attempt(policy, fn, attempt_timeout(policy, endpoint))
+            except DeadlineExceeded:
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                deadline = current_deadline()
+                if deadline is not None and deadline.expired:
+                    breaker.release_probe()
+                    # El intento se cortó por el plazo de la solicitud, no por el servicio
+                    if fallback is not None:
+                        return fallback()
+                    raise DeadlineExceeded(endpoint) from e
+                if not is_transient(e):
+                    # El servicio respondió (p. ej. un 4xx): no indica degradación
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                last_attempt = attempt + 1 >= policy.max_attempts
+                delay = policy.backoff(attempt)
+                if last_attempt or not breaker.allow() or backoff_exceeds_deadline(delay):
+                    if fallback is not None:
+                        print(f"Fallo transitorio en '{endpoint}', usando respaldo: {str(e)}")
+                        return fallback()
+                    raise
+                print(f"Fallo transitorio en '{endpoint}' (intento {attempt + 1}), reintentando en {delay:.2f}s: {str(e)}")
+                time.sleep(delay)
+                continue
+            self.latencies[endpoint].record(time.monotonic() - started)
+            breaker.record_success()
+            return result
+
+    def _attempt(self, policy, fn, timeout):
+        hedge_delay = self.latencies[policy.name].p95() if policy.hedge else None
+        if hedge_delay is None:
+            return fn(timeout)
+
+        # Solicitud cubierta: si la primera supera el p95, lanzar una segunda y usar la primera que responda
+        executor = self._get_executor()
+        # Cada intento corre en una copia del contexto de la solicitud (plazo, consumo, logs)
+        pending = {executor.submit(contextvars.copy_context().run, fn, timeout)}
+        done, pending = wait(pending, timeout=hedge_delay)
+        if not done:
+            pending.add(executor.submit(contextvars.copy_context().run, fn, timeout))
+        error = None
+        while pending or done:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        raise error
+
+    async def call_async(self, endpoint, fn, fallback=None):
+        """Variante de call() para corrutinas: fn(timeout) debe ser async."""
+        policy = self.policies[endpoint]
+        breaker = self.breakers[endpoint]
+
+        if not breaker.allow():
+            print(f"Circuito abierto para '{endpoint}', fallando rápido")
+            if fallback is not None:
+                return fallback()
+            raise CircuitOpenError(endpoint, breaker.retry_after())
+
+        for attempt in range(policy.max_attempts):
+            started = time.monotonic()
+            try:
+                result = await self._attempt_async(policy, fn, attempt_timeout(policy, endpoint))
+            except DeadlineExceeded:
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                deadline = current_deadline()
+                if deadline is not None and deadline.expired:
+                    breaker.release_probe()
+                    if fallback is not None:
+                        return fallback()
+                    raise DeadlineExceeded(endpoint) from e
+                if not is_transient(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                last_attempt = attempt + 1 >= policy.max_attempts
+                delay = policy.backoff(attempt)
+                if last_attempt or not breaker.allow() or backoff_exceeds_deadline(delay):
+                    if fallback is not None:
+                        print(f"Fallo transitorio en '{endpoint}', usando respaldo: {str(e)}")
+                        return fallback()
+                    raise
+                print(f"Fallo transitorio en '{endpoint}' (intento {attempt + 1}), reintentando en {delay:.2f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                continue
+            self.latencies[endpoint].record(time.monotonic() - started)
+            breaker.record_success()
+            return result
+
+    async def _attempt_async(self, policy, fn, timeout):
+        hedge_delay = self.latencies[policy.name].p95() if policy.hedge else None
+        if hedge_delay is None:
+            return await fn(timeout)
+
+        pending = {asyncio.ensure_future(fn(timeout))}
+        done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+        if not done:
+            pending.add(asyncio.ensure_future(fn(timeout)))
+        error = None
+        try:
+            while pending or done:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            raise error
+        finally:
+            # Cancelar la solicitud que quedó en vuelo
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {
+            name: {
+                'circuit': self.breakers[name].state,
+                'p95_seconds': self.latencies[name].p95()
+            }
+            for name in self.policies
+        }
+
+
+# Política compartida por todos los hilos del proceso
+outbound_policy = OutboundPolicy.from_env()
@@ -1,21 +1,71 @@
 import os
 import base64
-import anthropic
+import argparse
 from dotenv import load_dotenv
-from PIL import Image
-import io
 import sys
 import json
 import re
-import requests
 import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from rate_limiter import AdmissionRejected, anthropic_limiter, estimate_input_tokens, overload_retry_after
+from outbound import outbound_policy
+from catalog import get_catalog, normalize_company_name
+from usage_tracker import usage_tracker
+import cassette
+import preprocessing
+from preprocessing import preprocessor
+from phash import near_duplicates, confirms
+from deadline import DeadlineExceeded, MIN_CALL_BUDGET, require_budget
+
+# anthropic y requests se importan al primer uso para acelerar el arranque
 
 # Load environment variables
 load_dotenv()
 
+# Tiempo durante el que se puede servir una deuda consultada si Tapila está degradado
+DEBT_CACHE_TTL = float(os.getenv("DEBT_CACHE_TTL", 900))
+DEBT_CACHE_MAX_ENTRIES = 10000
+
+# Consultas de deuda simultáneas por proceso en /analyze?withDebt=1
+DEBT_LOOKUP_WORKERS = int(os.getenv("DEBT_LOOKUP_WORKERS", 8))
+
+# Prompt para identificar la compañía y su categoría
+COMPANY_PROMPT = """Analiza esta factura y proporciona la siguiente información en formato JSON:
+
+{
+    "company_names": ["nombre1", "nombre2", ...],  // Lista de nombres comerciales de la compañía
+    "category": "categoría del servicio",  // Ejemplo: "gas", "electricidad", "telecomunicaciones"
+}
+
+Instrucciones específicas:
+1. Identifica todos los nombres comerciales posibles de la compañía
+2. Si el nombre es compuesto (ej: "Camuzzi Pampeana"), incluye tanto el nombre completo como sus partes
+3. Incluye abreviaturas y nombres alternativos
+4. Identifica la categoría del servicio (gas, electricidad, telecomunicaciones, etc.)
+5. Identifica el tipo de factura (residencial, comercial, industrial)
+6. No incluyas direcciones, códigos postales u otra información"""
+
+
+def _silent(*args, **kwargs):
+    """Reemplaza a print cuando se pide quiet (sin redirigir la salida del proceso)."""
+
+
 class InvoiceAnalyzer:
+    # Estado compartido entre instancias: cliente de Anthropic, token de Tapila,
+    # pool HTTP y últimas deudas consultadas
+    _shared_client = None
+    _client_lock = threading.Lock()
+    _shared_auth_token = None
+    _auth_lock = threading.Lock()
+    _session = None
+    _session_lock = threading.Lock()
+    _debt_cache = {}
+    _debt_pool = None
+
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        self.client = self.create_client()
         # Obtener el directorio del proyecto de forma dinámica
         project_dir = os.path.dirname(os.path.abspath(__file__))
         self.companies_file = os.path.join(project_dir, "companies.json")
@@ -23,87 +73,115 @@ class InvoiceAnalyzer:
         self.login_api_key = os.getenv("TAPILA_LOGIN_API_KEY")
         self.client_username = os.getenv("TAPILA_CLIENT_USERNAME")
         self.client_password = os.getenv("TAPILA_CLIENT_PASSWORD")
-        self.auth_token = None
+        self.auth_token = InvoiceAnalyzer._shared_auth_token
+        # Facturas ya preparadas en este análisis (una instancia por solicitud)
+        self._prepared_images = {}
+        # Hash perceptual de la factura y foto anterior parecida, si la hay
+        self.perceptual_hash = None
+        self.near_duplicate = None
+
+    def create_client(self):
+        """Create the shared Anthropic client; retries are handled by outbound_policy."""
+        with InvoiceAnalyzer._client_lock:
+            if InvoiceAnalyzer._shared_client is None:
+                client = None
+                # En modo replay las respuestas salen de las grabaciones: no hace falta el cliente real
+                recording = cassette.active_cassette()
+                if recording is None or not recording.offline:
+                    import anthropic
+                    anthropic_policy = outbound_policy.policies['anthropic']
+                    client = anthropic.Anthropic(
+                        api_key=os.getenv("ANTHROPIC_API_KEY"),
+                        timeout=anthropic.Timeout(anthropic_policy.read_timeout, connect=anthropic_policy.connect_timeout),
+                        max_retries=0
+                    )
+                InvoiceAnalyzer._shared_client = cassette.wrap_anthropic_client(client)
+            return InvoiceAnalyzer._shared_client
+
+    @classmethod
+    def http_session(cls):
+        """Sesión HTTP compartida para reutilizar conexiones con Tapila."""
+        with cls._session_lock:
+            if cls._session is None:
+                import requests
+                cls._session = cassette.mount_session(requests.Session())
+            return cls._session
         
-    def get_auth_token(self):
-        """Get authentication token from login service."""
-        try:
-            url = "https://login.prod.tapila.cloud/login"
-            
-            headers = {
-                'x-api-key': self.login_api_key,
-                'Content-Type': 'application/json'
-            }
+    def login_request(self):
+        """Build the login request: (url, headers, data)."""
+        url = "https://login.prod.tapila.cloud/login"
+        
+        headers = {
+            'x-api-key': self.login_api_key,
+            'Content-Type': 'application/json'
+        }
+        
+        data = {
+            "clientUsername": self.client_username,
+            "password": self.client_password
+        }
+        return url, headers, data
+
+    def store_auth_token(self, token_data, quiet=False):
+        """Validate the login response and share the token across instances."""
+        # Check if we got a valid token
+        if not token_data or 'accessToken' not in token_data:
+            print("Error: La respuesta no contiene un token válido")
+            print(f"Respuesta completa: {token_data}")
+            raise ValueError("No se pudo obtener el token de autenticación")
             
-            data = {
-                "clientUsername": self.client_username,
-                "password": self.client_password
-            }
+        self.auth_token = token_data['accessToken']
+        with InvoiceAnalyzer._auth_lock:
+            InvoiceAnalyzer._shared_auth_token = self.auth_token
+        if not quiet:
+            print("Token obtenido exitosamente")
+        return self.auth_token
+
+    def get_auth_token(self, quiet=False):
+        """Get authentication token from login service; quiet omite el detalle de la respuesta."""
+        import requests
+        log = _silent if quiet else print
+        try:
+            url, headers, data = self.login_request()
             
-            print("\nIntentando obtener token de autenticación...")
-            response = requests.post(url, headers=headers, json=data)
+            log("\nIntentando obtener token de autenticación...")
+
+            def post_login(timeout):
+                response = self.http_session().post(url, headers=headers, json=data, timeout=timeout)
+                if response.status_code >= 500:
+                    response.raise_for_status()
+                return response
+
+            response = outbound_policy.call('tapila_login', post_login)
             
             # Print response details for debugging
-            print(f"Status code: {response.status_code}")
-            print(f"Response headers: {response.headers}")
-            print(f"Response body: {response.text}")
+            log(f"Status code: {response.status_code}")
+            log(f"Response headers: {response.headers}")
+            log(f"Response body: {response.text}")
             
             response.raise_for_status()
             
             # Extract token from response
-            token_data = response.json()
-            
-            # Check if we got a valid token
-            if not token_data or 'accessToken' not in token_data:
-                print("Error: La respuesta no contiene un token válido")
-                print(f"Respuesta completa: {token_data}")
-                raise ValueError("No se pudo obtener el token de autenticación")
-                
-            self.auth_token = token_data['accessToken']
-            print("Token obtenido exitosamente")
-            return self.auth_token
+            return self.store_auth_token(response.json(), quiet)
             
         except requests.exceptions.RequestException as e:
             print(f"Error al obtener el token de autenticación: {str(e)}")
             if hasattr(e, 'response') and e.response is not None:
-                print(f"Status code: {e.response.status_code}")
-                print(f"Response body: {e.response.text}")
+                log(f"Status code: {e.response.status_code}")
+                log(f"Response body: {e.response.text}")
             return None
         except json.JSONDecodeError as e:
             print(f"Error al decodificar la respuesta JSON: {str(e)}")
             return None
+        except cassette.CassetteMiss:
+            raise
         except Exception as e:
             print(f"Error inesperado al obtener el token: {str(e)}")
             return None
             
     def normalize_company_name(self, name):
         """Normalize company name for comparison."""
-        if not isinstance(name, str):
-            return []
-            
-        # Convert to lowercase
-        name = name.lower()
-        
-        # Split by slash and take each part
-        name_parts = [part.strip() for part in name.split('/')]
-        
-        # Process each part
-        normalized_parts = []
-        for part in name_parts:
-            # Remove common suffixes and legal forms
-            part = re.sub(r'\b(s\.a\.|s\.a|sa|sociedad anonima|sociedad anónima)\b', '', part)
-            # Remove special characters and extra spaces
-            part = re.sub(r'[^\w\s]', '', part)
-            part = re.sub(r'\s+', ' ', part)
-            if part.strip():
-                # Split into words and filter out common words
-                words = part.strip().split()
-                # List of common words to ignore
-                common_words = {'y', 'de', 'la', 'el', 'los', 'las', 'del', 'para', 'por', 'con', 'en', 'a', 'o', 'u'}
-                # Add only non-common words
-                normalized_parts.extend([word for word in words if word not in common_words])
-        
-        return normalized_parts
+        return normalize_company_name(name)
         
     def image_to_base64(self, image_path):
         """Convert image to base64 string."""
@@ -122,57 +200,110 @@ class InvoiceAnalyzer:
             print("Asegúrate de que la ruta sea correcta y el archivo exista.")
             sys.exit(1)
             
-    def analyze_image(self, image_path, prompt):
+    def client_timeout(self, timeout):
+        """Convert the policy's (connect, read) timeout to the Anthropic format."""
+        import anthropic
+        return anthropic.Timeout(timeout[1], connect=timeout[0])
+
+    def media_type_for(self, image_path):
+        """Get file extension to determine media type."""
+        return preprocessing.media_type_for(image_path)
+
+    def cached_image(self, image_path):
+        """Factura ya preparada en este análisis, o None (no la prepara)."""
+        return self._prepared_images.get(image_path)
+
+    def prepared_image(self, image_path):
+        """Prepara la factura una sola vez por análisis, en el pool de procesos."""
+        prepared = self._prepared_images.get(image_path)
+        if prepared is None:
+            prepared = preprocessor.prepare(image_path)
+            self._prepared_images[image_path] = prepared
+            if prepared.resized:
+                print(f"Imagen reducida a {prepared.width}x{prepared.height} para el análisis")
+        return prepared
+
+    def image_message_request(self, prompt, image_base64, media_type, model=None, max_tokens=4000):
+        """Build the Messages API arguments for a prompt about one image."""
+        return {
+            "model": model or usage_tracker.model,
+            "max_tokens": max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        },
+                        {
+                            # Los PDF se envían como documento, no como imagen
+                            "type": "document" if media_type == "application/pdf" else "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": media_type,
+                                "data": image_base64
+                            }
+                        }
+                    ]
+                }
+            ]
+        }
+
+    def handle_overload(self, error, slot):
+        """Turn a 429/529 from Anthropic into an admission rejection."""
+        retry_after = overload_retry_after(error)
+        if retry_after is not None:
+            # Anthropic está saturado: reducir concurrencia y avisar al cliente
+            slot.mark_overloaded(retry_after)
+            raise AdmissionRejected(retry_after, reason="upstream_overloaded")
+
+    def message_options(self):
+        """Model and max_tokens for the next call, honoring the daily budget."""
+        options = usage_tracker.request_options()
+        if options['economy']:
+            print(f"Presupuesto diario superado: usando el modelo económico {options['model']}")
+        return options['model'], options['max_tokens']
+
+    def analyze_image(self, image_path, prompt, stage=None):
         """Analyze an image using Claude's API."""
         try:
-            # Convert image to base64
-            image_base64 = self.image_to_base64(image_path)
-            
-            # Get file extension to determine media type
-            _, ext = os.path.splitext(image_path)
-            media_type = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.png': 'image/png',
-                '.gif': 'image/gif',
-                '.webp': 'image/webp'
-            }.get(ext.lower(), 'image/jpeg')
-            
-            # Create message with image content
-            message = self.client.messages.create(
-                model="claude-3-opus-20240229",
-                max_tokens=4000,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            },
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": media_type,
-                                    "data": image_base64
-                                }
-                            }
-                        ]
-                    }
-                ]
-            )
+            # Hash, redimensionado y base64 fuera del GIL, una vez por análisis
+            prepared = self.prepared_image(image_path)
+            # Sin tiempo suficiente para la llamada no se gasta en Claude
+            require_budget(MIN_CALL_BUDGET, stage)
+            model, max_tokens = self.message_options()
+            request = self.image_message_request(prompt, prepared.data, prepared.media_type, model, max_tokens)
+            
+            # Create message with image content, within the shared admission limits
+            def create_message(timeout):
+                with anthropic_limiter.slot(estimate_input_tokens(prompt), request["max_tokens"] // 4) as slot:
+                    try:
+                        message = self.client.messages.create(
+                            timeout=self.client_timeout(timeout),
+                            **request
+                        )
+                    except Exception as e:
+                        self.handle_overload(e, slot)
+                        raise
+                    slot.record_usage(message.usage)
+                return message
+
+            started = time.monotonic()
+            message = outbound_policy.call('anthropic', create_message)
+            usage_tracker.record(stage, request["model"], getattr(message, 'usage', None), time.monotonic() - started)
             
             return message.content[0].text
             
+        except (AdmissionRejected, DeadlineExceeded, cassette.CassetteMiss):
+            raise
         except Exception as e:
             return f"Error analyzing image: {str(e)}"
             
     def find_company_info(self, provider_name):
         """Find company information in the JSON file."""
         try:
-            with open(self.companies_file, 'r') as f:
-                companies_data = json.load(f)
+            catalog = get_catalog(self.companies_file)
             
             # Normalize provider name into words
             provider_words = self.normalize_company_name(provider_name)
@@ -183,17 +314,12 @@ class InvoiceAnalyzer:
             
             # Search for company in the services array
             matches = []
-            for service in companies_data.get('services', []):
-                if not isinstance(service, dict):
-                    continue
-                    
-                # Get company name
-                company_name = service.get('companyName', '')
-                if not company_name:
-                    continue
+            for entry in catalog.entries:
+                service = entry.service
+                company_name = entry.company_name
                 
-                # Normalize name and check for matches
-                company_words = self.normalize_company_name(company_name)
+                # Los nombres del catálogo ya están normalizados
+                company_words = entry.words
                 
                 # Calculate match score
                 matching_words = set(provider_words) & set(company_words)
@@ -255,472 +381,510 @@ class InvoiceAnalyzer:
             return ""
         return identifier.replace(" ", "").replace(".", "").replace("-", "")
 
-    def extract_invoice_data(self, image_path, identifiers_to_find):
-        """Extrae información general de la factura y los identificadores específicos."""
-        try:
-            # Leer la imagen
-            with open(image_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            # Construir el prompt para Claude
-            prompt = f"""Analiza esta imagen de factura y extrae la siguiente información en formato JSON:
-
-1. Información general:
-   - valor_factura: El monto total de la factura (número sin símbolos de moneda)
-   - fecha_vencimiento: La fecha de vencimiento en formato YYYY-MM-DD
-   - nombre_cliente: El nombre completo del cliente
-
-2. Identificadores específicos:
-   - {', '.join([f'{id["identifierName"]}: {id["description"]}' for id in identifiers_to_find])}
-
-Formato de respuesta requerido:
-{{
-    "valor_factura": "1234.56",
-    "fecha_vencimiento": "2024-03-15",
-    "nombre_cliente": "Juan Pérez",
-    "identificadores": {{
-        "identificador1": "valor1",
-        "identificador2": "valor2"
-    }}
-}}
-
-IMPORTANTE:
-- Los valores de los identificadores deben estar sin espacios, puntos ni guiones
-- Si no encuentras algún identificador, devuelve una cadena vacía ("") para ese campo
-- Si no encuentras la fecha de vencimiento, devuelve una cadena vacía ("")
-- Si no encuentras el nombre del cliente, devuelve una cadena vacía ("")
-- Si no encuentras el valor de la factura, devuelve "0.00"
-"""
-
-            # Hacer la consulta a Claude
-            response = self.client.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=1000,
-                temperature=0,
-                system="Eres un asistente especializado en analizar facturas y extraer información específica.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": image_data
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ]
-            )
-
-            # Procesar la respuesta
-            try:
-                # Intentar parsear la respuesta como JSON
-                response_text = response.content[0].text
-                # Limpiar la respuesta de posibles caracteres extra
-                response_text = response_text.strip()
-                if response_text.startswith("```json"):
-                    response_text = response_text[7:]
-                if response_text.endswith("```"):
-                    response_text = response_text[:-3]
-                response_text = response_text.strip()
-                
-                data = json.loads(response_text)
-                
-                # Limpiar los identificadores
-                if "identificadores" in data:
-                    cleaned_identifiers = {}
-                    for key, value in data["identificadores"].items():
-                        cleaned_identifiers[key] = self.clean_identifier(value)
-                    data["identificadores"] = cleaned_identifiers
-                
-                return data
-            except json.JSONDecodeError as e:
-                print(f"Error al parsear la respuesta JSON: {str(e)}")
-                print(f"Respuesta recibida: {response_text}")
-                # Si no se puede parsear como JSON, intentar extraer manualmente
-                text = response_text
-                data = {
-                    "valor_factura": "0.00",
-                    "fecha_vencimiento": "",
-                    "nombre_cliente": "",
-                    "identificadores": {}
-                }
-                
-                # Extraer valor de la factura
-                valor_match = re.search(r'valor_factura[":\s]+([\d,.]+)', text)
-                if valor_match:
-                    data["valor_factura"] = valor_match.group(1).replace(",", ".")
-                
-                # Extraer fecha de vencimiento
-                fecha_match = re.search(r'fecha_vencimiento[":\s]+(\d{4}-\d{2}-\d{2})', text)
-                if fecha_match:
-                    data["fecha_vencimiento"] = fecha_match.group(1)
-                
-                # Extraer nombre del cliente
-                nombre_match = re.search(r'nombre_cliente[":\s]+([^"\n]+)', text)
-                if nombre_match:
-                    data["nombre_cliente"] = nombre_match.group(1).strip()
-                
-                # Extraer identificadores
-                for identifier in identifiers_to_find:
-                    id_name = identifier["identifierName"]
-                    id_match = re.search(f'{id_name}["\\s:]+([^"\\n]+)', text)
-                    if id_match:
-                        data["identificadores"][id_name] = self.clean_identifier(id_match.group(1).strip())
-                    else:
-                        data["identificadores"][id_name] = ""
-                
-                return data
-
-        except Exception as e:
-            print(f"Error al extraer datos de la factura: {str(e)}")
-            return {
-                "valor_factura": "0.00",
-                "fecha_vencimiento": "",
-                "nombre_cliente": "",
-                "identificadores": {id["identifierName"]: "" for id in identifiers_to_find}
-            }
-
-    def consult_debt(self, company_code, modality_id, query_data):
-        """Consult debt information using Tapila API."""
-        try:
-            # Get auth token if not already available
-            if not self.auth_token:
-                self.get_auth_token()
-                if not self.auth_token:
-                    return None
-                    
-            url = "https://services.prod.tapila.cloud/debts"
-            
-            headers = {
-                'Content-Type': 'application/json',
-                'Accept': 'application/json',
-                'Accept-Encoding': 'deflate,gzip',
-                'x-api-key': self.api_key,
-                'x-authorization-token': self.auth_token
-            }
-            
-            # Generate a unique external ID
-            external_id = f"ext-{int(time.time())}"
-            
-            data = {
-                "companyCode": company_code,
-                "modalityId": modality_id,
-                "queryData": query_data,
-                "externalRequestId": external_id,
-                "externalClientId": "pdf-analyzer"
-            }
-            
-            # Print the curl command for debugging
-            curl_command = f"""curl --location '{url}' \\
+    def debt_request(self, company_code, modality_id, query_data, quiet=False):
+        """Build the debts request: (url, headers, data); quiet omite el comando curl (incluye las credenciales)."""
+        url = "https://services.prod.tapila.cloud/debts"
+        
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Accept-Encoding': 'deflate,gzip',
+            'x-api-key': self.api_key,
+            'x-authorization-token': self.auth_token
+        }
+        
+        # Generate a unique external ID
+        external_id = f"ext-{int(time.time())}"
+        
+        data = {
+            "companyCode": company_code,
+            "modalityId": modality_id,
+            "queryData": query_data,
+            "externalRequestId": external_id,
+            "externalClientId": "pdf-analyzer"
+        }
+        
+        # Print the curl command for debugging
+        curl_command = f"""curl --location '{url}' \\
 --header 'Content-Type: application/json' \\
 --header 'Accept: application/json' \\
 --header 'Accept-Encoding: deflate,gzip' \\
 --header 'x-api-key: {self.api_key}' \\
 --header 'x-authorization-token: {self.auth_token}' \\
 --data '{json.dumps(data, indent=2)}'"""
-            
+        
+        if not quiet:
             print("\nCurl command being used:")
             print(curl_command)
             print("\nMaking request...")
-            
-            response = requests.post(url, headers=headers, json=data)
-            
-            # Print response details
-            print(f"\nResponse status code: {response.status_code}")
-            print(f"Response headers: {response.headers}")
-            print(f"Response body: {response.text}")
-            
-            response.raise_for_status()
-            
-            return response.json()
+        return url, headers, data
+
+    @classmethod
+    def remember_debt(cls, cache_key, debt):
+        if len(cls._debt_cache) >= DEBT_CACHE_MAX_ENTRIES:
+            cls._debt_cache.pop(next(iter(cls._debt_cache)), None)
+        cls._debt_cache[cache_key] = (time.time(), debt)
+
+    @classmethod
+    def cached_debt(cls, cache_key):
+        """Última deuda consultada, para servirla si Tapila está degradado."""
+        cached = cls._debt_cache.get(cache_key)
+        if not cached or time.time() - cached[0] > DEBT_CACHE_TTL:
+            return None
+        print("Tapila degradado, devolviendo la última deuda consultada")
+        return dict(cached[1], stale=True) if isinstance(cached[1], dict) else cached[1]
+
+    def consult_debt(self, company_code, modality_id, query_data, quiet=False):
+        """Consult debt information using Tapila API; quiet omite el detalle de la solicitud y la respuesta."""
+        import requests
+        log = _silent if quiet else print
+        try:
+            # Get auth token if not already available
+            if not self.auth_token:
+                self.get_auth_token(quiet)
+                if not self.auth_token:
+                    return None
+
+            url, headers, data = self.debt_request(company_code, modality_id, query_data, quiet)
+            cache_key = json.dumps([company_code, modality_id, query_data], sort_keys=True)
+
+            def post_debts(timeout):
+                response = self.http_session().post(url, headers=headers, json=data, timeout=timeout)
+                if response.status_code == 401:
+                    # Token vencido: renovarlo una vez y repetir la consulta
+                    log("Token rechazado, renovando...")
+                    if self.get_auth_token(quiet):
+                        headers['x-authorization-token'] = self.auth_token
+                        response = self.http_session().post(url, headers=headers, json=data, timeout=timeout)
+
+                # Print response details
+                log(f"\nResponse status code: {response.status_code}")
+                log(f"Response headers: {response.headers}")
+                log(f"Response body: {response.text}")
+
+                response.raise_for_status()
+
+                debt = response.json()
+                self.remember_debt(cache_key, debt)
+                return debt
+
+            return outbound_policy.call('tapila_debts', post_debts, fallback=lambda: self.cached_debt(cache_key))
             
         except requests.exceptions.RequestException as e:
             print(f"Error al consultar la deuda: {str(e)}")
             if hasattr(e, 'response') and e.response is not None:
-                print(f"Status code: {e.response.status_code}")
-                print(f"Response body: {e.response.text}")
+                log(f"Status code: {e.response.status_code}")
+                log(f"Response body: {e.response.text}")
+            return None
+        except AdmissionRejected as e:
+            print(f"Error al consultar la deuda: {str(e)}")
             return None
             
-    def analyze_invoice(self, image_path):
-        """Analiza una factura y extrae la información necesaria."""
+    @staticmethod
+    def debt_query_data(modality):
+        """Arma el queryData de consult_debt con los identificadores de una modalidad del resultado (None si falta alguno)."""
+        identifiers = modality.get("identifiersEncontrados") or {}
+        if not identifiers or not all(identifiers.values()):
+            return None
+        return [{"identifierName": name, "identifierValue": value} for name, value in identifiers.items()]
+
+    @staticmethod
+    def debt_lookups(result):
+        """Modalidades del resultado con todos sus identificadores: [(modalityId, queryData)]."""
+        lookups = []
+        for modality in result.get("modalities", []):
+            query_data = InvoiceAnalyzer.debt_query_data(modality)
+            if query_data:
+                lookups.append((modality.get("modalityId", ""), query_data))
+        return lookups
+
+    def debt_entry(self, modality_id, status, debt=None, error=None):
+        entry = {"modalityId": modality_id, "status": status, "debt": debt}
+        if error:
+            entry["error"] = error
+        return entry
+
+    @classmethod
+    def debt_pool(cls):
+        with cls._session_lock:
+            if cls._debt_pool is None:
+                cls._debt_pool = ThreadPoolExecutor(max_workers=DEBT_LOOKUP_WORKERS, thread_name_prefix="debt")
+            return cls._debt_pool
+
+    def consult_debts(self, result, deadline):
+        """
+        Consulta en paralelo la deuda de cada modalidad con identificadores completos.
+
+        deadline es un instante de time.monotonic(): las consultas que no
+        terminan antes se informan con status "timeout".
+        """
+        lookups = self.debt_lookups(result)
+        if not lookups:
+            return []
+        if time.monotonic() >= deadline:
+            return [self.debt_entry(modality_id, "timeout") for modality_id, _ in lookups]
+
+        # Un solo login para todas las consultas paralelas
+        if not self.auth_token:
+            self.get_auth_token()
+
+        company_code = result.get("companyCode", "")
+        # Cada consulta corre con el contexto de la solicitud (plazo incluido)
+        futures = [
+            (modality_id, self.debt_pool().submit(
+                contextvars.copy_context().run, self.consult_debt, company_code, modality_id, query_data
+            ))
+            for modality_id, query_data in lookups
+        ]
+        done, _ = wait([future for _, future in futures], timeout=max(0.0, deadline - time.monotonic()))
+
+        debts = []
+        for modality_id, future in futures:
+            if future not in done or isinstance(future.exception(), DeadlineExceeded):
+                debts.append(self.debt_entry(modality_id, "timeout"))
+            elif future.exception() is not None:
+                debts.append(self.debt_entry(modality_id, "error", error=str(future.exception())))
+            elif future.result() is None:
+                debts.append(self.debt_entry(modality_id, "error", error="No se pudo consultar la deuda"))
+            else:
+                debts.append(self.debt_entry(modality_id, "ok", future.result()))
+        return debts
+
+    def report_near_duplicate(self, match):
+        if match is None:
+            return
+        action = {
+            'reuse': "se reutiliza su resultado si los identificadores lo confirman",
+            'company': "se omite la identificación de la compañía"
+        }[match.kind] if match.applied else "se analiza completa (grupo de control)"
+        print(f"\nFactura similar a la {match.invoice_id} del historial (distancia {match.distance}): {action}")
+
+    def find_near_duplicate(self, image_path):
+        """Busca en el historial otra foto de la misma factura por hash perceptual."""
+        self.perceptual_hash = self.prepared_image(image_path).perceptual_hash
+        self.near_duplicate = near_duplicates.lookup(self.perceptual_hash)
+        self.report_near_duplicate(self.near_duplicate)
+        return self.near_duplicate
+
+    def confirm_reuse(self, match, result):
+        """Devuelve el resultado guardado de la factura similar solo si los identificadores extraídos lo confirman."""
+        if match is None or match.kind != 'reuse' or not match.applied:
+            return result
+        match.confirmed = confirms(result, match.result)
+        if not match.confirmed:
+            print(f"\nLos identificadores no coinciden con la factura {match.invoice_id}: se usa el análisis nuevo")
+            return result
+        print(f"\nIdentificadores confirmados: se reutiliza el resultado de la factura {match.invoice_id}")
+        return match.result
+
+    def reused_invoice_id(self):
+        """Id de la factura del historial cuyo resultado se devolvió, o None."""
+        match = self.near_duplicate
+        if match is not None and match.kind == 'reuse' and match.confirmed:
+            return match.invoice_id
+        return None
+
+    def known_company(self, match):
+        """Servicio del catálogo de la factura similar, cuando se omite la identificación."""
+        if match is None or not match.applied:
+            return None
+        entry = get_catalog(self.companies_file).entry_for(match.company_code)
+        if entry is None:
+            # La compañía ya no está en el catálogo: se identifica normalmente
+            match.applied = False
+            return None
+        return entry.service
+
+    def parse_company_response(self, invoice_info):
+        """Interpreta la respuesta de identificación de compañía: (nombres, categoría, tipo)."""
         try:
-            # Analizar la factura para identificar la compañía y su categoría
-            company_prompt = """Analiza esta factura y proporciona la siguiente información en formato JSON:
+            invoice_data = json.loads(invoice_info)
+            company_names = invoice_data.get("company_names", [])
+            category = invoice_data.get("category", "").lower()
+            invoice_type = invoice_data.get("invoice_type", "").lower()
+        except json.JSONDecodeError:
+            print("Error al procesar la respuesta de identificación de compañía")
+            return None
 
-{
-    "company_names": ["nombre1", "nombre2", ...],  // Lista de nombres comerciales de la compañía
-    "category": "categoría del servicio",  // Ejemplo: "gas", "electricidad", "telecomunicaciones"
-}
+        print(f"\nNombres de compañía detectados: {', '.join(company_names)}")
+        print(f"Categoría detectada: {category}")
+        print(f"Tipo de factura: {invoice_type}")
 
-Instrucciones específicas:
-1. Identifica todos los nombres comerciales posibles de la compañía
-2. Si el nombre es compuesto (ej: "Camuzzi Pampeana"), incluye tanto el nombre completo como sus partes
-3. Incluye abreviaturas y nombres alternativos
-4. Identifica la categoría del servicio (gas, electricidad, telecomunicaciones, etc.)
-5. Identifica el tipo de factura (residencial, comercial, industrial)
-6. No incluyas direcciones, códigos postales u otra información"""
+        return company_names, category, invoice_type
 
-            # Obtener información de la factura
-            invoice_info = self.analyze_image(image_path, company_prompt)
-            try:
-                invoice_data = json.loads(invoice_info)
-                company_names = invoice_data.get("company_names", [])
-                category = invoice_data.get("category", "").lower()
-                invoice_type = invoice_data.get("invoice_type", "").lower()
-            except json.JSONDecodeError:
-                print("Error al procesar la respuesta de identificación de compañía")
-                return None
+    def select_company(self, company_names, category):
+        """Devuelve el servicio del catálogo que coincide con alguno de los nombres detectados."""
+        company_info = None
+        company_code = None
+        
+        # Intentar encontrar la compañía por nombre
+        for company_name in company_names:
+            temp_info = self.find_company_info(company_name)
+            if temp_info:
+                # Encontramos una coincidencia, la seleccionamos sin verificar categoría
+                company_info = temp_info
+                company_code = temp_info.get("companyCode", "")
+                company_tags = [tag.lower() for tag in temp_info.get("tags", [])]
+                
+                print(f"\nCompañía seleccionada: {temp_info.get('companyName', '')}")
+                print(f"Código de compañía: {company_code}")
+                print(f"Tags de la compañía: {', '.join(company_tags)}")
+                print(f"Categoría detectada: {category}")
+                break  # Tomamos la primera coincidencia y terminamos
 
-            print(f"\nNombres de compañía detectados: {', '.join(company_names)}")
-            print(f"Categoría detectada: {category}")
-            print(f"Tipo de factura: {invoice_type}")
-
-            # Buscar la compañía en el JSON
-            company_info = None
-            company_code = None
-            
-            # Intentar encontrar la compañía por nombre
-            for company_name in company_names:
-                temp_info = self.find_company_info(company_name)
-                if temp_info:
-                    # Encontramos una coincidencia, la seleccionamos sin verificar categoría
-                    company_info = temp_info
-                    company_code = temp_info.get("companyCode", "")
-                    company_tags = [tag.lower() for tag in temp_info.get("tags", [])]
-                    
-                    print(f"\nCompañía seleccionada: {temp_info.get('companyName', '')}")
-                    print(f"Código de compañía: {company_code}")
-                    print(f"Tags de la compañía: {', '.join(company_tags)}")
-                    print(f"Categoría detectada: {category}")
-                    break  # Tomamos la primera coincidencia y terminamos
-
-            if not company_info:
-                print("\nNo se encontraron coincidencias para la compañía")
-                return None
+        if not company_info:
+            print("\nNo se encontraron coincidencias para la compañía")
 
-            # Ya tenemos la compañía, procedemos con sus modalidades
-            print("\nBuscando modalidades activas...")
-            modalities = company_info.get("modalities", [])
-            
-            # Filtrar modalidades activas
-            active_modalities = []
-            for modality in modalities:
-                if isinstance(modality, dict) and modality.get("active", True):
-                    active_modalities.append(modality)
-            
-            if not active_modalities:
-                print("No hay modalidades activas para esta compañía")
-                return None
+        return company_info
+
+    def get_active_modalities(self, company_info, quiet=False):
+        """Filtra las modalidades activas de la compañía."""
+        log = _silent if quiet else print
+        log("\nBuscando modalidades activas...")
+        modalities = company_info.get("modalities", [])
+        
+        # Filtrar modalidades activas
+        active_modalities = []
+        for modality in modalities:
+            if isinstance(modality, dict) and modality.get("active", True):
+                active_modalities.append(modality)
+        
+        if not active_modalities:
+            log("No hay modalidades activas para esta compañía")
+            return None
+        
+        log(f"\nModalidades activas encontradas: {len(active_modalities)}")
+
+        return active_modalities
+
+    def build_identifiers_to_find(self, active_modalities, quiet=False):
+        """Construye la lista de identificadores a buscar para las modalidades activas."""
+        log = _silent if quiet else print
+        # Construir la lista de identificadores para buscar
+        identifiers_to_find = []
+        
+        for i, modality in enumerate(active_modalities):
+            log(f"\nModalidad {i+1}:")
+            log(f"  ID: {modality.get('modalityId', 'N/A')}")
+            log(f"  Título: {modality.get('modalityTitle', 'N/A')}")
+            log(f"  Tipo: {modality.get('modalityType', 'N/A')}")
             
-            print(f"\nModalidades activas encontradas: {len(active_modalities)}")
+            # Obtener queryData, que puede ser una lista o un diccionario
+            query_data = modality.get("queryData", [])
             
-            # Construir la lista de identificadores para buscar
-            identifiers_to_find = []
+            # Procesar queryData si es una lista
+            if isinstance(query_data, list):
+                for qd_item in query_data:
+                    if isinstance(qd_item, dict):
+                        description = qd_item.get("description", "")
+                        identifier_name = qd_item.get("identifierName", "")
+                        min_length = qd_item.get("minLength", "")
+                        max_length = qd_item.get("maxLength", "")
+                        data_type = qd_item.get("dataType", "")
+                        help_text = qd_item.get("helpText", "")
+                        
+                        if description and identifier_name:
+                            log(f"  Identificador: {identifier_name}")
+                            log(f"  Descripción: {description}")
+                            log(f"  Longitud mínima: {min_length}")
+                            log(f"  Longitud máxima: {max_length}")
+                            log(f"  Tipo de dato: {data_type}")
+                            if help_text:
+                                log(f"  Ayuda: {help_text}")
+                            
+                            identifiers_to_find.append({
+                                "identifierName": identifier_name,
+                                "description": description,
+                                "min_length": min_length,
+                                "max_length": max_length,
+                                "dataType": data_type,
+                                "helpText": help_text,
+                                "modalityId": modality.get("modalityId", "")
+                            })
             
-            for i, modality in enumerate(active_modalities):
-                print(f"\nModalidad {i+1}:")
-                print(f"  ID: {modality.get('modalityId', 'N/A')}")
-                print(f"  Título: {modality.get('modalityTitle', 'N/A')}")
-                print(f"  Tipo: {modality.get('modalityType', 'N/A')}")
-                
-                # Obtener queryData, que puede ser una lista o un diccionario
-                query_data = modality.get("queryData", [])
-                
-                # Procesar queryData si es una lista
-                if isinstance(query_data, list):
-                    for qd_item in query_data:
-                        if isinstance(qd_item, dict):
-                            description = qd_item.get("description", "")
-                            identifier_name = qd_item.get("identifierName", "")
-                            min_length = qd_item.get("minLength", "")
-                            max_length = qd_item.get("maxLength", "")
-                            data_type = qd_item.get("dataType", "")
-                            help_text = qd_item.get("helpText", "")
+            # Procesar queryData si es un diccionario
+            elif isinstance(query_data, dict):
+                identifiers = query_data.get("identifiers", [])
+                if isinstance(identifiers, list):
+                    for identifier in identifiers:
+                        if isinstance(identifier, dict):
+                            identifier_name = identifier.get("name", "")
+                            identifier_description = identifier.get("description", "")
+                            min_length = identifier.get("minLength", "")
+                            max_length = identifier.get("maxLength", "")
+                            data_type = identifier.get("dataType", "")
+                            help_text = identifier.get("helpText", "")
                             
-                            if description and identifier_name:
-                                print(f"  Identificador: {identifier_name}")
-                                print(f"  Descripción: {description}")
-                                print(f"  Longitud mínima: {min_length}")
-                                print(f"  Longitud máxima: {max_length}")
-                                print(f"  Tipo de dato: {data_type}")
+                            if identifier_name and identifier_description:
+                                log(f"  Identificador: {identifier_name}")
+                                log(f"  Descripción: {identifier_description}")
+                                log(f"  Longitud mínima: {min_length}")
+                                log(f"  Longitud máxima: {max_length}")
+                                log(f"  Tipo de dato: {data_type}")
                                 if help_text:
-                                    print(f"  Ayuda: {help_text}")
+                                    log(f"  Ayuda: {help_text}")
                                 
                                 identifiers_to_find.append({
                                     "identifierName": identifier_name,
-                                    "description": description,
+                                    "description": identifier_description,
                                     "min_length": min_length,
                                     "max_length": max_length,
                                     "dataType": data_type,
                                     "helpText": help_text,
                                     "modalityId": modality.get("modalityId", "")
                                 })
+        
+        if not identifiers_to_find:
+            log("\nNo se encontraron identificadores para las modalidades")
+            log("Usando modalidades completas para el análisis...")
+            
+            # Si no se encontraron identificadores, usamos las descripciones generales
+            for i, modality in enumerate(active_modalities):
+                modality_id = modality.get("modalityId", "")
                 
-                # Procesar queryData si es un diccionario
-                elif isinstance(query_data, dict):
-                    identifiers = query_data.get("identifiers", [])
-                    if isinstance(identifiers, list):
-                        for identifier in identifiers:
-                            if isinstance(identifier, dict):
-                                identifier_name = identifier.get("name", "")
-                                identifier_description = identifier.get("description", "")
-                                min_length = identifier.get("minLength", "")
-                                max_length = identifier.get("maxLength", "")
-                                data_type = identifier.get("dataType", "")
-                                help_text = identifier.get("helpText", "")
-                                
-                                if identifier_name and identifier_description:
-                                    print(f"  Identificador: {identifier_name}")
-                                    print(f"  Descripción: {identifier_description}")
-                                    print(f"  Longitud mínima: {min_length}")
-                                    print(f"  Longitud máxima: {max_length}")
-                                    print(f"  Tipo de dato: {data_type}")
-                                    if help_text:
-                                        print(f"  Ayuda: {help_text}")
-                                    
-                                    identifiers_to_find.append({
-                                        "identifierName": identifier_name,
-                                        "description": identifier_description,
-                                        "min_length": min_length,
-                                        "max_length": max_length,
-                                        "dataType": data_type,
-                                        "helpText": help_text,
-                                        "modalityId": modality.get("modalityId", "")
-                                    })
-            
-            if not identifiers_to_find:
-                print("\nNo se encontraron identificadores para las modalidades")
-                print("Usando modalidades completas para el análisis...")
-                
-                # Si no se encontraron identificadores, usamos las descripciones generales
-                for i, modality in enumerate(active_modalities):
-                    modality_id = modality.get("modalityId", "")
-                    
-                    # Determinar qué descripción usar para este tipo de modalidad
-                    if modality.get("modalityType") == "barcode":
-                        description = "Código de Barras"
-                        identifier_name = "BARCODE"
-                        min_length = ""
-                        max_length = ""
-                        data_type = "ALF"
-                        help_text = "Código de barras ubicado en la factura"
-                    else:
-                        # Buscar alguna descripción en queryData
-                        description = ""
-                        identifier_name = ""
-                        min_length = ""
-                        max_length = ""
-                        data_type = "ALF"
-                        help_text = ""
-                        
-                        query_data = modality.get("queryData", [])
-                        if isinstance(query_data, list) and len(query_data) > 0:
-                            for item in query_data:
-                                if isinstance(item, dict) and item.get("description"):
-                                    description = item.get("description", "")
-                                    identifier_name = item.get("identifierName", f"ID_{i}")
-                                    min_length = item.get("minLength", "")
-                                    max_length = item.get("maxLength", "")
-                                    data_type = item.get("dataType", "ALF")
-                                    help_text = item.get("helpText", "")
-                                    break
-                        
-                        # Si aún no tenemos descripción, usar el título de la modalidad
-                        if not description:
-                            description = modality.get("modalityTitle", f"Modalidad {i+1}")
-                            identifier_name = f"ID_{i}"
+                # Determinar qué descripción usar para este tipo de modalidad
+                if modality.get("modalityType") == "barcode":
+                    description = "Código de Barras"
+                    identifier_name = "BARCODE"
+                    min_length = ""
+                    max_length = ""
+                    data_type = "ALF"
+                    help_text = "Código de barras ubicado en la factura"
+                else:
+                    # Buscar alguna descripción en queryData
+                    description = ""
+                    identifier_name = ""
+                    min_length = ""
+                    max_length = ""
+                    data_type = "ALF"
+                    help_text = ""
                     
-                    print(f"  Usando identificador: {identifier_name}")
-                    print(f"  Descripción: {description}")
-                    print(f"  Longitud mínima: {min_length}")
-                    print(f"  Longitud máxima: {max_length}")
-                    print(f"  Tipo de dato: {data_type}")
-                    if help_text:
-                        print(f"  Ayuda: {help_text}")
+                    query_data = modality.get("queryData", [])
+                    if isinstance(query_data, list) and len(query_data) > 0:
+                        for item in query_data:
+                            if isinstance(item, dict) and item.get("description"):
+                                description = item.get("description", "")
+                                identifier_name = item.get("identifierName", f"ID_{i}")
+                                min_length = item.get("minLength", "")
+                                max_length = item.get("maxLength", "")
+                                data_type = item.get("dataType", "ALF")
+                                help_text = item.get("helpText", "")
+                                break
                     
-                    identifiers_to_find.append({
-                        "identifierName": identifier_name,
-                        "description": description,
-                        "min_length": min_length,
-                        "max_length": max_length,
-                        "dataType": data_type,
-                        "helpText": help_text,
-                        "modalityId": modality_id
-                    })
-            
-            print(f"\nIdentificadores a buscar: {len(identifiers_to_find)}")
-            for id_item in identifiers_to_find:
-                print(f"  - {id_item['identifierName']}: {id_item['description']}")
-                if id_item['min_length'] or id_item['max_length'] or id_item['dataType']:
-                    print(f"    Restricciones: {id_item['dataType'] or 'N/A'}, longitud: {id_item['min_length'] or 'N/A'}-{id_item['max_length'] or 'N/A'}")
-                if id_item.get('helpText'):
-                    print(f"    Ayuda: {id_item['helpText']}")
-            
-            # Construir el prompt específico para Claude
-            descriptions_list = []
-            for item in identifiers_to_find:
-                descriptions_list.append(f'  "{item["description"]}": "valor"')
-            
-            json_template = ",\n".join(descriptions_list)
-            
-            # Construir la lista de descripciones con detalles adicionales para Claude
-            detailed_descriptions = []
-            for item in identifiers_to_find:
-                desc = f"   - {item['description']}"
+                    # Si aún no tenemos descripción, usar el título de la modalidad
+                    if not description:
+                        description = modality.get("modalityTitle", f"Modalidad {i+1}")
+                        identifier_name = f"ID_{i}"
                 
-                # Añadir detalles sobre el tipo de dato y restricciones
-                restrictions = []
+                log(f"  Usando identificador: {identifier_name}")
+                log(f"  Descripción: {description}")
+                log(f"  Longitud mínima: {min_length}")
+                log(f"  Longitud máxima: {max_length}")
+                log(f"  Tipo de dato: {data_type}")
+                if help_text:
+                    log(f"  Ayuda: {help_text}")
                 
-                if item['dataType']:
-                    data_type_desc = ""
-                    if item['dataType'] == "NUM":
-                        data_type_desc = "numérico (solo dígitos)"
-                    elif item['dataType'] == "ALF":
-                        data_type_desc = "alfanumérico"
-                    elif item['dataType'] == "IMP":
-                        data_type_desc = "importe/monto"
-                    elif item['dataType'] == "CBA":
-                        data_type_desc = "código de barras"
-                    
-                    if data_type_desc:
-                        restrictions.append(f"tipo {data_type_desc}")
-                
-                length_desc = ""
-                if item['min_length'] and item['max_length'] and item['min_length'] == item['max_length']:
-                    length_desc = f"exactamente {item['min_length']} caracteres"
-                else:
-                    if item['min_length']:
-                        length_desc = f"mínimo {item['min_length']} caracteres"
-                    if item['max_length']:
-                        if length_desc:
-                            length_desc += f", máximo {item['max_length']} caracteres"
-                        else:
-                            length_desc = f"máximo {item['max_length']} caracteres"
-                
-                if length_desc:
-                    restrictions.append(length_desc)
-                
-                if restrictions:
-                    desc += f" ({', '.join(restrictions)})"
-                
-                # Añadir el texto de ayuda si existe
-                if item.get('helpText'):
-                    desc += f"\n     Ubicación: {item['helpText']}"
+                identifiers_to_find.append({
+                    "identifierName": identifier_name,
+                    "description": description,
+                    "min_length": min_length,
+                    "max_length": max_length,
+                    "dataType": data_type,
+                    "helpText": help_text,
+                    "modalityId": modality_id
+                })
+        
+        log(f"\nIdentificadores a buscar: {len(identifiers_to_find)}")
+        for id_item in identifiers_to_find:
+            log(f"  - {id_item['identifierName']}: {id_item['description']}")
+            if id_item['min_length'] or id_item['max_length'] or id_item['dataType']:
+                log(f"    Restricciones: {id_item['dataType'] or 'N/A'}, longitud: {id_item['min_length'] or 'N/A'}-{id_item['max_length'] or 'N/A'}")
+            if id_item.get('helpText'):
+                log(f"    Ayuda: {id_item['helpText']}")
+
+        return identifiers_to_find
+
+    def build_plan(self, active_modalities, quiet=False):
+        """Identificadores a buscar y prompt de extracción para las modalidades activas."""
+        identifiers_to_find = self.build_identifiers_to_find(active_modalities, quiet)
+        return identifiers_to_find, self.build_identifiers_prompt(identifiers_to_find)
+
+    def identifiers_plan(self, company_info, active_modalities, quiet=False):
+        """Identificadores a buscar y prompt de extracción, precalculados por compañía."""
+        entry = get_catalog(self.companies_file).entry_for(company_info.get("companyCode", ""))
+        if entry is None or entry.service is not company_info:
+            return self.build_plan(active_modalities, quiet)
+        if entry.plan is None:
+            entry.plan = self.build_plan(active_modalities, quiet)
+        elif not quiet:
+            print(f"\nUsando plantilla de identificadores precalculada ({len(entry.plan[0])} identificadores)")
+        return entry.plan
+
+    def identifiers_prompt_parts(self, identifiers_to_find):
+        """Descripciones detalladas y plantilla JSON de los identificadores, para armar el prompt."""
+        descriptions_list = []
+        for item in identifiers_to_find:
+            descriptions_list.append(f'  "{item["description"]}": "valor"')
+        
+        json_template = ",\n".join(descriptions_list)
+        
+        # Construir la lista de descripciones con detalles adicionales para Claude
+        detailed_descriptions = []
+        for item in identifiers_to_find:
+            desc = f"   - {item['description']}"
+            
+            # Añadir detalles sobre el tipo de dato y restricciones
+            restrictions = []
+            
+            if item['dataType']:
+                data_type_desc = ""
+                if item['dataType'] == "NUM":
+                    data_type_desc = "numérico (solo dígitos)"
+                elif item['dataType'] == "ALF":
+                    data_type_desc = "alfanumérico"
+                elif item['dataType'] == "IMP":
+                    data_type_desc = "importe/monto"
+                elif item['dataType'] == "CBA":
+                    data_type_desc = "código de barras"
                 
-                detailed_descriptions.append(desc)
+                if data_type_desc:
+                    restrictions.append(f"tipo {data_type_desc}")
+            
+            length_desc = ""
+            if item['min_length'] and item['max_length'] and item['min_length'] == item['max_length']:
+                length_desc = f"exactamente {item['min_length']} caracteres"
+            else:
+                if item['min_length']:
+                    length_desc = f"mínimo {item['min_length']} caracteres"
+                if item['max_length']:
+                    if length_desc:
+                        length_desc += f", máximo {item['max_length']} caracteres"
+                    else:
+                        length_desc = f"máximo {item['max_length']} caracteres"
+            
+            if length_desc:
+                restrictions.append(length_desc)
+            
+            if restrictions:
+                desc += f" ({', '.join(restrictions)})"
             
-            identifiers_prompt = f"""Analiza esta factura y extrae la siguiente información:
+            # Añadir el texto de ayuda si existe
+            if item.get('helpText'):
+                desc += f"\n     Ubicación: {item['helpText']}"
+            
+            detailed_descriptions.append(desc)
+
+        return chr(10).join(detailed_descriptions), json_template
+
+    def build_identifiers_prompt(self, identifiers_to_find):
+        """Construye el prompt de extracción de identificadores para Claude."""
+        # Construir el prompt específico para Claude
+        descriptions, json_template = self.identifiers_prompt_parts(identifiers_to_find)
+
+        identifiers_prompt = f"""Analiza esta factura y extrae la siguiente información:
 
 1. Extrae los siguientes datos específicos con las restricciones indicadas:
-{chr(10).join(detailed_descriptions)}
+{descriptions}
 
 2. Información general de la factura:
    - Valor total de la factura
@@ -744,166 +908,252 @@ IMPORTANTE:
 - Para importes/montos (IMP), usa formato de número con punto decimal.
 - La respuesta debe ser SOLO el JSON, sin texto adicional antes o después."""
 
-            # Obtener los datos de la factura usando Claude
-            print("\nConsultando a Claude para extraer los identificadores...")
-            identifiers_info = self.analyze_image(image_path, identifiers_prompt)
+        return identifiers_prompt
+
+    def parse_identifiers_response(self, identifiers_info, identifiers_to_find):
+        """Interpreta la respuesta de extracción de identificadores de Claude."""
+        try:
+            # Limpiar la respuesta para asegurar que sea un JSON válido
+            identifiers_info = identifiers_info.strip()
+            if identifiers_info.startswith("```json"):
+                identifiers_info = identifiers_info[7:]
+            if identifiers_info.endswith("```"):
+                identifiers_info = identifiers_info[:-3]
+            identifiers_info = identifiers_info.strip()
+            
+            # Parsear el JSON
+            claude_data = json.loads(identifiers_info)
+            print("Respuesta JSON recibida de Claude")
             
+            # Crear el diccionario de resultado
+            invoice_data = {
+                "valor_factura": claude_data.get("valor_factura", "0.00"),
+                "fecha_vencimiento": claude_data.get("fecha_vencimiento", ""),
+                "nombre_cliente": claude_data.get("nombre_cliente", ""),
+                "identificadores": {}
+            }
+            
+            # Mapear las descripciones a los identificadores internos
+            for id_item in identifiers_to_find:
+                description = id_item["description"]
+                identifier_name = id_item["identifierName"]
+                # Buscar por descripción exacta
+                if description in claude_data:
+                    value = claude_data[description]
+                    clean_value = self.clean_identifier(value)
+                    invoice_data["identificadores"][identifier_name] = clean_value
+                    print(f"Encontrado {description}: {clean_value}")
+                else:
+                    print(f"No se encontró valor para: {description}")
+            
+            print("Datos extraídos correctamente de la factura")
+            
+        except json.JSONDecodeError as e:
+            print(f"Error al procesar el JSON de Claude: {str(e)}")
+            print(f"Respuesta recibida: {identifiers_info}")
             try:
-                # Limpiar la respuesta para asegurar que sea un JSON válido
-                identifiers_info = identifiers_info.strip()
-                if identifiers_info.startswith("```json"):
-                    identifiers_info = identifiers_info[7:]
-                if identifiers_info.endswith("```"):
-                    identifiers_info = identifiers_info[:-3]
-                identifiers_info = identifiers_info.strip()
-                
-                # Parsear el JSON
-                claude_data = json.loads(identifiers_info)
-                print("Respuesta JSON recibida de Claude")
+                # Intentar procesar como texto plano si JSON falla
+                print("Intentando procesar como texto plano...")
+                lines = identifiers_info.strip().split('\n')
                 
-                # Crear el diccionario de resultado
+                # Crear diccionario para almacenar resultados
                 invoice_data = {
-                    "valor_factura": claude_data.get("valor_factura", "0.00"),
-                    "fecha_vencimiento": claude_data.get("fecha_vencimiento", ""),
-                    "nombre_cliente": claude_data.get("nombre_cliente", ""),
+                    "valor_factura": "0.00",
+                    "fecha_vencimiento": "",
+                    "nombre_cliente": "",
                     "identificadores": {}
                 }
                 
-                # Mapear las descripciones a los identificadores internos
-                for id_item in identifiers_to_find:
-                    description = id_item["description"]
-                    identifier_name = id_item["identifierName"]
-                    # Buscar por descripción exacta
-                    if description in claude_data:
-                        value = claude_data[description]
-                        clean_value = self.clean_identifier(value)
-                        invoice_data["identificadores"][identifier_name] = clean_value
-                        print(f"Encontrado {description}: {clean_value}")
+                # Procesar cada línea
+                for line in lines:
+                    line = line.strip()
+                    if not line or ":" not in line:
+                        continue
+                        
+                    # Dividir en clave y valor
+                    key, value = [part.strip() for part in line.split(":", 1)]
+                    
+                    # Verificar si es un campo general
+                    if key.lower() in ["valor de la factura", "valor_factura", "monto"]:
+                        value = re.sub(r'[^\d.,]', '', value)
+                        invoice_data["valor_factura"] = value
+                        print(f"Valor de factura: {value}")
+                    elif key.lower() in ["fecha de vencimiento", "fecha_vencimiento"]:
+                        invoice_data["fecha_vencimiento"] = value
+                        print(f"Fecha de vencimiento: {value}")
+                    elif key.lower() in ["nombre del cliente", "nombre_cliente"]:
+                        invoice_data["nombre_cliente"] = value
+                        print(f"Nombre del cliente: {value}")
                     else:
-                        print(f"No se encontró valor para: {description}")
+                        # Buscar coincidencias para los identificadores
+                        for id_item in identifiers_to_find:
+                            description = id_item["description"]
+                            identifier_name = id_item["identifierName"]
+                            
+                            if key.lower() == description.lower():
+                                clean_value = self.clean_identifier(value)
+                                invoice_data["identificadores"][identifier_name] = clean_value
+                                print(f"Encontrado {description}: {clean_value}")
+                                break
                 
-                print("Datos extraídos correctamente de la factura")
+                print("Datos extraídos mediante modo alternativo")
                 
-            except json.JSONDecodeError as e:
-                print(f"Error al procesar el JSON de Claude: {str(e)}")
-                print(f"Respuesta recibida: {identifiers_info}")
-                try:
-                    # Intentar procesar como texto plano si JSON falla
-                    print("Intentando procesar como texto plano...")
-                    lines = identifiers_info.strip().split('\n')
-                    
-                    # Crear diccionario para almacenar resultados
-                    invoice_data = {
-                        "valor_factura": "0.00",
-                        "fecha_vencimiento": "",
-                        "nombre_cliente": "",
-                        "identificadores": {}
-                    }
-                    
-                    # Procesar cada línea
-                    for line in lines:
-                        line = line.strip()
-                        if not line or ":" not in line:
-                            continue
-                            
-                        # Dividir en clave y valor
-                        key, value = [part.strip() for part in line.split(":", 1)]
-                        
-                        # Verificar si es un campo general
-                        if key.lower() in ["valor de la factura", "valor_factura", "monto"]:
-                            value = re.sub(r'[^\d.,]', '', value)
-                            invoice_data["valor_factura"] = value
-                            print(f"Valor de factura: {value}")
-                        elif key.lower() in ["fecha de vencimiento", "fecha_vencimiento"]:
-                            invoice_data["fecha_vencimiento"] = value
-                            print(f"Fecha de vencimiento: {value}")
-                        elif key.lower() in ["nombre del cliente", "nombre_cliente"]:
-                            invoice_data["nombre_cliente"] = value
-                            print(f"Nombre del cliente: {value}")
-                        else:
-                            # Buscar coincidencias para los identificadores
-                            for id_item in identifiers_to_find:
-                                description = id_item["description"]
-                                identifier_name = id_item["identifierName"]
-                                
-                                if key.lower() == description.lower():
-                                    clean_value = self.clean_identifier(value)
-                                    invoice_data["identificadores"][identifier_name] = clean_value
-                                    print(f"Encontrado {description}: {clean_value}")
-                                    break
-                    
-                    print("Datos extraídos mediante modo alternativo")
-                    
-                except Exception as e2:
-                    print(f"Error en el procesamiento alternativo: {str(e2)}")
-                    import traceback
-                    print(traceback.format_exc())
-                    return None
-            except Exception as e:
-                print(f"Error al procesar la respuesta de Claude: {str(e)}")
+            except Exception as e2:
+                print(f"Error en el procesamiento alternativo: {str(e2)}")
                 import traceback
                 print(traceback.format_exc())
                 return None
-                
-            # Asignar los identificadores a las modalidades
-            for modality in active_modalities:
-                modality_id = modality.get("modalityId", "")
-                modality["identifiers"] = {}
-                
-                # Buscar los identificadores correspondientes a esta modalidad
-                for id_item in identifiers_to_find:
-                    if id_item["modalityId"] == modality_id:
-                        identifier_name = id_item["identifierName"]
-                        valor = invoice_data.get("identificadores", {}).get(identifier_name, "")
-                        modality["identifiers"][identifier_name] = self.clean_identifier(valor)
-
-            # Construir el resultado final con solo los campos solicitados
-            simplified_modalities = []
-            for modality in active_modalities:
-                # Extraer las descripciones de queryData
-                query_data_descriptions = []
-                query_data = modality.get("queryData", [])
-                if isinstance(query_data, list):
-                    for qd_item in query_data:
-                        if isinstance(qd_item, dict) and "description" in qd_item:
-                            query_data_descriptions.append(qd_item["description"])
-                
-                # Extraer los identificadores encontrados
-                identifiers_dict = modality.get("identifiers", {})
-                
-                # Crear la estructura simplificada de modalidad
-                simplified_modality = {
-                    "modalityId": modality.get("modalityId", ""),
-                    "modalityType": modality.get("modalityType", ""),
-                    "modalityTitle": modality.get("modalityTitle", ""),
-                    "queryDataDescriptions": query_data_descriptions,
-                    "identifiersEncontrados": identifiers_dict
-                }
-                
-                simplified_modalities.append(simplified_modality)
-            
-            result = {
-                "companyName": company_info.get("companyName", ""),
-                "companyCode": company_code,
-                "category": category,
-                "modalities": simplified_modalities,
-                "valor_factura": invoice_data.get("valor_factura", "0.00"),
-                "fecha_vencimiento": invoice_data.get("fecha_vencimiento", ""),
-                "nombre_cliente": invoice_data.get("nombre_cliente", "")
+        except Exception as e:
+            print(f"Error al procesar la respuesta de Claude: {str(e)}")
+            import traceback
+            print(traceback.format_exc())
+            return None
+
+        return invoice_data
+
+    def partial_result(self, company_info, category, active_modalities, identifiers_to_find, error):
+        """Resultado sin identificadores, cuando el plazo se agota después de identificar la compañía."""
+        print(f"\n{str(error)}: se devuelve la compañía y sus modalidades sin identificadores")
+        invoice_data = {"valor_factura": "", "fecha_vencimiento": "", "nombre_cliente": "", "identificadores": {}}
+        result = self.build_result(company_info, category, active_modalities, identifiers_to_find, invoice_data)
+        result["partial"] = True
+        result["partialReason"] = "deadline_exceeded"
+        return result
+
+    def build_result(self, company_info, category, active_modalities, identifiers_to_find, invoice_data):
+        """Construye el resultado final con solo los campos solicitados."""
+        # Asignar los identificadores a las modalidades (sin modificar el catálogo compartido)
+        identifiers_by_modality = {}
+        for modality in active_modalities:
+            modality_id = modality.get("modalityId", "")
+            modality_identifiers = identifiers_by_modality.setdefault(modality_id, {})
+            
+            # Buscar los identificadores correspondientes a esta modalidad
+            for id_item in identifiers_to_find:
+                if id_item["modalityId"] == modality_id:
+                    identifier_name = id_item["identifierName"]
+                    valor = invoice_data.get("identificadores", {}).get(identifier_name, "")
+                    modality_identifiers[identifier_name] = self.clean_identifier(valor)
+
+        # Construir el resultado final con solo los campos solicitados
+        simplified_modalities = []
+        for modality in active_modalities:
+            # Extraer las descripciones de queryData
+            query_data_descriptions = []
+            query_data = modality.get("queryData", [])
+            if isinstance(query_data, list):
+                for qd_item in query_data:
+                    if isinstance(qd_item, dict) and "description" in qd_item:
+                        query_data_descriptions.append(qd_item["description"])
+            
+            # Extraer los identificadores encontrados
+            identifiers_dict = identifiers_by_modality.get(modality.get("modalityId", ""), {})
+            
+            # Crear la estructura simplificada de modalidad
+            simplified_modality = {
+                "modalityId": modality.get("modalityId", ""),
+                "modalityType": modality.get("modalityType", ""),
+                "modalityTitle": modality.get("modalityTitle", ""),
+                "queryDataDescriptions": query_data_descriptions,
+                "identifiersEncontrados": identifiers_dict
             }
             
+            simplified_modalities.append(simplified_modality)
+        
+        result = {
+            "companyName": company_info.get("companyName", ""),
+            "companyCode": company_info.get("companyCode", ""),
+            "category": category,
+            "modalities": simplified_modalities,
+            "valor_factura": invoice_data.get("valor_factura", "0.00"),
+            "fecha_vencimiento": invoice_data.get("fecha_vencimiento", ""),
+            "nombre_cliente": invoice_data.get("nombre_cliente", "")
+        }
+
+        return result
+
+    def analyze_invoice(self, image_path):
+        """Analiza una factura y extrae la información necesaria."""
+        try:
+            # Otra foto reciente de la misma factura: reutilizar el resultado guardado
+            near_duplicate = self.find_near_duplicate(image_path)
+
+            company_info = self.known_company(near_duplicate)
+            if company_info:
+                category = near_duplicate.category
+            else:
+                # Analizar la factura para identificar la compañía y su categoría
+                invoice_info = self.analyze_image(image_path, COMPANY_PROMPT, stage='company')
+                company = self.parse_company_response(invoice_info)
+                if company is None:
+                    return None
+                company_names, category, invoice_type = company
+
+                # Buscar la compañía en el JSON
+                company_info = self.select_company(company_names, category)
+                if not company_info:
+                    return None
+            usage_tracker.tag_company(company_info.get("companyCode", ""))
+
+            # Ya tenemos la compañía, procedemos con sus modalidades
+            active_modalities = self.get_active_modalities(company_info)
+            if not active_modalities:
+                return None
+
+            identifiers_to_find, identifiers_prompt = self.identifiers_plan(company_info, active_modalities)
+
+            # Obtener los datos de la factura usando Claude
+            print("\nConsultando a Claude para extraer los identificadores...")
+            try:
+                identifiers_info = self.analyze_image(image_path, identifiers_prompt, stage='identifiers')
+            except DeadlineExceeded as e:
+                return self.partial_result(company_info, category, active_modalities, identifiers_to_find, e)
+            invoice_data = self.parse_identifiers_response(identifiers_info, identifiers_to_find)
+            if invoice_data is None:
+                return None
+
+            result = self.build_result(company_info, category, active_modalities, identifiers_to_find, invoice_data)
+            # El hash no distingue facturas del mismo diseño: reutilizar solo con identificadores confirmados
+            result = self.confirm_reuse(near_duplicate, result)
+            near_duplicates.observe(near_duplicate, result)
+            
             print("\nResultado del análisis:")
             print(json.dumps(result, indent=2, ensure_ascii=False))
             
             return result
 
+        except (AdmissionRejected, DeadlineExceeded, cassette.CassetteMiss):
+            raise
         except Exception as e:
             print(f"Error al analizar la factura: {str(e)}")
             import traceback
             print(traceback.format_exc())
             return None
 
-def main():
+def run_worker(args):
+    """Consume la cola durable de análisis (ver job_queue.py) hasta recibir SIGTERM."""
+    from warmup import warm_up
+    from catalog_sync import start_catalog_sync
+    from job_queue import Worker, get_job_queue
+
+    # Catálogo, clientes y plantillas listos antes de tomar el primer trabajo
+    warm_up()
+    start_catalog_sync()
+    Worker(
+        get_job_queue(),
+        concurrency=args.concurrency,
+        poll_interval=args.poll_interval,
+        retention=float(os.getenv("JOB_RETENTION_DAYS", 7)) * 86400
+    ).run()
+
+def run_debt_refresh(args):
+    """Actualiza periódicamente las deudas de las cuentas del historial (ver debt_refresh.py)."""
+    from invoice_store import get_invoice_store
+    from debt_refresh import DebtRefresher
+
+    DebtRefresher.from_env(get_invoice_store()).run(verbose=args.verbose)
+
+def interactive():
     # Example usage
     analyzer = InvoiceAnalyzer()
     
@@ -936,5 +1186,37 @@ def main():
         print(f"\nError: No se encontró el archivo {image_path}")
         print("Por favor, verifica que la ruta sea correcta y el archivo exista.")
 
+def main():
+    parser = argparse.ArgumentParser(description="Analizador de facturas (sin argumentos, modo interactivo)")
+    commands = parser.add_subparsers(dest="command")
+    worker = commands.add_parser("worker", help="Procesar los análisis encolados con /analyze?async=1")
+    worker.add_argument("--concurrency", type=int, default=int(os.getenv("WORKER_CONCURRENCY", 4)),
+                        help="Trabajos simultáneos en este proceso")
+    worker.add_argument("--poll-interval", type=float, default=2.0,
+                        help="Espera máxima entre consultas a la cola vacía (segundos)")
+    batch = commands.add_parser("batch", help="Analizar directorios o patrones glob y escribir JSONL")
+    batch.add_argument("inputs", nargs="+", help="Directorios, archivos o patrones glob (entre comillas)")
+    batch.add_argument("--out", default="resultados.jsonl", help="Archivo JSONL de salida (se agrega al final)")
+    batch.add_argument("--checkpoint", help="Archivo de checkpoint (por defecto <out>.checkpoint)")
+    batch.add_argument("--jobs", type=int, default=4, help="Facturas analizadas en paralelo")
+    batch.add_argument("--debts", action="store_true", help="Consultar también las deudas en Tapila")
+    batch.add_argument("--debt-timeout", type=float, default=30.0, help="Plazo para las consultas de deuda")
+    batch.add_argument("--save", action="store_true", help="Guardar los resultados en el historial")
+    batch.add_argument("--retries", type=int, default=5, help="Reintentos si Anthropic está saturado")
+    batch.add_argument("--verbose", action="store_true", help="Mostrar el detalle de cada análisis")
+    refresh = commands.add_parser("refresh-debts", help="Actualizar periódicamente las deudas de las cuentas analizadas")
+    refresh.add_argument("--verbose", action="store_true", help="Mostrar el detalle de cada consulta a Tapila")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_worker(args)
+    elif args.command == "refresh-debts":
+        run_debt_refresh(args)
+    elif args.command == "batch":
+        from batch_runner import run_batch
+        sys.exit(run_batch(args))
+    else:
+        interactive()
+
 if __name__ == "__main__":
     main()
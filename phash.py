@@ -0,0 +1,296 @@
+"""
+Detección de facturas casi duplicadas por hash perceptual.
+
+Es común que el usuario saque una segunda foto de la misma factura con otro
+ángulo o recorte: los bytes cambian y el hash de contenido no la reconoce. Por
+eso a cada imagen se le calcula un dHash de 64 bits (en el pool de
+preprocesamiento) y los hashes del historial se indexan en un BK-tree por
+distancia de Hamming.
+
+Las facturas de una misma compañía comparten el diseño y quedan a pocos bits
+entre sí aunque sean de otro cliente o de otro mes (una foto repetida queda a
+2-5 bits; otra factura del mismo diseño, a 7-9 o incluso a 0). Por eso el
+hash nunca alcanza para devolver el resultado de otra subida: con una
+coincidencia casi exacta y reciente se omite la identificación de la compañía
+y el resultado guardado solo se reutiliza si la extracción de identificadores
+(una llamada) los confirma; con una coincidencia cercana se omite solo la
+identificación de la compañía. El modo por defecto es shadow (se mide sin
+aplicar atajos). Una fracción de las coincidencias (NEAR_DUP_CONTROL_FRACTION)
+se analiza completa como grupo de control, para medir en
+/metrics/near-duplicates cuántas llamadas se ahorran y con qué frecuencia el
+atajo habría acertado.
+"""
+
+import os
+import time
+import random
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Lado de la grilla del dHash: 8x8 = 64 bits (una grilla mayor es sensible al recorte)
+HASH_SIZE = 8
+
+MODES = ('on', 'shadow', 'off')
+
+# Campos del resultado que deben coincidir para considerar correcta la reutilización
+COMPARED_FIELDS = ('companyCode', 'nombre_cliente', 'fecha_vencimiento', 'valor_factura')
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """Difference hash de una imagen de Pillow: compara cada píxel con su vecino derecho."""
+    from PIL import Image
+
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    # Un byte por píxel en modo L (getdata está obsoleto en Pillow)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Árbol BK sobre la distancia de Hamming; cada nodo guarda los elementos con el mismo hash."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            node_value, items, children = node
+            distance = hamming(value, node_value)
+            if distance == 0:
+                items.append(item)
+                return
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Elementos a distancia <= max_distance, como lista de (distancia, elemento)."""
+        found = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node_value, items, children = pending.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.extend((distance, item) for item in items)
+            # Desigualdad triangular: solo pueden estar cerca los hijos en este rango
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class IndexedInvoice:
+    def __init__(self, invoice_id, company_code, category, created_at):
+        self.invoice_id = invoice_id
+        self.company_code = company_code
+        self.category = category
+        self.created_at = created_at
+
+
+class NearDuplicateMatch:
+    """Factura del historial parecida a la subida y atajo que corresponde aplicar."""
+
+    def __init__(self, kind, invoice, distance, applied, result=None):
+        # 'reuse' (se reutiliza el resultado) o 'company' (solo se omite la identificación)
+        self.kind = kind
+        self.invoice_id = invoice.invoice_id
+        self.company_code = invoice.company_code
+        self.category = invoice.category
+        self.distance = distance
+        # False en el grupo de control: se analiza completa y se compara
+        self.applied = applied
+        self.result = result
+        # Con 'reuse' aplicado: si los identificadores extraídos confirmaron el resultado guardado
+        self.confirmed = None
+
+    def summary(self):
+        return {
+            'kind': self.kind,
+            'invoiceId': self.invoice_id,
+            'distance': self.distance,
+            'applied': self.applied,
+            'confirmed': self.confirmed
+        }
+
+
+def identifier_fields(result):
+    """Identificadores de un resultado, por modalidad: {"modalidad.identificador": valor}."""
+    fields = {}
+    for modality in (result or {}).get('modalities', []):
+        for name, value in (modality.get('identifiersEncontrados') or {}).items():
+            fields[f"{modality.get('modalityId')}.{name}"] = value
+    return fields
+
+
+def result_fields(result):
+    """Campos comparables de un resultado: datos generales e identificadores por modalidad."""
+    if not result:
+        return {}
+    fields = {name: result.get(name) for name in COMPARED_FIELDS}
+    fields.update(identifier_fields(result))
+    return fields
+
+
+def confirms(result, stored):
+    """Indica si los identificadores extraídos confirman que stored es la misma factura."""
+    extracted = identifier_fields(result)
+    # Sin ningún identificador leído no hay nada que confirme la coincidencia
+    if not any(extracted.values()):
+        return False
+    return (
+        extracted == identifier_fields(stored)
+        and result.get('companyCode') == stored.get('companyCode')
+    )
+
+
+def _counters():
+    return {'candidates': 0, 'applied': 0, 'confirmed': 0, 'rejected': 0, 'control': 0, 'agreed': 0, 'disagreed': 0}
+
+
+class NearDuplicateIndex:
+    def __init__(self, mode='shadow', reuse_distance=4, company_distance=12,
+                 reuse_window=900.0, control_fraction=0.1):
+        self.mode = mode if mode in MODES else 'shadow'
+        self.reuse_distance = reuse_distance
+        self.company_distance = max(company_distance, reuse_distance)
+        # Solo se reutilizan fotos recientes: otra factura de la compañía tiene el mismo diseño
+        self.reuse_window = reuse_window
+        self.control_fraction = control_fraction
+        self._tree = BKTree()
+        self._indexed = set()
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.misses = 0
+        self.unhashed = 0
+        self.counters = {'reuse': _counters(), 'company': _counters()}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            mode=os.environ.get('NEAR_DUP_MODE', 'shadow').lower(),
+            reuse_distance=int(os.environ.get('NEAR_DUP_REUSE_DISTANCE', 4)),
+            company_distance=int(os.environ.get('NEAR_DUP_COMPANY_DISTANCE', 12)),
+            reuse_window=float(os.environ.get('NEAR_DUP_REUSE_WINDOW', 900)),
+            control_fraction=float(os.environ.get('NEAR_DUP_CONTROL_FRACTION', 0.1))
+        )
+
+    def _store(self):
+        from invoice_store import get_invoice_store
+        return get_invoice_store()
+
+    def _refresh(self):
+        """Agrega al árbol los hashes guardados desde la última consulta (también por otros workers)."""
+        rows = self._store().perceptual_hashes(after_id=self._last_id)
+        with self._lock:
+            for row in rows:
+                self._last_id = max(self._last_id, row['invoice_id'])
+                if row['invoice_id'] in self._indexed:
+                    continue
+                self._indexed.add(row['invoice_id'])
+                invoice = IndexedInvoice(row['invoice_id'], row['company_code'], row['category'], row['created_at'])
+                self._tree.add(int(row['perceptual_hash'], 16), invoice)
+
+    def lookup(self, perceptual_hash):
+        """Busca la factura más parecida del historial; devuelve un NearDuplicateMatch o None."""
+        if self.mode == 'off':
+            return None
+        if perceptual_hash is None:
+            # PDF o imagen sin hash: no hay con qué comparar
+            with self._lock:
+                self.unhashed += 1
+            return None
+
+        self._refresh()
+        with self._lock:
+            self.lookups += 1
+            candidates = self._tree.search(perceptual_hash, self.company_distance)
+            if not candidates:
+                self.misses += 1
+                return None
+
+        now = time.time()
+        recent = [
+            (distance, invoice) for distance, invoice in candidates
+            if distance <= self.reuse_distance and now - invoice.created_at <= self.reuse_window
+        ]
+        applied = self.mode == 'on' and random.random() >= self.control_fraction
+        if recent:
+            distance, invoice = min(recent, key=lambda candidate: (candidate[0], -candidate[1].invoice_id))
+            stored = self._store().get(invoice.invoice_id)
+            if stored is not None:
+                return NearDuplicateMatch('reuse', invoice, distance, applied, stored['data'])
+
+        distance, invoice = min(candidates, key=lambda candidate: (candidate[0], -candidate[1].invoice_id))
+        return NearDuplicateMatch('company', invoice, distance, applied)
+
+    def observe(self, match, result):
+        """Registra el atajo aplicado o, en el grupo de control, si habría acertado."""
+        if match is None:
+            return
+        with self._lock:
+            counters = self.counters[match.kind]
+            counters['candidates'] += 1
+            if match.applied:
+                counters['applied'] += 1
+                if match.kind == 'reuse':
+                    # Reutilizaciones que la extracción de identificadores confirmó o descartó
+                    counters['confirmed' if match.confirmed else 'rejected'] += 1
+                return
+            counters['control'] += 1
+            if not result:
+                return
+            if match.kind == 'reuse':
+                agreed = result_fields(result) == result_fields(match.result)
+            else:
+                agreed = result.get('companyCode') == match.company_code
+            counters['agreed' if agreed else 'disagreed'] += 1
+
+    def stats(self):
+        with self._lock:
+            reuse = dict(self.counters['reuse'])
+            company = dict(self.counters['company'])
+            return {
+                'mode': self.mode,
+                'indexed': len(self._tree),
+                'lookups': self.lookups,
+                'misses': self.misses,
+                'unhashed': self.unhashed,
+                'reuse': reuse,
+                'company': company,
+                # Los dos atajos evitan la llamada de identificación de la compañía
+                'callsSaved': reuse['applied'] + company['applied'],
+                'thresholds': {
+                    'reuseDistance': self.reuse_distance,
+                    'companyDistance': self.company_distance,
+                    'reuseWindowSeconds': self.reuse_window,
+                    'controlFraction': self.control_fraction
+                }
+            }
+
+
+# Índice compartido por el proceso; se completa desde el historial en la primera búsqueda
+near_duplicates = NearDuplicateIndex.from_env()
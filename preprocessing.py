@@ -0,0 +1,256 @@
+"""
+Preparación de las facturas antes de enviarlas a Claude.
+
+Leer, calcular el hash, decodificar, redimensionar y codificar en base64 una
+captura PNG grande o un PDF de varias páginas consume CPU y retiene el GIL,
+frenando a los demás hilos del worker. Ese trabajo se hace en un pool de
+procesos (PREPROCESS_WORKERS; por defecto, los núcleos repartidos entre los
+WEB_CONCURRENCY workers, porque cada uno crea su propio pool). El resultado
+vuelve por memoria compartida en lugar de serializarse con pickle. Cuando el pool
+está saturado las solicitudes esperan hasta PREPROCESS_MAX_WAIT segundos y
+después se rechazan con AdmissionRejected.
+"""
+
+import io
+import os
+import base64
+import asyncio
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from dotenv import load_dotenv
+
+import phash
+from rate_limiter import AdmissionRejected
+from upload_validation import sniff_extension
+from deadline import bounded_wait, require_budget
+
+# Load environment variables
+load_dotenv()
+
+# Lado máximo recomendado por Anthropic: las imágenes más grandes se reducen del lado del servidor
+MAX_IMAGE_SIDE = int(os.environ.get('PREPROCESS_MAX_IMAGE_SIDE', 1568))
+JPEG_QUALITY = 85
+
+MEDIA_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.pdf': 'application/pdf'
+}
+
+
+class PreparedImage:
+    """Factura lista para el mensaje: base64, tipo de contenido y metadatos."""
+
+    def __init__(self, data, media_type, sha256, original_size, width=None, height=None, resized=False,
+                 perceptual_hash=None):
+        self.data = data
+        self.media_type = media_type
+        self.sha256 = sha256
+        self.original_size = original_size
+        self.width = width
+        self.height = height
+        self.resized = resized
+        # dHash para detectar otra foto de la misma factura (None en los PDF)
+        self.perceptual_hash = perceptual_hash
+
+    @property
+    def is_document(self):
+        return self.media_type == 'application/pdf'
+
+
+def media_type_for(path):
+    _, ext = os.path.splitext(path)
+    return MEDIA_TYPES.get(ext.lower(), 'image/jpeg')
+
+
+def _downscale(image, raw, media_type, max_side):
+    """Reduce la imagen si supera max_side; devuelve (bytes, media_type, ancho, alto, redimensionada)."""
+    from PIL import Image
+
+    width, height = image.size
+    if max(width, height) <= max_side:
+        return raw, media_type, width, height, False
+
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P') and media_type == 'image/png':
+        image.save(output, format='PNG', optimize=False)
+    else:
+        image.convert('RGB').save(output, format='JPEG', quality=JPEG_QUALITY)
+        media_type = 'image/jpeg'
+    return output.getvalue(), media_type, image.size[0], image.size[1], True
+
+
+def prepare_file(path, max_side=MAX_IMAGE_SIDE):
+    """Trabajo de CPU de la preparación: hashes, redimensionado y base64 (sin pool)."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    # El tipo real según los primeros bytes: Claude rechaza un PNG enviado como image/jpeg
+    media_type = MEDIA_TYPES.get(sniff_extension(raw)) or media_type_for(path)
+    meta = {
+        'media_type': media_type,
+        'sha256': hashlib.sha256(raw).hexdigest(),
+        'original_size': len(raw),
+        'width': None,
+        'height': None,
+        'resized': False,
+        'perceptual_hash': None
+    }
+    if media_type != 'application/pdf':
+        from PIL import Image
+
+        with Image.open(io.BytesIO(raw)) as image:
+            raw, meta['media_type'], meta['width'], meta['height'], meta['resized'] = _downscale(
+                image, raw, media_type, max_side
+            )
+            meta['perceptual_hash'] = phash.dhash(image)
+    return base64.b64encode(raw), meta
+
+
+def _prepare_in_worker(path, max_side):
+    """Ejecuta prepare_file en el pool y deja el base64 en un bloque de memoria compartida."""
+    data, meta = prepare_file(path, max_side)
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        block.buf[:len(data)] = data
+    finally:
+        block.close()
+    return block.name, len(data), meta
+
+
+def _read_shared(name, size):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _discard(future):
+    """Libera la memoria compartida de un resultado que nadie va a leer."""
+    if not future.cancelled() and future.exception() is None:
+        name, size, _ = future.result()
+        _read_shared(name, size)
+
+
+def default_workers():
+    """Núcleos por worker de gunicorn: cada worker crea su propio pool."""
+    web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(1, (os.cpu_count() or 1) // web_workers)
+
+
+def _prepared(data, meta):
+    return PreparedImage(
+        data.decode('ascii'), meta['media_type'], meta['sha256'], meta['original_size'],
+        meta['width'], meta['height'], meta['resized'], meta['perceptual_hash']
+    )
+
+
+class Preprocessor:
+    def __init__(self, workers, max_wait=10.0, max_side=MAX_IMAGE_SIDE):
+        self.workers = workers
+        self.max_wait = max_wait
+        self.max_side = max_side
+        # Trabajos admitidos a la vez: los del pool más una cola corta
+        self._slots = threading.BoundedSemaphore(max(1, workers * 2))
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.rejected = 0
+        self.completed = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.environ.get('PREPROCESS_WORKERS', default_workers())),
+            max_wait=float(os.environ.get('PREPROCESS_MAX_WAIT', 10))
+        )
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # forkserver/spawn: hacer fork de un proceso con hilos activos no es seguro
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+    def _reset_pool(self):
+        with self._pool_lock:
+            self._pool = None
+
+    def _acquire(self):
+        # La espera por el pool no pasa del plazo de la solicitud
+        if not self._slots.acquire(timeout=bounded_wait(self.max_wait)):
+            require_budget(0.05, 'preprocess')
+            self.rejected += 1
+            raise AdmissionRejected(self.max_wait, reason="preprocess_saturated")
+
+    def _release_abandoned(self, acquiring):
+        """Devuelve el lugar que el hilo obtuvo después de que la solicitud se canceló."""
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            self._slots.release()
+
+    def _finish(self, result):
+        name, size, meta = result
+        self.completed += 1
+        return _prepared(_read_shared(name, size), meta)
+
+    def prepare(self, path):
+        """Prepara la factura en el pool (o en línea con PREPROCESS_WORKERS=0)."""
+        if self.workers <= 0:
+            return _prepared(*prepare_file(path, self.max_side))
+
+        self._acquire()
+        try:
+            return self._finish(self._get_pool().submit(_prepare_in_worker, path, self.max_side).result())
+        except BrokenProcessPool:
+            # Un worker murió (p. ej. por memoria): recrear el pool en la próxima solicitud
+            self._reset_pool()
+            raise
+        finally:
+            self._slots.release()
+
+    async def prepare_async(self, path):
+        if self.workers <= 0:
+            return _prepared(*(await asyncio.to_thread(prepare_file, path, self.max_side)))
+
+        # El hilo sigue esperando aunque se cancele la solicitud: si obtiene el lugar, se devuelve al terminar
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self._acquire))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(self._release_abandoned)
+            raise
+        try:
+            future = self._get_pool().submit(_prepare_in_worker, path, self.max_side)
+            try:
+                result = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                future.add_done_callback(_discard)
+                raise
+            return self._finish(result)
+        except BrokenProcessPool:
+            self._reset_pool()
+            raise
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'started': self._pool is not None,
+            'completed': self.completed,
+            'rejected': self.rejected
+        }
+
+
+# Pool compartido por el proceso; se crea en el primer uso (después del fork de gunicorn)
+preprocessor = Preprocessor.from_env()
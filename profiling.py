@@ -0,0 +1,261 @@
+"""
+Perfilado a pedido de solicitudes individuales.
+
+Un administrador (cabecera X-Admin-Token igual a PROFILE_ADMIN_TOKEN) puede
+pedir el perfil de una solicitud con la cabecera `X-Profile: sampling|trace`
+o el parámetro `?profile=`. El modo sampling toma muestras de la pila del
+hilo cada PROFILE_SAMPLE_INTERVAL segundos (tiempo de pared, bajo costo); el
+modo trace registra cada llamada con sys.setprofile (exacto, más lento).
+
+Los perfiles se guardan en PROFILE_DIR (compartido entre workers) como pilas
+plegadas, el formato que aceptan flamegraph.pl y speedscope.
+"""
+
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import uuid
+import tempfile
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+MODES = ('sampling', 'trace')
+
+# Cantidad de perfiles que se conservan en disco
+DEFAULT_MAX_PROFILES = 50
+
+# Cada cuántos perfiles guardados se eliminan los que sobran (recorrer el directorio no es gratis)
+PRUNE_EVERY = 10
+
+# Profundidad máxima de las pilas registradas
+MAX_STACK_DEPTH = 128
+
+# Ids aceptados (también se usan como nombre de archivo)
+PROFILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+
+
+def _stack_of(frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return ';'.join(stack)
+
+
+class SamplingProfiler:
+    """Muestrea periódicamente la pila de un hilo desde un hilo auxiliar."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = _stack_of(frame)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        # Cada muestra representa `interval` segundos de pared
+        weight = int(self.interval * 1_000_000)
+        return {stack: count * weight for stack, count in self.stacks.items()}
+
+
+class TracingProfiler:
+    """Registra el tiempo propio de cada función con sys.setprofile en el hilo actual."""
+
+    def __init__(self):
+        self.stacks = {}
+        self.samples = 0
+        self._names = []
+        self._started = []
+        self._child_time = []
+        self._previous = None
+
+    def _callback(self, frame, event, arg):
+        now = time.perf_counter()
+        if event in ('call', 'c_call'):
+            name = _frame_name(frame.f_code) if event == 'call' else f"builtin:{getattr(arg, '__qualname__', arg)}"
+            self._names.append(name)
+            self._started.append(now)
+            self._child_time.append(0.0)
+            self.samples += 1
+        elif event in ('return', 'c_return', 'c_exception') and self._names:
+            elapsed = now - self._started.pop()
+            own = elapsed - self._child_time.pop()
+            stack = ';'.join(self._names[-MAX_STACK_DEPTH:])
+            self.stacks[stack] = self.stacks.get(stack, 0) + int(own * 1_000_000)
+            self._names.pop()
+            if self._child_time:
+                self._child_time[-1] += elapsed
+
+    def start(self):
+        self._previous = sys.getprofile()
+        sys.setprofile(self._callback)
+
+    def stop(self):
+        sys.setprofile(self._previous)
+        return {stack: micros for stack, micros in self.stacks.items() if micros > 0}
+
+
+class ProfileStore:
+    def __init__(self, directory, max_profiles=DEFAULT_MAX_PROFILES):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id):
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def save(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+        # Temporal propio: dos workers pueden guardar el mismo id (X-Request-Id) a la vez
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(profile, f)
+            os.replace(temp_path, self._path(profile['id']))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        with self._lock:
+            self._saved += 1
+            prune = self._saved % PRUNE_EVERY == 1
+        if prune:
+            self._prune()
+
+    def _files(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        except FileNotFoundError:
+            return []
+        modified = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                modified.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                # Otro worker lo eliminó mientras se recorría el directorio
+                continue
+        return [path for _, path in sorted(modified, reverse=True)]
+
+    def _prune(self):
+        for path in self._files()[self.max_profiles:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, profile_id):
+        if not profile_id or not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list(self):
+        summaries = []
+        for path in self._files():
+            try:
+                with open(path, 'r') as f:
+                    profile = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            profile.pop('stacks', None)
+            summaries.append(profile)
+        return summaries
+
+
+def folded(profile):
+    """Pilas plegadas ("a;b;c valor" por línea) para flamegraph.pl o speedscope."""
+    lines = [f"{stack} {value}" for stack, value in sorted(profile['stacks'].items())]
+    return '\n'.join(lines) + '\n'
+
+
+class RequestProfiler:
+    def __init__(self, admin_token, directory, interval=0.005, max_profiles=DEFAULT_MAX_PROFILES):
+        self.admin_token = admin_token
+        self.interval = interval
+        self.store = ProfileStore(directory, max_profiles)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            admin_token=os.environ.get('PROFILE_ADMIN_TOKEN', ''),
+            directory=os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'invoice-profiles')),
+            interval=float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005)),
+            max_profiles=int(os.environ.get('PROFILE_MAX_STORED', DEFAULT_MAX_PROFILES))
+        )
+
+    def is_admin(self, headers):
+        """Sin PROFILE_ADMIN_TOKEN configurado nadie es administrador."""
+        token = headers.get('X-Admin-Token', '')
+        return bool(self.admin_token) and hmac.compare_digest(token.encode(), self.admin_token.encode())
+
+    def requested_mode(self, headers, params):
+        """Modo de perfilado pedido por un administrador, o None."""
+        mode = headers.get('X-Profile') or params.get('profile')
+        if not mode or not self.is_admin(headers):
+            return None
+        mode = mode.lower()
+        if mode in ('1', 'true'):
+            return 'sampling'
+        return mode if mode in MODES else None
+
+    @contextmanager
+    def profile(self, mode, path, request_id=None):
+        """Perfila el bloque y guarda el resultado; el registro incluye el id asignado."""
+        record = {
+            'id': request_id if request_id and PROFILE_ID_PATTERN.match(request_id) else uuid.uuid4().hex[:16],
+            'path': path,
+            'mode': mode,
+            'startedAt': time.time()
+        }
+        profiler = SamplingProfiler(threading.get_ident(), self.interval) if mode == 'sampling' else TracingProfiler()
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        profiler.start()
+        try:
+            yield record
+        finally:
+            stacks = profiler.stop()
+            record['wallSeconds'] = round(time.perf_counter() - wall_started, 4)
+            record['cpuSeconds'] = round(time.thread_time() - cpu_started, 4)
+            record['samples'] = profiler.samples
+            record['unit'] = 'microseconds'
+            record['stacks'] = stacks
+            try:
+                self.store.save(record)
+            except OSError as e:
+                print(f"Error al guardar el perfil {record['id']}: {str(e)}")
+
+
+# Perfilador compartido por el proceso
+request_profiler = RequestProfiler.from_env()
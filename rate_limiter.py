@@ -0,0 +1,274 @@
+"""
+Control de admisión hacia la API de Anthropic.
+
+Combina buckets de tokens (solicitudes, tokens de entrada y tokens de salida
+por minuto) con un límite de concurrencia adaptativo (AIMD) que se reduce
+ante respuestas 429/529. Cuando la cola de espera está llena, las solicitudes
+se rechazan de inmediato con un tiempo sugerido de reintento.
+"""
+
+import os
+import math
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from dotenv import load_dotenv
+
+from deadline import current_deadline
+
+# Load environment variables
+load_dotenv()
+
+# Códigos de estado con los que Anthropic indica límite de tasa o sobrecarga
+OVERLOAD_STATUS_CODES = {429, 529}
+
+# Estimación de tokens de una imagen cuando no se conoce su tamaño
+DEFAULT_IMAGE_TOKENS = 1600
+
+
+class AdmissionRejected(Exception):
+    """La solicitud no puede admitirse ahora; reintentar tras retry_after segundos."""
+
+    def __init__(self, retry_after, reason="queue_full"):
+        super().__init__(f"Solicitud rechazada por control de admisión ({reason})")
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Segundos hasta que haya `amount` tokens disponibles (0 si ya los hay)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta):
+        """Corrige el saldo con el consumo real (puede quedar negativo)."""
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class AdaptiveConcurrencyLimit:
+    """Límite de concurrencia con incremento aditivo y reducción multiplicativa."""
+
+    def __init__(self, initial, minimum=1, maximum=64, backoff=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.limit = float(max(minimum, min(initial, maximum)))
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self):
+        self.limit = max(self.minimum, self.limit * self.backoff)
+
+    def current(self):
+        return int(self.limit)
+
+
+class LimiterSlot:
+    def __init__(self, estimated_input, estimated_output):
+        self.estimated_input = estimated_input
+        self.estimated_output = estimated_output
+        self.usage = None
+        self.overloaded = False
+        self.retry_after = None
+
+    def record_usage(self, usage):
+        """Registra el `message.usage` devuelto por Anthropic."""
+        self.usage = usage
+
+    def mark_overloaded(self, retry_after=None):
+        self.overloaded = True
+        self.retry_after = retry_after
+
+
+class AnthropicLimiter:
+    def __init__(self, requests_per_minute=0, input_tokens_per_minute=0,
+                 output_tokens_per_minute=0, initial_concurrency=8,
+                 max_concurrency=64, max_queue=32, max_wait=20.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.input_tokens = TokenBucket(input_tokens_per_minute) if input_tokens_per_minute else None
+        self.output_tokens = TokenBucket(output_tokens_per_minute) if output_tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrencyLimit(initial_concurrency, maximum=max_concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            requests_per_minute=int(os.environ.get('ANTHROPIC_RPM', 0)),
+            input_tokens_per_minute=int(os.environ.get('ANTHROPIC_ITPM', 0)),
+            output_tokens_per_minute=int(os.environ.get('ANTHROPIC_OTPM', 0)),
+            initial_concurrency=int(os.environ.get('ANTHROPIC_CONCURRENCY', 8)),
+            max_concurrency=int(os.environ.get('ANTHROPIC_MAX_CONCURRENCY', 64)),
+            max_queue=int(os.environ.get('ANTHROPIC_MAX_QUEUE', 32)),
+            max_wait=float(os.environ.get('ANTHROPIC_MAX_WAIT', 20))
+        )
+
+    def _buckets(self, estimated_input, estimated_output):
+        return [(bucket, amount) for bucket, amount in (
+            (self.requests, 1),
+            (self.input_tokens, estimated_input),
+            (self.output_tokens, estimated_output)
+        ) if bucket is not None]
+
+    def _try_acquire(self, slot):
+        """Intenta reservar capacidad; devuelve 0 si lo logra o los segundos a esperar."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= self.concurrency.current():
+            # Se libera al terminar otra llamada; se reintenta al recibir la notificación
+            return 0.5
+        buckets = self._buckets(slot.estimated_input, slot.estimated_output)
+        wait = max([bucket.wait_time(amount, now) for bucket, amount in buckets] or [0.0])
+        if wait > 0:
+            return wait
+        for bucket, amount in buckets:
+            bucket.consume(amount)
+        self.in_flight += 1
+        return 0.0
+
+    def _retry_after_locked(self):
+        now = time.monotonic()
+        return max(1.0, self.blocked_until - now)
+
+    def check_admission(self):
+        """Rechaza de inmediato si la cola de espera ya está llena."""
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                raise AdmissionRejected(self._retry_after_locked())
+
+    def acquire(self, slot):
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                raise AdmissionRejected(self._retry_after_locked())
+            self.waiting += 1
+            try:
+                request_deadline = current_deadline()
+                deadline = time.monotonic() + self.max_wait
+                while True:
+                    wait = self._try_acquire(slot)
+                    if wait == 0:
+                        return slot
+                    remaining = deadline - time.monotonic()
+                    if wait > remaining:
+                        raise AdmissionRejected(wait, reason="rate_limited")
+                    # No esperar turno más allá del plazo de la solicitud
+                    if request_deadline is not None:
+                        request_deadline.require(0.05, 'anthropic_queue')
+                        wait = min(wait, request_deadline.remaining())
+                    self._changed.wait(wait)
+            finally:
+                self.waiting -= 1
+
+    async def acquire_async(self, slot):
+        """Variante para asyncio: espera sin bloquear el event loop."""
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                raise AdmissionRejected(self._retry_after_locked())
+            self.waiting += 1
+        try:
+            request_deadline = current_deadline()
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                with self._lock:
+                    wait = self._try_acquire(slot)
+                if wait == 0:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if wait > remaining:
+                    raise AdmissionRejected(wait, reason="rate_limited")
+                if request_deadline is not None:
+                    request_deadline.require(0.05, 'anthropic_queue')
+                await asyncio.sleep(min(wait, 0.05))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def release(self, slot):
+        with self._lock:
+            self.in_flight -= 1
+            usage = slot.usage
+            if usage is not None:
+                # Corregir las reservas estimadas con el consumo real
+                if self.input_tokens is not None:
+                    self.input_tokens.adjust(getattr(usage, 'input_tokens', 0) - slot.estimated_input)
+                if self.output_tokens is not None:
+                    self.output_tokens.adjust(getattr(usage, 'output_tokens', 0) - slot.estimated_output)
+            if slot.overloaded:
+                self.concurrency.on_overload()
+                pause = slot.retry_after if slot.retry_after else 1.0
+                self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            elif usage is not None:
+                self.concurrency.on_success()
+            self._changed.notify_all()
+
+    @contextmanager
+    def slot(self, estimated_input, estimated_output):
+        """Reserva capacidad para una llamada a Anthropic durante el bloque."""
+        slot = self.acquire(LimiterSlot(estimated_input, estimated_output))
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    @asynccontextmanager
+    async def async_slot(self, estimated_input, estimated_output):
+        slot = await self.acquire_async(LimiterSlot(estimated_input, estimated_output))
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'concurrency_limit': self.concurrency.current(),
+                'blocked_for': max(0.0, self.blocked_until - time.monotonic())
+            }
+
+
+def estimate_input_tokens(prompt, image_count=1):
+    """Estimación conservadora de tokens de entrada para un prompt con imágenes."""
+    return len(prompt) // 3 + image_count * DEFAULT_IMAGE_TOKENS
+
+
+def overload_retry_after(error):
+    """Devuelve el Retry-After de un error 429/529 de Anthropic, o None si no lo es."""
+    if getattr(error, 'status_code', None) not in OVERLOAD_STATUS_CODES:
+        return None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after', 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+# Limitador compartido por todos los hilos del proceso
+anthropic_limiter = AnthropicLimiter.from_env()
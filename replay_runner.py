@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Ejecuta el análisis completo sobre un corpus de facturas usando grabaciones.
+
+Ejemplos:
+
+    # Grabar una vez el corpus (requiere red y credenciales)
+    python3 replay_runner.py facturas/ --mode record --out baseline.json --debts
+
+    # Reproducir sin red y comparar con la línea base
+    python3 replay_runner.py facturas/ --mode replay --out candidato.json --baseline baseline.json
+
+Un cambio de prompt o de modelo cambia la huella de las solicitudes: se graba
+con --mode auto (solo salen a la red las solicitudes nuevas) y a partir de ahí
+ambas variantes se reproducen sin red.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import statistics
+from contextlib import redirect_stdout
+
+import cassette
+
+SUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.pdf'}
+
+# Campos del resultado que se comparan con la línea base
+COMPARED_FIELDS = ('companyCode', 'nombre_cliente', 'fecha_vencimiento', 'valor_factura')
+
+
+def corpus_files(corpus):
+    if os.path.isfile(corpus):
+        return [corpus]
+    return sorted(
+        os.path.join(corpus, name) for name in os.listdir(corpus)
+        if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS
+    )
+
+
+def run_one(analyzer, path, with_debts):
+    """Analiza una factura (y opcionalmente consulta sus deudas) midiendo el tiempo."""
+    output = io.StringIO()
+    started = time.monotonic()
+    error = None
+    result = None
+    debts = {}
+    try:
+        with redirect_stdout(output):
+            result = analyzer.analyze_invoice(path)
+            if with_debts and result:
+                for modality in result.get('modalities', []):
+                    query_data = analyzer.debt_query_data(modality)
+                    if query_data:
+                        debts[modality['modalityId']] = analyzer.consult_debt(
+                            result['companyCode'], modality['modalityId'], query_data
+                        )
+    except cassette.CassetteMiss as e:
+        error = str(e)
+    except Exception as e:
+        error = f"{type(e).__name__}: {str(e)}"
+    return {
+        'result': result,
+        'debts': debts,
+        'seconds': round(time.monotonic() - started, 4),
+        'error': error or (None if result else 'No se pudieron extraer datos de la factura')
+    }
+
+
+def invoice_fields(result):
+    """Campos comparables de un resultado: datos generales e identificadores por modalidad."""
+    if not result:
+        return {}
+    fields = {name: result.get(name) for name in COMPARED_FIELDS}
+    for modality in result.get('modalities', []):
+        for name, value in (modality.get('identifiersEncontrados') or {}).items():
+            fields[f"{modality.get('modalityId')}.{name}"] = value
+    return fields
+
+
+def timing_summary(seconds):
+    if not seconds:
+        return {'count': 0}
+    ordered = sorted(seconds)
+    return {
+        'count': len(ordered),
+        'total': round(sum(ordered), 4),
+        'mean': round(statistics.mean(ordered), 4),
+        'p50': round(ordered[len(ordered) // 2], 4),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4)
+    }
+
+
+def compare(runs, baseline_runs):
+    """Exactitud por campo contra la línea base y diferencia de tiempos."""
+    matched = 0
+    total = 0
+    invoices = {}
+    for name, run in runs.items():
+        baseline = baseline_runs.get(name)
+        if baseline is None:
+            continue
+        expected = invoice_fields(baseline.get('result'))
+        actual = invoice_fields(run.get('result'))
+        mismatches = {
+            field: {'baseline': value, 'actual': actual.get(field)}
+            for field, value in expected.items() if actual.get(field) != value
+        }
+        matched += len(expected) - len(mismatches)
+        total += len(expected)
+        invoices[name] = {
+            'fields': len(expected),
+            'mismatches': mismatches,
+            'secondsDelta': round(run['seconds'] - baseline['seconds'], 4)
+        }
+
+    common = [name for name in runs if name in baseline_runs]
+    current = timing_summary([runs[name]['seconds'] for name in common])
+    previous = timing_summary([baseline_runs[name]['seconds'] for name in common])
+    return {
+        'invoices': len(common),
+        'fieldAccuracy': round(matched / total, 4) if total else None,
+        'timing': current,
+        'baselineTiming': previous,
+        'meanDelta': round(current['mean'] - previous['mean'], 4) if common else None,
+        'p95Delta': round(current['p95'] - previous['p95'], 4) if common else None,
+        'details': invoices
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Análisis de un corpus de facturas con grabación/reproducción")
+    parser.add_argument('corpus', help="Archivo o directorio con facturas")
+    parser.add_argument('--mode', choices=cassette.MODES, default='replay')
+    parser.add_argument('--cassettes', default=os.environ.get('CASSETTE_DIR', 'cassettes'))
+    parser.add_argument('--simulate-latency', action='store_true', help="Reproducir la latencia grabada")
+    parser.add_argument('--debts', action='store_true', help="Consultar también las deudas en Tapila")
+    parser.add_argument('--out', help="Archivo JSON donde guardar los resultados")
+    parser.add_argument('--baseline', help="Resultados de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    # La grabación debe configurarse antes de crear los clientes compartidos
+    recording = cassette.configure(args.mode, args.cassettes, args.simulate_latency)
+    from pdf_analyzer import InvoiceAnalyzer
+    from phash import near_duplicates
+    # Cada factura del corpus se analiza completa, sin atajos por facturas similares del historial
+    near_duplicates.mode = 'off'
+
+    runs = {}
+    files = corpus_files(args.corpus)
+    for index, path in enumerate(files, 1):
+        name = os.path.basename(path)
+        # Una instancia por factura, como por solicitud: guarda el base64 preparado de su factura
+        runs[name] = run_one(InvoiceAnalyzer(), path, args.debts)
+        status = 'OK' if runs[name]['error'] is None else f"ERROR: {runs[name]['error']}"
+        print(f"[{index}/{len(files)}] {name} {runs[name]['seconds']}s {status}")
+
+    report = {
+        'mode': args.mode,
+        'timing': timing_summary([run['seconds'] for run in runs.values()]),
+        'failures': sum(1 for run in runs.values() if run['error']),
+        'cassette': recording.stats(),
+        'runs': runs
+    }
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        report['comparison'] = compare(runs, baseline.get('runs', {}))
+        comparison = report['comparison']
+        print(f"\nExactitud por campo vs línea base: {comparison['fieldAccuracy']}")
+        print(f"Tiempo medio: {comparison['timing'].get('mean')}s (delta {comparison['meanDelta']}s), "
+              f"p95 delta {comparison['p95Delta']}s")
+        for name, detail in comparison['details'].items():
+            if detail['mismatches']:
+                print(f"  {name}: {', '.join(detail['mismatches'])}")
+
+    print(f"\nFacturas: {len(runs)}, fallidas: {report['failures']}, tiempo total: {report['timing'].get('total')}s")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Resultados guardados en {args.out}")
+
+    return 0 if report['failures'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
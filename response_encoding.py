@@ -0,0 +1,155 @@
+"""
+Respuestas livianas: logs fuera del cuerpo, compresión y ETag.
+
+Por defecto /analyze y /jobs/<id> no incluyen los logs del análisis: se
+guardan aparte con el id de la solicitud (X-Request-Id o uno generado), en un
+hilo propio para no demorar la respuesta, y un administrador los consulta en
+/debug/logs/<id>; con `?verbose=1` se incluyen como antes. Las respuestas se comprimen con br o gzip según Accept-Encoding, y
+las respuestas GET llevan un ETag para que el cliente reciba 304 si no
+cambiaron (por ejemplo, al consultar periódicamente el estado de un trabajo).
+"""
+
+import os
+import gzip
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from profiling import ProfileStore, PROFILE_ID_PATTERN
+
+try:
+    import brotli
+except ImportError:  # br es opcional: sin el paquete brotli se usa gzip
+    brotli = None
+
+# Load environment variables
+load_dotenv()
+
+# Cuerpos más chicos no se comprimen: el ahorro no compensa el costo
+MIN_COMPRESS_SIZE = 512
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+# Logs de solicitudes que se conservan en disco (compartido entre workers)
+request_logs = ProfileStore(
+    os.environ.get('REQUEST_LOG_DIR', os.path.join(tempfile.gettempdir(), 'invoice-request-logs')),
+    int(os.environ.get('REQUEST_LOG_MAX_STORED', 500))
+)
+
+# Escrituras de logs en espera como máximo: si el disco no da abasto se descartan, sin acumular memoria
+MAX_PENDING_LOG_WRITES = 100
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+_pending_log_writes = 0
+
+
+def wants_verbose(params):
+    return params.get('verbose', '').lower() in ('1', 'true')
+
+
+def request_id_for(headers):
+    """Id de la solicitud: el X-Request-Id del cliente si es válido, o uno nuevo."""
+    request_id = headers.get('X-Request-Id')
+    if request_id and PROFILE_ID_PATTERN.match(request_id):
+        return request_id
+    return uuid.uuid4().hex
+
+
+def _write_request_logs(record):
+    global _pending_log_writes
+    try:
+        request_logs.save(record)
+    except OSError as e:
+        print(f"Error al guardar los logs de la solicitud {record['id']}: {str(e)}")
+    finally:
+        with _log_writer_lock:
+            _pending_log_writes -= 1
+
+
+def save_request_logs(request_id, path, logs):
+    """
+    Encola los logs de la solicitud para /debug/logs y vuelve sin esperar.
+
+    La escritura corre en un hilo aparte (creado en el primer uso, después del
+    fork de gunicorn); un fallo no afecta la respuesta. Devuelve False si se
+    descartaron por haber demasiadas escrituras pendientes.
+    """
+    global _log_writer, _pending_log_writes
+    record = {'id': request_id, 'path': path, 'createdAt': time.time(), 'logs': logs}
+    with _log_writer_lock:
+        if _pending_log_writes >= MAX_PENDING_LOG_WRITES:
+            return False
+        _pending_log_writes += 1
+        if _log_writer is None:
+            _log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='request-logs')
+        writer = _log_writer
+    writer.submit(_write_request_logs, record)
+    return True
+
+
+def negotiate_encoding(accept_encoding):
+    """Elige br o gzip según Accept-Encoding (respetando q=0); None si no acepta ninguna."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    wildcard = accepted.get('*', 0.0)
+    for encoding in (('br',) if brotli is not None else ()) + ('gzip',):
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def etag_for(body):
+    # Débil: el mismo contenido puede enviarse con distintas codificaciones
+    return f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return etag.removeprefix('W/') in candidates
+
+
+def encode_body(method, status, body, content_type, request_headers):
+    """
+    Aplica ETag y compresión a una respuesta ya generada.
+
+    Devuelve (status, body, cabeceras a agregar). Solo las respuestas GET 200
+    llevan ETag; si coincide con If-None-Match el status pasa a 304 sin cuerpo.
+    """
+    headers = {}
+    if method in ('GET', 'HEAD') and status == 200:
+        headers['ETag'] = etag_for(body)
+        if etag_matches(request_headers.get('If-None-Match'), headers['ETag']):
+            return 304, b'', headers
+
+    if len(body) >= MIN_COMPRESS_SIZE and (content_type or '').startswith(COMPRESSIBLE_TYPES):
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = negotiate_encoding(request_headers.get('Accept-Encoding'))
+        if encoding is not None:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+    return status, body, headers
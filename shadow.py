@@ -0,0 +1,330 @@
+"""
+Tráfico en sombra para evaluar modelos y prompts candidatos.
+
+Cambiar el modelo o los prompts del análisis hoy es un salto de fe. Con
+SHADOW_FRACTION > 0, una fracción de los análisis completos de /analyze se
+repite en segundo plano con la configuración candidata (SHADOW_MODEL y,
+opcionalmente, prompts leídos de archivos), sobre la misma factura ya
+preparada. La respuesta al usuario no espera: la comparación corre en un pool
+propio, solo cuando la cola hacia Anthropic no tiene esperas, y se descarta si
+ya hay SHADOW_MAX_PENDING comparaciones pendientes.
+
+Cada comparación registra la latencia de Claude, los tokens y el costo de las
+dos configuraciones y la coincidencia campo por campo (datos generales e
+identificadores de cada modalidad). Los totales por compañía se exponen en
+/metrics/shadow. El resultado candidato nunca se devuelve ni se guarda.
+
+Los prompts candidatos son plantillas (string.Template): la de identificadores
+recibe $descriptions (identificadores con sus restricciones) y $json_template
+(los campos del JSON de respuesta).
+"""
+
+import os
+import time
+import random
+import threading
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from rate_limiter import AdmissionRejected, anthropic_limiter, estimate_input_tokens
+from usage_tracker import RequestUsage, UsageCall, usage_tracker
+from phash import COMPARED_FIELDS, result_fields
+
+# Load environment variables
+load_dotenv()
+
+
+def _read_prompt(path):
+    if not path:
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _field_group(field):
+    # En los totales, los identificadores de todas las compañías se agrupan en uno
+    return field if field in COMPARED_FIELDS else 'identificadores'
+
+
+def _empty_side():
+    return {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0, 'latency_seconds': 0.0}
+
+
+def _add_side(side, usage):
+    for key in side:
+        side[key] += usage.get(key, 0)
+
+
+def _empty_comparison():
+    return {
+        'compared': 0,
+        # Resultado candidato idéntico en todos los campos comparados
+        'agreed': 0,
+        # La configuración candidata no produjo resultado
+        'candidateFailed': 0,
+        'fields': {},
+        'primary': _empty_side(),
+        'candidate': _empty_side()
+    }
+
+
+def _export_side(side, compared):
+    return {
+        'avgLatencySeconds': round(side['latency_seconds'] / compared, 3) if compared else 0.0,
+        'avgInputTokens': round(side['input_tokens'] / compared, 1) if compared else 0.0,
+        'avgOutputTokens': round(side['output_tokens'] / compared, 1) if compared else 0.0,
+        'avgCostUsd': round(side['cost_usd'] / compared, 6) if compared else 0.0,
+        'costUsd': round(side['cost_usd'], 6)
+    }
+
+
+def _export_comparison(comparison):
+    compared = comparison['compared']
+    return {
+        'compared': compared,
+        'agreed': comparison['agreed'],
+        'agreementRate': round(comparison['agreed'] / compared, 4) if compared else None,
+        'candidateFailed': comparison['candidateFailed'],
+        'fields': {
+            name: dict(counts, agreementRate=round(counts['agreed'] / (counts['agreed'] + counts['disagreed']), 4))
+            for name, counts in sorted(comparison['fields'].items())
+        },
+        'primary': _export_side(comparison['primary'], compared),
+        'candidate': _export_side(comparison['candidate'], compared)
+    }
+
+
+def _record(comparison, primary_usage, candidate_usage, fields):
+    """Suma una comparación; fields es None si la configuración candidata no produjo resultado."""
+    comparison['compared'] += 1
+    _add_side(comparison['primary'], primary_usage)
+    _add_side(comparison['candidate'], candidate_usage)
+    if fields is None:
+        comparison['candidateFailed'] += 1
+        return
+    if all(fields.values()):
+        comparison['agreed'] += 1
+    for name, agreed in fields.items():
+        counts = comparison['fields'].setdefault(name, {'agreed': 0, 'disagreed': 0})
+        counts['agreed' if agreed else 'disagreed'] += 1
+
+
+def compare_fields(primary, candidate):
+    """Coincidencia por campo entre el resultado principal y el candidato: {campo: bool}."""
+    primary_fields = result_fields(primary)
+    candidate_fields = result_fields(candidate)
+    return {
+        name: (candidate_fields.get(name) or '') == (value or '')
+        for name, value in primary_fields.items()
+    }
+
+
+class ShadowConfig:
+    """Configuración candidata: modelo, max_tokens y prompts (None = los del análisis principal)."""
+
+    def __init__(self, model=None, max_tokens=4000, company_prompt=None, identifiers_prompt=None, label=None):
+        self.model = model or usage_tracker.model
+        self.max_tokens = max_tokens
+        self.company_prompt = company_prompt
+        self.identifiers_template = Template(identifiers_prompt) if identifiers_prompt else None
+        self.label = label or self.model
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            model=os.environ.get('SHADOW_MODEL'),
+            max_tokens=int(os.environ.get('SHADOW_MAX_TOKENS', 4000)),
+            company_prompt=_read_prompt(os.environ.get('SHADOW_COMPANY_PROMPT_FILE')),
+            identifiers_prompt=_read_prompt(os.environ.get('SHADOW_IDENTIFIERS_PROMPT_FILE')),
+            label=os.environ.get('SHADOW_LABEL')
+        )
+
+    def summary(self):
+        return {
+            'label': self.label,
+            'model': self.model,
+            'maxTokens': self.max_tokens,
+            'companyPrompt': 'candidate' if self.company_prompt else 'primary',
+            'identifiersPrompt': 'candidate' if self.identifiers_template else 'primary'
+        }
+
+
+def shadow_analyze(config, prepared):
+    """
+    Repite el análisis de una factura preparada con la configuración candidata.
+
+    Devuelve (resultado o None, RequestUsage). Sigue los mismos pasos que
+    InvoiceAnalyzer.analyze_invoice pero sin sus efectos: no usa la política
+    de reintentos, ni registra consumo en /metrics/usage, ni observa duplicados.
+    """
+    from pdf_analyzer import InvoiceAnalyzer, COMPANY_PROMPT
+    from outbound import outbound_policy
+
+    analyzer = InvoiceAnalyzer()
+    usage = RequestUsage()
+    timeout = analyzer.client_timeout(outbound_policy.policies['anthropic'].timeout)
+
+    def ask(prompt, stage):
+        request = analyzer.image_message_request(
+            prompt, prepared.data, prepared.media_type, config.model, config.max_tokens
+        )
+        started = time.monotonic()
+        # Dentro de los mismos límites que el tráfico real, para no exceder los de Anthropic
+        with anthropic_limiter.slot(estimate_input_tokens(prompt), request["max_tokens"] // 4) as slot:
+            try:
+                message = analyzer.client.messages.create(timeout=timeout, **request)
+            except Exception as e:
+                analyzer.handle_overload(e, slot)
+                raise
+            slot.record_usage(message.usage)
+        usage.calls.append(UsageCall(stage, request["model"], message.usage, time.monotonic() - started))
+        return message.content[0].text
+
+    company = analyzer.parse_company_response(ask(config.company_prompt or COMPANY_PROMPT, 'company'))
+    if company is None:
+        return None, usage
+    company_names, category, _ = company
+    company_info = analyzer.select_company(company_names, category)
+    if not company_info:
+        return None, usage
+    usage.company_code = company_info.get("companyCode", "")
+    active_modalities = analyzer.get_active_modalities(company_info)
+    if not active_modalities:
+        return None, usage
+
+    if config.identifiers_template is None:
+        identifiers_to_find, identifiers_prompt = analyzer.identifiers_plan(company_info, active_modalities)
+    else:
+        identifiers_to_find = analyzer.build_identifiers_to_find(active_modalities)
+        descriptions, json_template = analyzer.identifiers_prompt_parts(identifiers_to_find)
+        identifiers_prompt = config.identifiers_template.safe_substitute(
+            descriptions=descriptions, json_template=json_template
+        )
+    invoice_data = analyzer.parse_identifiers_response(ask(identifiers_prompt, 'identifiers'), identifiers_to_find)
+    if invoice_data is None:
+        return None, usage
+    result = analyzer.build_result(company_info, category, active_modalities, identifiers_to_find, invoice_data)
+    return result, usage
+
+
+class ShadowEvaluator:
+    def __init__(self, config, fraction=0.0, workers=2, max_pending=8):
+        self.config = config
+        self.fraction = fraction
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.sampled = 0
+        # Omitidas porque había solicitudes reales esperando turno hacia Anthropic
+        self.skipped_busy = 0
+        # Descartadas por tener ya max_pending comparaciones en curso
+        self.dropped = 0
+        self.errors = 0
+        self.totals = _empty_comparison()
+        self.by_company = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ShadowConfig.from_env(),
+            fraction=float(os.environ.get('SHADOW_FRACTION', 0)),
+            workers=int(os.environ.get('SHADOW_WORKERS', 2)),
+            max_pending=int(os.environ.get('SHADOW_MAX_PENDING', 8))
+        )
+
+    @property
+    def enabled(self):
+        return self.fraction > 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='shadow')
+            return self._executor
+
+    def mirror(self, analyzer, image_path, result, usage):
+        """
+        Encola la comparación de un análisis terminado, si entra en la muestra.
+
+        No bloquea: se llama desde /analyze con el resultado y el consumo
+        (usage.summary()) del análisis principal. Devuelve True si se encoló.
+        """
+        if not self.enabled or random.random() >= self.fraction:
+            return False
+        # Solo análisis completos: sin atajos de duplicados ni resultados parciales
+        if not result or not isinstance(result, dict) or result.get('partial'):
+            return False
+        if analyzer.near_duplicate is not None and analyzer.near_duplicate.applied:
+            return False
+        prepared = analyzer.cached_image(image_path)
+        if prepared is None:
+            return False
+
+        with self._lock:
+            if anthropic_limiter.waiting > 0:
+                self.skipped_busy += 1
+                return False
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending += 1
+            self.sampled += 1
+        # El pool no hereda el contexto de la solicitud (plazo, consumo): la comparación es independiente
+        self._get_executor().submit(self._evaluate, prepared, result, usage)
+        return True
+
+    def _evaluate(self, prepared, primary, primary_usage):
+        try:
+            try:
+                candidate, candidate_usage = shadow_analyze(self.config, prepared)
+            except AdmissionRejected:
+                with self._lock:
+                    self.skipped_busy += 1
+                return
+            except Exception as e:
+                print(f"Error en el análisis en sombra ({self.config.label}): {str(e)}")
+                with self._lock:
+                    self.errors += 1
+                return
+            fields = compare_fields(primary, candidate) if candidate else None
+            self.record(primary.get('companyCode', ''), primary_usage, candidate_usage.summary(), fields)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def record(self, company_code, primary_usage, candidate_usage, fields):
+        with self._lock:
+            total_fields = None
+            if fields is not None:
+                total_fields = {}
+                for name, agreed in fields.items():
+                    group = _field_group(name)
+                    total_fields[group] = total_fields.get(group, True) and agreed
+            _record(self.totals, primary_usage, candidate_usage, total_fields)
+            comparison = self.by_company.setdefault(company_code or 'unknown', _empty_comparison())
+            _record(comparison, primary_usage, candidate_usage, fields)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'fraction': self.fraction,
+                'candidate': self.config.summary(),
+                'sampled': self.sampled,
+                'pending': self.pending,
+                'skippedBusy': self.skipped_busy,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'totals': _export_comparison(self.totals),
+                'byCompany': {
+                    code: _export_comparison(comparison)
+                    for code, comparison in sorted(self.by_company.items())
+                }
+            }
+
+
+# Evaluador compartido por el proceso
+shadow_evaluator = ShadowEvaluator.from_env()
@@ -0,0 +1,239 @@
+"""
+Coalescencia de solicitudes concurrentes idénticas (single-flight).
+
+La primera solicitud para una clave ejecuta el trabajo y las duplicadas que
+llegan mientras está en curso esperan y reciben el mismo resultado. Dentro de
+un worker se coordina con hilos; opcionalmente, entre workers, con un archivo
+de bloqueo y un archivo de resultado en un directorio compartido.
+
+La espera nunca supera el plazo de la solicitud (deadline.bounded_wait): si el
+primero no termina a tiempo, la duplicada hace el análisis por su cuenta. Los
+archivos de bloqueo y de resultado vencidos se eliminan periódicamente.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import tempfile
+
+from deadline import bounded_wait
+
+try:
+    import fcntl
+except ImportError:  # Plataformas sin flock (Windows): solo coalescencia local
+    fcntl = None
+
+# Intervalo máximo entre intentos de tomar el bloqueo compartido
+LOCK_POLL_INTERVAL = 0.05
+
+
+def content_hash(data):
+    """Calcula el hash SHA-256 del contenido subido."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, shared_dir=None, shared_ttl=30.0, max_wait=60.0):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared_dir = shared_dir if fcntl is not None else None
+        self.shared_ttl = shared_ttl
+        # Espera máxima por otra solicitud idéntica (también acotada por el plazo de la propia)
+        self.max_wait = max_wait
+        self._next_sweep = 0.0
+        if self.shared_dir:
+            os.makedirs(self.shared_dir, exist_ok=True)
+
+    def do(self, key, fn, shareable=None):
+        """
+        Ejecuta fn() una sola vez por clave entre las llamadas concurrentes.
+
+        Devuelve una tupla (resultado, compartido), donde compartido indica si
+        el resultado fue producido por otra solicitud. shareable decide qué
+        resultados se publican a otros workers (por defecto, los no nulos).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if not call.event.wait(bounded_wait(self.max_wait)):
+                # El primero no terminó dentro del plazo de esta solicitud: analizar por cuenta propia
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._run_leader(key, fn, shareable)
+            return call.result, shared
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+            self._maybe_sweep()
+
+    def _run_leader(self, key, fn, shareable):
+        if not self.shared_dir:
+            return fn(), False
+
+        lock_path = os.path.join(self.shared_dir, f"{key}.lock")
+        result_path = os.path.join(self.shared_dir, f"{key}.json")
+
+        with open(lock_path, 'a') as lock_file:
+            # Otro worker con la misma clave espera aquí hasta que el primero termine (o venza el plazo)
+            if not self._acquire_shared(lock_file):
+                print("Otra solicitud idéntica sigue en curso en otro worker, analizando por cuenta propia")
+                return self._run_and_share(fn, shareable, result_path), False
+            try:
+                # Marca de uso: el barrido no elimina bloqueos recientes
+                os.utime(lock_path)
+                cached = self._read_shared(result_path)
+                if cached is not None:
+                    return cached, True
+                return self._run_and_share(fn, shareable, result_path), False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _acquire_shared(self, lock_file):
+        """Toma el bloqueo exclusivo sin esperar más que el plazo de la solicitud."""
+        give_up_at = time.monotonic() + bounded_wait(self.max_wait)
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(LOCK_POLL_INTERVAL, remaining))
+
+    def _run_and_share(self, fn, shareable, result_path):
+        result = fn()
+        # Solo se comparten resultados válidos para no propagar fallos transitorios
+        should_share = shareable(result) if shareable else result is not None
+        if should_share:
+            self._write_shared(result_path, result)
+        return result
+
+    def _read_shared(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.shared_ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_shared(self, path, result):
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.shared_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Error al guardar el resultado compartido: {str(e)}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _maybe_sweep(self):
+        """Barre el directorio compartido a lo sumo una vez cada shared_ttl segundos."""
+        if not self.shared_dir:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + self.shared_ttl
+        self.sweep()
+
+    def sweep(self):
+        """Elimina los resultados, temporales y bloqueos sin uso desde hace más de shared_ttl."""
+        try:
+            names = os.listdir(self.shared_dir)
+        except OSError:
+            return
+        cutoff = time.time() - self.shared_ttl
+        for name in names:
+            path = os.path.join(self.shared_dir, name)
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                if name.endswith('.lock'):
+                    self._remove_idle_lock(path)
+                elif name.endswith(('.json', '.tmp')):
+                    os.remove(path)
+            except OSError:
+                # Otro worker lo eliminó o lo está usando
+                continue
+
+    def _remove_idle_lock(self, path):
+        with open(path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                os.remove(path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class _LeaderCancelled(Exception):
+    """La solicitud que hacía el trabajo se canceló (p. ej. su cliente se desconectó)."""
+
+
+class AsyncSingleFlight:
+    """Coalescencia equivalente para el servidor ASGI, dentro de un mismo event loop."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future), True
+            except _LeaderCancelled:
+                # La primera duplicada en despertar toma el lugar del cancelado; el resto la espera
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # La cancelación es de esta solicitud, no del análisis: no se propaga a las duplicadas
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Evitar el aviso de excepción no recuperada cuando no hay duplicadas
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._calls.pop(key, None)
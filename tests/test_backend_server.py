@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import backend_server
+from cassette import CassetteMiss
+from deadline import DeadlineExceeded
+from rate_limiter import AdmissionRejected
+
+
+def failing_analyzer(error, paths):
+    class FailingAnalyzer:
+        def analyze_invoice(self, path):
+            paths.append(path)
+            assert os.path.exists(path)
+            raise error
+
+    return FailingAnalyzer
+
+
+@pytest.mark.parametrize('error', [
+    AdmissionRejected(5, reason='queue_full'),
+    DeadlineExceeded('company'),
+    CassetteMiss('anthropic', 'abc'),
+])
+def test_temp_file_removed_when_analysis_raises(monkeypatch, error):
+    paths = []
+    monkeypatch.setattr(backend_server, 'InvoiceAnalyzer', failing_analyzer(error, paths))
+    with pytest.raises(type(error)):
+        backend_server.run_analysis(b'contenido', '.jpg')
+    assert len(paths) == 1
+    assert not os.path.exists(paths[0])
@@ -0,0 +1,48 @@
+import pytest
+
+from deadline import (
+    DEADLINE_HEADER, MAX_DEADLINE, Deadline, DeadlineExceeded, bounded_wait, deadline_scope,
+    request_deadline, require_budget
+)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('10', 10.0),
+    ('0.5', 0.5),
+    (str(MAX_DEADLINE * 10), MAX_DEADLINE),
+    ('inf', MAX_DEADLINE),
+    ('0', 30.0),
+    ('-5', 30.0),
+    ('abc', 30.0),
+    ('nan', 30.0),
+    ('', 30.0),
+])
+def test_request_deadline_header(value, expected):
+    deadline = request_deadline({DEADLINE_HEADER: value}, default=30.0)
+    assert deadline.budget == expected
+
+
+def test_request_deadline_without_header_uses_default():
+    assert request_deadline({}, default=12.0).budget == 12.0
+    # El plazo del servidor también se acota al máximo
+    assert request_deadline({}, default=MAX_DEADLINE + 100).budget == MAX_DEADLINE
+
+
+def test_deadline_bound_and_require():
+    deadline = Deadline(1.0)
+    connect, read = deadline.bound((5.0, 60.0))
+    assert connect <= 1.0 and read <= 1.0
+    assert deadline.bound((0.1, 0.2)) == (0.1, 0.2)
+    with pytest.raises(DeadlineExceeded) as info:
+        deadline.require(5.0, 'identifiers')
+    assert info.value.stage == 'identifiers'
+
+
+def test_scope_bounds_waits_only_inside():
+    assert bounded_wait(10.0) == 10.0
+    with deadline_scope(Deadline(0.5)):
+        assert bounded_wait(10.0) <= 0.5
+        with pytest.raises(DeadlineExceeded):
+            require_budget(3.0, 'company')
+    assert bounded_wait(10.0) == 10.0
+    require_budget(3.0, 'company')
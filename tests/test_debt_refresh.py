@@ -0,0 +1,25 @@
+from debt_refresh import interleave_by_company
+
+
+def check(company_code, n):
+    return {'company_code': company_code, 'n': n}
+
+
+def test_interleave_alternates_companies_and_keeps_order():
+    checks = [check('A', 1), check('A', 2), check('A', 3), check('B', 1), check('C', 1), check('C', 2)]
+    ordered = [(c['company_code'], c['n']) for c in interleave_by_company(checks)]
+    assert ordered == [('A', 1), ('B', 1), ('C', 1), ('A', 2), ('C', 2), ('A', 3)]
+
+
+def test_interleave_keeps_every_check():
+    checks = [check(code, n) for n in range(5) for code in 'XYZ'][::-1]
+    ordered = interleave_by_company(checks)
+    assert sorted(ordered, key=lambda c: (c['company_code'], c['n'])) == \
+        sorted(checks, key=lambda c: (c['company_code'], c['n']))
+    # Dentro de cada compañía se respeta el orden de llegada
+    for code in 'XYZ':
+        assert [c['n'] for c in ordered if c['company_code'] == code] == [4, 3, 2, 1, 0]
+
+
+def test_interleave_empty():
+    assert interleave_by_company([]) == []
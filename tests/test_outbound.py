@@ -0,0 +1,95 @@
+import time
+
+from outbound import CircuitBreaker, CircuitOpenError, is_transient
+from rate_limiter import AdmissionRejected
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def open_breaker(reset_timeout=60.0):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def expire(breaker):
+    # Simula que pasó reset_timeout desde que se abrió
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60.0)
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.retry_after() > 1.0
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60.0)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = open_breaker()
+    expire(breaker)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert [breaker.allow() for _ in range(5)] == [False] * 5
+
+
+def test_probe_success_closes_the_circuit():
+    breaker = open_breaker()
+    expire(breaker)
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() and breaker.allow()
+
+
+def test_probe_failure_reopens_the_circuit():
+    breaker = open_breaker()
+    expire(breaker)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_released_probe_lets_another_caller_probe():
+    breaker = open_breaker()
+    expire(breaker)
+    breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_lost_probe_expires_after_reset_timeout():
+    breaker = open_breaker(reset_timeout=0.05)
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_is_transient():
+    assert is_transient(HttpError(503))
+    assert is_transient(HttpError(429))
+    assert not is_transient(HttpError(400))
+    assert is_transient(TimeoutError())
+    assert not is_transient(ValueError())
+    assert is_transient(AdmissionRejected(1, reason='upstream_overloaded'))
+    assert not is_transient(AdmissionRejected(1, reason='queue_full'))
+    assert not is_transient(CircuitOpenError('anthropic', 5))
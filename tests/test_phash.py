@@ -0,0 +1,152 @@
+import io
+import time
+
+from PIL import Image, ImageDraw
+
+from phash import BKTree, NearDuplicateIndex, confirms, dhash, hamming
+
+
+def bill(customer, account, amount):
+    """Factura sintética con el diseño de una compañía: cambian solo los datos del cliente."""
+    image = Image.new('RGB', (600, 800), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 600, 90), fill=(20, 60, 140))
+    draw.rectangle((30, 120, 570, 260), outline='black', width=3)
+    draw.rectangle((30, 300, 570, 620), fill=(230, 230, 230))
+    for y in range(330, 600, 40):
+        draw.line((50, y, 550, y), fill='gray', width=2)
+    draw.rectangle((350, 660, 570, 760), fill=(200, 30, 30))
+    draw.text((50, 140), f"Cliente: {customer}", fill='black')
+    draw.text((50, 180), f"Cuenta: {account}", fill='black')
+    draw.text((370, 700), f"Total ${amount}", fill='white')
+    return image
+
+
+def other_design():
+    image = Image.new('RGB', (600, 800), 'white')
+    ImageDraw.Draw(image).ellipse((100, 100, 500, 700), fill='black')
+    return image
+
+
+def retake(image):
+    # Otra captura de la misma factura: reducida y recomprimida
+    output = io.BytesIO()
+    image.resize((300, 400)).save(output, format='JPEG', quality=60)
+    return Image.open(io.BytesIO(output.getvalue()))
+
+
+def result(account, customer, company_code='GAS1'):
+    return {
+        'companyCode': company_code,
+        'nombre_cliente': customer,
+        'modalities': [{'modalityId': 'm1', 'identifiersEncontrados': {'NRO_CUENTA': account}}]
+    }
+
+
+class FakeStore:
+    def __init__(self):
+        self.rows = []
+        self.results = {}
+
+    def add(self, image, data, created_at=None):
+        invoice_id = len(self.rows) + 1
+        self.rows.append({
+            'invoice_id': invoice_id,
+            'perceptual_hash': format(dhash(image), '016x'),
+            'company_code': data['companyCode'],
+            'category': 'gas',
+            'created_at': time.time() if created_at is None else created_at
+        })
+        self.results[invoice_id] = {'id': invoice_id, 'data': data}
+        return invoice_id
+
+    def perceptual_hashes(self, after_id=0):
+        return [row for row in self.rows if row['invoice_id'] > after_id]
+
+    def get(self, invoice_id):
+        return self.results.get(invoice_id)
+
+
+def index_with(store, **options):
+    options.setdefault('control_fraction', 0.0)
+    index = NearDuplicateIndex(**options)
+    index._store = lambda: store
+    return index
+
+
+def test_hamming():
+    assert hamming(0, 0) == 0
+    assert hamming(0b1011, 0b0001) == 2
+    assert hamming(0, 2 ** 64 - 1) == 64
+
+
+def test_bktree_matches_brute_force():
+    import random
+
+    rng = random.Random(7)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    query = values[0] ^ 0b10110  # a 3 bits del primero
+    for max_distance in (0, 3, 20):
+        expected = sorted((hamming(query, value), i) for i, value in enumerate(values)
+                          if hamming(query, value) <= max_distance)
+        assert sorted(tree.search(query, max_distance)) == expected
+    assert len(tree) == 300
+
+
+def test_retake_is_near_and_other_design_is_far():
+    index = NearDuplicateIndex()
+    original = bill('Juan Perez', '0012345', '1.234,56')
+    assert hamming(dhash(original), dhash(retake(original))) <= index.reuse_distance
+    assert hamming(dhash(original), dhash(other_design())) > index.company_distance
+
+
+def test_same_layout_bills_are_indistinguishable_by_hash():
+    # Dos clientes distintos de la misma compañía: el hash no los separa
+    first = bill('Juan Perez', '0012345', '1.234,56')
+    second = bill('Maria Gomez', '0098765', '987,10')
+    assert hamming(dhash(first), dhash(second)) <= NearDuplicateIndex().reuse_distance
+
+
+def test_reuse_of_same_layout_bill_is_not_confirmed():
+    store = FakeStore()
+    first = bill('Juan Perez', '0012345', '1.234,56')
+    store.add(first, result('0012345', 'Juan Perez'))
+    index = index_with(store, mode='on')
+
+    match = index.lookup(dhash(bill('Maria Gomez', '0098765', '987,10')))
+    assert match.kind == 'reuse' and match.applied
+    # Los identificadores extraídos de la segunda factura no confirman la reutilización
+    assert not confirms(result('0098765', 'Maria Gomez'), match.result)
+
+    match = index.lookup(dhash(retake(first)))
+    assert match.kind == 'reuse'
+    assert confirms(result('0012345', 'Juan Perez'), match.result)
+
+
+def test_confirms_requires_identifiers():
+    stored = result('', 'Juan Perez')
+    assert not confirms(result('', 'Juan Perez'), stored)
+    assert not confirms(result('0012345', 'Juan Perez', company_code='ELEC'), result('0012345', 'Juan Perez'))
+
+
+def test_old_match_only_skips_company_identification():
+    store = FakeStore()
+    first = bill('Juan Perez', '0012345', '1.234,56')
+    store.add(first, result('0012345', 'Juan Perez'), created_at=time.time() - 3600)
+    index = index_with(store, mode='on', reuse_window=900)
+    match = index.lookup(dhash(retake(first)))
+    assert match.kind == 'company' and match.company_code == 'GAS1'
+    assert index.lookup(dhash(other_design())) is None
+
+
+def test_shadow_is_the_default_and_off_skips_lookup():
+    store = FakeStore()
+    first = bill('Juan Perez', '0012345', '1.234,56')
+    store.add(first, result('0012345', 'Juan Perez'))
+    assert NearDuplicateIndex(mode='bogus').mode == 'shadow'
+    match = index_with(store).lookup(dhash(first))
+    assert match is not None and not match.applied
+    assert index_with(store, mode='off').lookup(dhash(first)) is None
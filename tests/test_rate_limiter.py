@@ -0,0 +1,54 @@
+import math
+
+import pytest
+
+from rate_limiter import AdmissionRejected, TokenBucket
+
+
+def test_bucket_starts_full():
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60, bucket.updated) == 0.0
+
+
+def test_bucket_waits_for_refill():
+    bucket = TokenBucket(60)  # 1 token por segundo
+    now = bucket.updated
+    bucket.consume(60)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, now + 1.0) == 0.0
+
+
+def test_bucket_refill_is_capped_at_capacity():
+    bucket = TokenBucket(60)
+    bucket.wait_time(0, bucket.updated + 3600)
+    assert bucket.tokens == 60
+
+
+def test_bucket_request_larger_than_capacity_is_clamped():
+    # Una solicitud mayor que la capacidad no debe esperar para siempre
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(1000, now) == 0.0
+    bucket.consume(1000)
+    assert bucket.tokens == 0
+    assert bucket.wait_time(1000, now) == pytest.approx(60.0)
+
+
+def test_bucket_adjust_can_go_negative():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    bucket.consume(60)
+    # El consumo real superó la estimación: la deuda se paga con espera
+    bucket.adjust(30)
+    assert bucket.tokens == -30
+    assert bucket.wait_time(1, now) == pytest.approx(31.0)
+    # Y si fue menor, se devuelve el sobrante sin superar la capacidad
+    bucket.adjust(-1000)
+    assert bucket.tokens == 60
+
+
+def test_admission_rejected_rounds_retry_after_up():
+    assert AdmissionRejected(0.2).retry_after == 1
+    assert AdmissionRejected(2.1).retry_after == math.ceil(2.1)
+    assert AdmissionRejected(5, reason='circuit_open').reason == 'circuit_open'
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from deadline import Deadline, deadline_scope
+from single_flight import AsyncSingleFlight, SingleFlight, content_hash
+
+
+def run_concurrently(flight, key, fn, count):
+    results = []
+    errors = []
+
+    def call():
+        try:
+            results.append(flight.do(key, fn))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def slow(value, calls, seconds=0.2):
+    def fn():
+        calls.append(1)
+        time.sleep(seconds)
+        return value
+    return fn
+
+
+def test_content_hash():
+    assert content_hash(b'abc') == content_hash(b'abc') != content_hash(b'abd')
+
+
+def test_concurrent_calls_are_coalesced():
+    calls = []
+    results, errors = run_concurrently(SingleFlight(), 'k', slow({'ok': True}, calls), 5)
+    assert not errors and len(calls) == 1
+    assert all(result == {'ok': True} for result, _ in results)
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+
+
+def test_leader_exception_reaches_followers():
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('sin datos')
+
+    results, errors = run_concurrently(SingleFlight(), 'k', fail, 3)
+    assert not results
+    assert len(errors) == 3 and all(isinstance(e, ValueError) for e in errors)
+
+
+def test_follower_runs_itself_when_leader_exceeds_its_deadline():
+    flight = SingleFlight()
+    calls = []
+    leader = threading.Thread(target=flight.do, args=('k', slow('lento', calls, seconds=1.0)))
+    leader.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    with deadline_scope(Deadline(0.2)):
+        assert flight.do('k', lambda: 'propio') == ('propio', False)
+    assert time.monotonic() - started < 0.5
+    leader.join()
+
+
+def test_shared_result_across_workers(tmp_path):
+    # Dos instancias simulan dos workers con el mismo directorio compartido
+    first = SingleFlight(shared_dir=str(tmp_path), shared_ttl=30)
+    second = SingleFlight(shared_dir=str(tmp_path), shared_ttl=30)
+    calls = []
+    assert first.do('k', slow({'n': 1}, calls, 0)) == ({'n': 1}, False)
+    assert second.do('k', slow({'n': 2}, calls, 0)) == ({'n': 1}, True)
+    assert len(calls) == 1
+
+
+def test_unshareable_results_are_not_published(tmp_path):
+    first = SingleFlight(shared_dir=str(tmp_path))
+    second = SingleFlight(shared_dir=str(tmp_path))
+    assert first.do('k', lambda: None) == (None, False)
+    assert second.do('k', lambda: {'n': 2}) == ({'n': 2}, False)
+
+
+def test_shared_lock_wait_is_bounded_by_deadline(tmp_path):
+    import fcntl
+
+    flight = SingleFlight(shared_dir=str(tmp_path))
+    # Otro worker tiene tomado el bloqueo y no termina
+    with open(tmp_path / 'k.lock', 'a') as other:
+        fcntl.flock(other, fcntl.LOCK_EX)
+        started = time.monotonic()
+        with deadline_scope(Deadline(0.2)):
+            assert flight.do('k', lambda: {'n': 1}) == ({'n': 1}, False)
+        assert time.monotonic() - started < 0.5
+        fcntl.flock(other, fcntl.LOCK_UN)
+
+
+def test_expired_files_are_swept(tmp_path):
+    flight = SingleFlight(shared_dir=str(tmp_path), shared_ttl=60)
+    flight.do('viejo', lambda: {'n': 1})
+    flight.do('nuevo', lambda: {'n': 2})
+    old = time.time() - 120
+    for name in ('viejo.lock', 'viejo.json'):
+        os.utime(tmp_path / name, (old, old))
+    flight.sweep()
+    assert sorted(os.listdir(tmp_path)) == ['nuevo.json', 'nuevo.lock']
+
+
+def test_sweep_keeps_locks_in_use(tmp_path):
+    import fcntl
+
+    flight = SingleFlight(shared_dir=str(tmp_path), shared_ttl=60)
+    lock_path = tmp_path / 'k.lock'
+    with open(lock_path, 'a') as other:
+        fcntl.flock(other, fcntl.LOCK_EX)
+        old = time.time() - 120
+        os.utime(lock_path, (old, old))
+        flight.sweep()
+        assert lock_path.exists()
+
+
+def async_slow(value, calls, seconds=0.1):
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(seconds)
+        return value
+    return fn
+
+
+def test_async_calls_are_coalesced():
+    async def main():
+        flight = AsyncSingleFlight()
+        calls = []
+        fn = async_slow({'ok': True}, calls)
+        results = await asyncio.gather(*(flight.do('k', fn) for _ in range(4)))
+        return calls, results
+
+    calls, results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+
+
+def test_async_leader_exception_reaches_followers():
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ValueError('sin datos')
+
+    async def main():
+        flight = AsyncSingleFlight()
+        return await asyncio.gather(*(flight.do('k', fail) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+
+def test_async_follower_takes_over_when_leader_is_cancelled():
+    async def main():
+        flight = AsyncSingleFlight()
+        calls = []
+        fn = async_slow({'ok': True}, calls, seconds=0.2)
+        leader = asyncio.ensure_future(flight.do('k', fn))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.ensure_future(flight.do('k', fn)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        # El cliente de la primera solicitud se desconecta
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, await asyncio.gather(*followers)
+
+    calls, results = asyncio.run(main())
+    # Una duplicada repite el análisis y la otra recibe su resultado
+    assert len(calls) == 2
+    assert all(result == {'ok': True} for result, _ in results)
+    assert sorted(shared for _, shared in results) == [False, True]
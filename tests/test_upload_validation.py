@@ -0,0 +1,88 @@
+import io
+
+import pytest
+
+import upload_validation
+from upload_validation import UploadRejected, allowed_file, sniff_extension, validate_upload
+
+PDF = (
+    b"%PDF-1.4\n"
+    b"1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n"
+    b"2 0 obj << /Type /Pages /Kids [3 0 R] /Count 1 >> endobj\n"
+    b"3 0 obj << /Type /Page /Parent 2 0 R >> endobj\n"
+    b"trailer << /Root 1 0 R >>\n"
+    b"%%EOF\n"
+)
+
+
+def image_bytes(size=(400, 400), fmt='PNG', blank=False):
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', size, 'white')
+    if not blank:
+        draw = ImageDraw.Draw(image)
+        for x in range(0, size[0], 20):
+            draw.rectangle((x, 0, x + 9, size[1]), fill='black')
+    output = io.BytesIO()
+    image.save(output, format=fmt)
+    return output.getvalue()
+
+
+def rejection(data, filename):
+    with pytest.raises(UploadRejected) as info:
+        validate_upload(data, filename)
+    return info.value
+
+
+def test_allowed_file():
+    assert allowed_file('factura.JPG')
+    assert allowed_file('factura.pdf')
+    assert not allowed_file('factura.exe')
+    assert not allowed_file('factura')
+
+
+def test_sniff_extension():
+    assert sniff_extension(image_bytes(fmt='PNG')) == '.png'
+    assert sniff_extension(image_bytes(fmt='JPEG')) == '.jpg'
+    assert sniff_extension(b'basura' + PDF) == '.pdf'
+    assert sniff_extension(b'MZ\x90\x00') is None
+
+
+def test_valid_image_and_pdf():
+    assert validate_upload(image_bytes(fmt='JPEG'), 'factura.jpg') == '.jpg'
+    assert validate_upload(PDF, 'factura.pdf') == '.pdf'
+
+
+def test_real_format_wins_over_extension():
+    # Una captura PNG guardada como .jpg se acepta con su tipo real
+    assert validate_upload(image_bytes(fmt='PNG'), 'captura.jpg') == '.png'
+
+
+@pytest.mark.parametrize('data, filename, code', [
+    (b'', 'factura.png', 'EMPTY_FILE'),
+    (b'MZ\x90\x00' * 100, 'factura.exe', 'UNSUPPORTED_EXTENSION'),
+    (b'MZ\x90\x00' * 100, 'factura.pdf', 'UNKNOWN_FORMAT'),
+    (PDF[:-7], 'factura.pdf', 'CORRUPT_PDF'),
+    (PDF.replace(b'trailer <<', b'trailer << /Encrypt 4 0 R'), 'factura.pdf', 'ENCRYPTED_PDF'),
+    (PDF.replace(b'/Type /Page /Parent', b'/Parent'), 'factura.pdf', 'EMPTY_PDF'),
+])
+def test_rejections(data, filename, code):
+    assert rejection(data, filename).code == code
+
+
+def test_image_rejections():
+    assert rejection(image_bytes(blank=True), 'factura.png').code == 'BLANK_IMAGE'
+    assert rejection(image_bytes(size=(100, 400)), 'factura.png').code == 'IMAGE_TOO_SMALL'
+    truncated = image_bytes(fmt='JPEG')
+    assert rejection(truncated[:len(truncated) // 2], 'factura.jpg').code == 'CORRUPT_IMAGE'
+
+
+def test_limits(monkeypatch):
+    monkeypatch.setattr(upload_validation, 'MAX_UPLOAD_BYTES', 100)
+    error = rejection(PDF * 2, 'factura.pdf')
+    assert (error.code, error.status) == ('FILE_TOO_LARGE', 413)
+
+    monkeypatch.setattr(upload_validation, 'MAX_PDF_PAGES', 1)
+    monkeypatch.setattr(upload_validation, 'MAX_UPLOAD_BYTES', 10_000)
+    two_pages = PDF.replace(b'trailer', b'4 0 obj << /Type /Page /Parent 2 0 R >> endobj\ntrailer')
+    assert rejection(two_pages, 'factura.pdf').code == 'TOO_MANY_PAGES'
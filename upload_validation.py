@@ -0,0 +1,147 @@
+"""
+Validación local de las facturas subidas, antes de gastar en Claude.
+
+Un archivo vacío, truncado, un ejecutable renombrado, una imagen en blanco o
+un PDF cifrado llegaban hasta la llamada de visión y fallaban después de
+varios segundos con un error genérico. validate_upload los rechaza en
+milisegundos con un código preciso (UploadRejected.code):
+
+- EMPTY_FILE, FILE_TOO_LARGE (413), UNSUPPORTED_EXTENSION, UNKNOWN_FORMAT
+- CORRUPT_IMAGE, IMAGE_TOO_SMALL, IMAGE_TOO_LARGE, BLANK_IMAGE
+- CORRUPT_PDF, ENCRYPTED_PDF, EMPTY_PDF, TOO_MANY_PAGES
+
+El formato se reconoce por los primeros bytes y no por la extensión: una
+captura PNG guardada como .jpg se acepta con el tipo real.
+"""
+
+import io
+import os
+import re
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
+
+# Límite de tamaño de las solicitudes de Anthropic
+MAX_UPLOAD_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 32 * 1024 * 1024))
+# Con menos píxeles de lado los identificadores no son legibles
+MIN_IMAGE_SIDE = int(os.environ.get('UPLOAD_MIN_IMAGE_SIDE', 200))
+MAX_IMAGE_PIXELS = int(os.environ.get('UPLOAD_MAX_IMAGE_PIXELS', 50_000_000))
+# Páginas que acepta Claude en un documento PDF
+MAX_PDF_PAGES = int(os.environ.get('UPLOAD_MAX_PDF_PAGES', 100))
+# Desvío estándar de grises (0-255) bajo el cual la imagen se considera en blanco
+BLANK_STDDEV = float(os.environ.get('UPLOAD_BLANK_STDDEV', 4.0))
+
+# Lado de la miniatura sobre la que se mide la varianza
+BLANK_SAMPLE_SIDE = 128
+
+PDF_PAGE_PATTERN = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+
+class UploadRejected(Exception):
+    """Archivo rechazado por la validación local; code identifica el motivo."""
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def sniff_extension(data):
+    """Extensión que corresponde a los primeros bytes del archivo, o None si no es un formato soportado."""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return '.gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    # La especificación admite basura antes del encabezado dentro del primer KB
+    if b'%PDF-' in data[:1024]:
+        return '.pdf'
+    return None
+
+
+def _validate_image(data):
+    from PIL import Image, ImageStat
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            if width * height > MAX_IMAGE_PIXELS:
+                raise UploadRejected(
+                    'IMAGE_TOO_LARGE',
+                    f'La imagen es demasiado grande ({width}x{height}); el máximo es {MAX_IMAGE_PIXELS} píxeles'
+                )
+            if min(width, height) < MIN_IMAGE_SIDE:
+                raise UploadRejected(
+                    'IMAGE_TOO_SMALL',
+                    f'La imagen es demasiado chica ({width}x{height}); el mínimo es {MIN_IMAGE_SIDE} píxeles de lado'
+                )
+            # En JPEG draft decodifica a escala reducida; decodificar también detecta archivos truncados
+            image.draft('L', (BLANK_SAMPLE_SIDE, BLANK_SAMPLE_SIDE))
+            sample = image.convert('L')
+            sample.thumbnail((BLANK_SAMPLE_SIDE, BLANK_SAMPLE_SIDE))
+            stddev = ImageStat.Stat(sample).stddev[0]
+    except UploadRejected:
+        raise
+    except Image.DecompressionBombError:
+        raise UploadRejected('IMAGE_TOO_LARGE', 'La imagen es demasiado grande')
+    except Exception as e:
+        raise UploadRejected('CORRUPT_IMAGE', f'La imagen está dañada o incompleta: {str(e)}')
+
+    if stddev < BLANK_STDDEV:
+        raise UploadRejected('BLANK_IMAGE', 'La imagen está en blanco o no tiene contenido legible')
+    return width, height
+
+
+def _validate_pdf(data):
+    # Un PDF completo termina con %%EOF (puede seguirlo un salto de línea o relleno)
+    if b'%%EOF' not in data[-1024:]:
+        raise UploadRejected('CORRUPT_PDF', 'El PDF está incompleto o dañado (no se encontró el final del archivo)')
+    if b'/Encrypt' in data:
+        raise UploadRejected('ENCRYPTED_PDF', 'El PDF está protegido con contraseña')
+
+    pages = len(PDF_PAGE_PATTERN.findall(data))
+    # Con object streams (PDF 1.5+) las páginas pueden estar comprimidas: sin conteo no se rechaza
+    if pages == 0 and b'/ObjStm' not in data:
+        raise UploadRejected('EMPTY_PDF', 'El PDF no tiene páginas')
+    if pages > MAX_PDF_PAGES:
+        raise UploadRejected('TOO_MANY_PAGES', f'El PDF tiene {pages} páginas; el máximo es {MAX_PDF_PAGES}')
+    return pages
+
+
+def validate_upload(data, filename):
+    """
+    Valida el contenido de una factura subida.
+
+    Devuelve la extensión que corresponde al formato real (puede diferir de la
+    del nombre); lanza UploadRejected si el archivo no puede analizarse.
+    """
+    if not allowed_file(filename):
+        raise UploadRejected(
+            'UNSUPPORTED_EXTENSION', 'Formato de archivo no permitido. Use: PNG, JPG, JPEG, GIF o PDF'
+        )
+    if not data:
+        raise UploadRejected('EMPTY_FILE', 'El archivo está vacío')
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise UploadRejected(
+            'FILE_TOO_LARGE', f'El archivo supera el máximo de {MAX_UPLOAD_BYTES // (1024 * 1024)} MB', status=413
+        )
+
+    ext = sniff_extension(data)
+    if ext is None:
+        raise UploadRejected('UNKNOWN_FORMAT', 'El contenido del archivo no es una imagen ni un PDF')
+    if ext == '.pdf':
+        _validate_pdf(data)
+    else:
+        _validate_image(data)
+    return ext
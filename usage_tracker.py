@@ -0,0 +1,272 @@
+"""
+Contabilidad de tokens y costo de las llamadas a Anthropic.
+
+Cada llamada registra los tokens de entrada, salida y caché junto con la
+etapa del análisis (identificación de la compañía o extracción de
+identificadores), el modelo y el código de compañía. Los totales se agregan en
+el proceso y se exponen en /metrics/usage. Con un presupuesto diario
+configurado, al superarlo se pasa al modelo económico.
+"""
+
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_MODEL = "claude-3-opus-20240229"
+DEFAULT_ECONOMY_MODEL = "claude-3-haiku-20240307"
+
+# Precios en USD por millón de tokens (entrada, salida)
+MODEL_PRICES = {
+    "claude-3-opus-20240229": (15.0, 75.0),
+    "claude-3-sonnet-20240229": (3.0, 15.0),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-3-5-sonnet-20241022": (3.0, 15.0),
+    "claude-3-5-haiku-20241022": (0.8, 4.0)
+}
+# Multiplicadores sobre el precio de entrada para lecturas y escrituras de caché
+CACHE_READ_FACTOR = 0.1
+CACHE_WRITE_FACTOR = 1.25
+
+# Límite de tokens de salida en modo económico (las respuestas son JSON cortos)
+ECONOMY_MAX_TOKENS = 1000
+
+# Uso de la solicitud en curso: llamadas acumuladas y compañía, si ya se conoce
+_current = contextvars.ContextVar('analysis_usage', default=None)
+
+
+def usage_cost(model, input_tokens, output_tokens, cache_read_tokens=0, cache_creation_tokens=0):
+    """Costo estimado en USD de una llamada (0 si el modelo no tiene precio conocido)."""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (
+        input_tokens * input_price
+        + cache_read_tokens * input_price * CACHE_READ_FACTOR
+        + cache_creation_tokens * input_price * CACHE_WRITE_FACTOR
+        + output_tokens * output_price
+    ) / 1_000_000
+
+
+def _today():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+class UsageCall:
+    def __init__(self, stage, model, usage, latency):
+        self.stage = stage or 'unknown'
+        self.model = model
+        self.input_tokens = getattr(usage, 'input_tokens', 0) or 0
+        self.output_tokens = getattr(usage, 'output_tokens', 0) or 0
+        self.cache_read_tokens = getattr(usage, 'cache_read_input_tokens', 0) or 0
+        self.cache_creation_tokens = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+        self.latency = latency
+        self.cost = usage_cost(
+            model, self.input_tokens, self.output_tokens,
+            self.cache_read_tokens, self.cache_creation_tokens
+        )
+
+
+class RequestUsage:
+    """Llamadas de un análisis; se agregan al terminar, cuando ya se conoce la compañía."""
+
+    def __init__(self):
+        self.calls = []
+        self.company_code = ''
+
+    def summary(self):
+        return {
+            'company_code': self.company_code,
+            'calls': len(self.calls),
+            'input_tokens': sum(call.input_tokens for call in self.calls),
+            'output_tokens': sum(call.output_tokens for call in self.calls),
+            'cache_read_tokens': sum(call.cache_read_tokens for call in self.calls),
+            'cache_creation_tokens': sum(call.cache_creation_tokens for call in self.calls),
+            'cost_usd': round(sum(call.cost for call in self.calls), 6),
+            'latency_seconds': round(sum(call.latency for call in self.calls), 3),
+            'models': sorted({call.model for call in self.calls})
+        }
+
+
+def _empty_bucket():
+    return {
+        'calls': 0,
+        'input_tokens': 0,
+        'output_tokens': 0,
+        'cache_read_tokens': 0,
+        'cache_creation_tokens': 0,
+        'cost_usd': 0.0,
+        'latency_seconds': 0.0
+    }
+
+
+def _add(bucket, call):
+    bucket['calls'] += 1
+    bucket['input_tokens'] += call.input_tokens
+    bucket['output_tokens'] += call.output_tokens
+    bucket['cache_read_tokens'] += call.cache_read_tokens
+    bucket['cache_creation_tokens'] += call.cache_creation_tokens
+    bucket['cost_usd'] += call.cost
+    bucket['latency_seconds'] += call.latency
+
+
+def _export(buckets):
+    exported = {}
+    for key, bucket in buckets.items():
+        item = dict(bucket)
+        item['cost_usd'] = round(item['cost_usd'], 6)
+        item['avg_latency_seconds'] = round(item['latency_seconds'] / item['calls'], 3) if item['calls'] else 0.0
+        item['latency_seconds'] = round(item['latency_seconds'], 3)
+        exported[key] = item
+    return exported
+
+
+class UsageTracker:
+    def __init__(self, model=DEFAULT_MODEL, economy_model=DEFAULT_ECONOMY_MODEL,
+                 daily_budget=0.0, company_daily_budget=0.0):
+        self.model = model
+        self.economy_model = economy_model
+        # Presupuestos en USD por día (UTC); 0 desactiva el límite
+        self.daily_budget = daily_budget
+        self.company_daily_budget = company_daily_budget
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.day = _today()
+        self.day_cost = 0.0
+        self.day_company_cost = {}
+        self.economy_calls = 0
+        self.totals = _empty_bucket()
+        self.by_stage = {}
+        self.by_model = {}
+        self.by_company = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            model=os.environ.get('ANTHROPIC_MODEL', DEFAULT_MODEL),
+            economy_model=os.environ.get('ANTHROPIC_ECONOMY_MODEL', DEFAULT_ECONOMY_MODEL),
+            daily_budget=float(os.environ.get('ANTHROPIC_DAILY_BUDGET_USD', 0)),
+            company_daily_budget=float(os.environ.get('ANTHROPIC_COMPANY_DAILY_BUDGET_USD', 0))
+        )
+
+    def _roll_day(self):
+        today = _today()
+        if today != self.day:
+            self.day = today
+            self.day_cost = 0.0
+            self.day_company_cost = {}
+
+    def _over_budget(self, company_code):
+        if self.daily_budget and self.day_cost >= self.daily_budget:
+            return True
+        if self.company_daily_budget and company_code:
+            return self.day_company_cost.get(company_code, 0.0) >= self.company_daily_budget
+        return False
+
+    def request_options(self, company_code=None):
+        """Modelo y max_tokens para la próxima llamada según el presupuesto del día."""
+        if company_code is None:
+            company_code = current_company()
+        with self._lock:
+            self._roll_day()
+            if self._over_budget(company_code):
+                self.economy_calls += 1
+                return {'model': self.economy_model, 'max_tokens': ECONOMY_MAX_TOKENS, 'economy': True}
+        return {'model': self.model, 'max_tokens': 4000, 'economy': False}
+
+    def record(self, stage, model, usage, latency):
+        """Registra una llamada; dentro de un análisis se agrega al cerrar usage_scope."""
+        call = UsageCall(stage, model, usage, latency)
+        request_usage = _current.get()
+        if request_usage is not None:
+            request_usage.calls.append(call)
+            # El costo del día se descuenta enseguida para que el presupuesto reaccione a tiempo
+            with self._lock:
+                self._roll_day()
+                self.day_cost += call.cost
+                if request_usage.company_code:
+                    self._charge_company(request_usage.company_code, call.cost)
+        else:
+            self._aggregate([call], '', charge_day=True)
+        return call
+
+    def _charge_company(self, company_code, cost):
+        self.day_company_cost[company_code] = self.day_company_cost.get(company_code, 0.0) + cost
+
+    def _aggregate(self, calls, company_code, charge_day=False):
+        company_key = company_code or 'unknown'
+        with self._lock:
+            self._roll_day()
+            for call in calls:
+                _add(self.totals, call)
+                _add(self.by_stage.setdefault(call.stage, _empty_bucket()), call)
+                _add(self.by_model.setdefault(call.model, _empty_bucket()), call)
+                _add(self.by_company.setdefault(company_key, _empty_bucket()), call)
+                if charge_day:
+                    self.day_cost += call.cost
+                    if company_code:
+                        self._charge_company(company_code, call.cost)
+
+    def finish(self, request_usage):
+        self._aggregate(request_usage.calls, request_usage.company_code)
+
+    def tag_company(self, company_code):
+        """Asocia el análisis en curso a una compañía (incluye las llamadas ya hechas)."""
+        request_usage = _current.get()
+        if request_usage is None or not company_code or request_usage.company_code:
+            return
+        request_usage.company_code = company_code
+        cost = sum(call.cost for call in request_usage.calls)
+        with self._lock:
+            self._roll_day()
+            self._charge_company(company_code, cost)
+
+    def stats(self):
+        with self._lock:
+            self._roll_day()
+            return {
+                'since': self.started_at,
+                'model': self.model,
+                'economy_model': self.economy_model,
+                'today': {
+                    'day': self.day,
+                    'cost_usd': round(self.day_cost, 6),
+                    'budget_usd': self.daily_budget,
+                    'company_budget_usd': self.company_daily_budget,
+                    'economy_mode': bool(self.daily_budget and self.day_cost >= self.daily_budget),
+                    'companies_over_budget': sorted(
+                        code for code, cost in self.day_company_cost.items()
+                        if self.company_daily_budget and cost >= self.company_daily_budget
+                    )
+                },
+                'economy_calls': self.economy_calls,
+                'totals': _export({'all': self.totals})['all'],
+                'by_stage': _export(self.by_stage),
+                'by_model': _export(self.by_model),
+                'by_company': _export(self.by_company)
+            }
+
+
+def current_company():
+    request_usage = _current.get()
+    return request_usage.company_code if request_usage is not None else ''
+
+
+@contextmanager
+def usage_scope():
+    """Agrupa las llamadas de un análisis y las agrega al terminar."""
+    request_usage = RequestUsage()
+    token = _current.set(request_usage)
+    try:
+        yield request_usage
+    finally:
+        _current.reset(token)
+        usage_tracker.finish(request_usage)
+
+
+# Contabilidad compartida por el proceso
+usage_tracker = UsageTracker.from_env()
@@ -0,0 +1,68 @@
+"""
+Precalentamiento del proceso antes de atender tráfico.
+
+Importa las dependencias pesadas, carga el catálogo de compañías, precalcula
+las plantillas de identificadores y construye los clientes compartidos. Con
+gunicorn y `preload_app` se ejecuta una vez en el proceso maestro, antes del
+fork, y los workers heredan todo ya inicializado.
+"""
+
+import time
+import importlib
+import threading
+
+# Dependencias cuya importación es costosa y se difiere hasta el primer uso
+HEAVY_MODULES = ('anthropic', 'requests', 'PIL.Image')
+
+_state = {
+    'ready': False,
+    'inProgress': False,
+    'startedAt': None,
+    'durationSeconds': None,
+    'companies': 0,
+    'error': None
+}
+_lock = threading.Lock()
+
+
+def warm_up():
+    """Ejecuta el precalentamiento una sola vez; las llamadas siguientes no hacen nada."""
+    with _lock:
+        if _state['ready']:
+            return dict(_state)
+
+        started = time.monotonic()
+        _state['startedAt'] = time.time()
+        _state['inProgress'] = True
+        try:
+            for module_name in HEAVY_MODULES:
+                importlib.import_module(module_name)
+
+            from pdf_analyzer import InvoiceAnalyzer
+            from catalog import get_catalog
+
+            analyzer = InvoiceAnalyzer()
+            InvoiceAnalyzer.http_session()
+            catalog = get_catalog(analyzer.companies_file)
+
+            # Las plantillas imprimen el detalle de cada modalidad: no hace falta en el arranque
+            for entry in catalog.entries:
+                active_modalities = analyzer.get_active_modalities(entry.service, quiet=True)
+                if active_modalities:
+                    analyzer.identifiers_plan(entry.service, active_modalities, quiet=True)
+
+            _state['companies'] = len(catalog.entries)
+            _state['error'] = None
+            _state['ready'] = True
+        except Exception as e:
+            _state['error'] = str(e)
+            print(f"Error durante el precalentamiento: {str(e)}")
+        _state['inProgress'] = False
+        _state['durationSeconds'] = round(time.monotonic() - started, 3)
+        print(f"Precalentamiento {'completado' if _state['ready'] else 'fallido'} en {_state['durationSeconds']}s")
+        return dict(_state)
+
+
+def readiness():
+    """Estado actual del precalentamiento (no espera a que termine)."""
+    return dict(_state)